@@ -5,21 +5,40 @@ import os
 import sys
 import logging
 import asyncio
+import signal
 
 import asyncpg
 
-from .utils import conf, amqp, exceptions
+from .utils import conf, amqp, exceptions, routing, metrics, schemas
+from . import supervisor
+from .utils.conf_logging import set_correlation_id
 from .utils.json import FEGAMessage
+from .utils.db import has_statements
+from .handlers import job_size
 from .handlers import (ingest,
                        cancel,
                        # heartbeat,
                        accession,
                        user,
                        dataset,
-                       dac)
+                       dac,
+                       verify)
 
 LOG = logging.getLogger(__name__)
 
+# Keep a reference to the background tasks, so they are not garbage-collected
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# The tasks processing a message: True once the job started (ie got its slot)
+in_flight = {}
+draining = False
+
 def mq_report(func):
     async def wrapper(config, message):
         try:
@@ -50,7 +69,18 @@ def ack_nack_on_exception(on_message):
         try:
             await on_message(*args, **kwargs)
             LOG.info('Acking message %d', message.delivery.delivery_tag)
+            # Only this delivery tag (not multiple=True): messages complete out of order
             await message.channel.basic_ack(message.delivery.delivery_tag)
+        except asyncio.CancelledError: # shutting down
+            LOG.warning('Interrupted: requeuing message %d', message.delivery.delivery_tag)
+            try:
+                await message.channel.basic_nack(message.delivery.delivery_tag, requeue=True)
+            except Exception as e:
+                LOG.error('Could not requeue message %d: %r', message.delivery.delivery_tag, e)
+            raise
+        except exceptions.TransientError as e: # try again later
+            LOG.warning('Transient error: requeuing message %d: %r', message.delivery.delivery_tag, e)
+            await message.channel.basic_nack(message.delivery.delivery_tag, requeue=True)
         except Exception as e:
             LOG.error('%r', e, exc_info=True)
             LOG.info('Nacking message %d', message.delivery.delivery_tag)
@@ -63,6 +93,7 @@ def ack_nack_on_exception(on_message):
 async def work(config, message):
 
     correlation_id = message.header.properties.correlation_id
+    set_correlation_id(correlation_id)
     LOG.info('Working on message %d', message.delivery.delivery_tag, extra={'correlation_id': correlation_id})
 
     job_type = message.parsed.get('type', None)
@@ -70,40 +101,61 @@ async def work(config, message):
     if job_type is None:
         raise Exception('Missing job type: Invalid message')
 
+    # Reject invalid messages before spending any I/O on them
+    message.validate()
+
+    # Already processed? (the message was redelivered)
+    key = None
+    if config.idempotency.applies(job_type):
+        key = config.idempotency.key(correlation_id, job_type, message.body)
+        result = await config.idempotency.lookup(key)
+        if result is not None:
+            LOG.info('Message already processed: skipping it')
+            await config.idempotency.replay(result, correlation_id)
+            return
+
+    # Wait for a free slot for that job type (the small files first)
+    size = job_size(config, job_type, message.parsed) if job_type in config.scheduler.prioritized else 0
+    async with config.scheduler.slot(job_type, size=size):
+        in_flight[asyncio.current_task()] = True # started: let it finish when shutting down
+        result = await dispatch(config, message, job_type)
+
+    if key is not None:
+        await config.idempotency.record(key, job_type, correlation_id, result)
+
+async def dispatch(config, message, job_type):
 
     LOG.debug('Message: %s', message.parsed)
 
     if job_type == 'ingest':
-        # delay in case another worker picked up a cancel message fast
-        await asyncio.sleep(1)
-
-        await ingest.execute(config, message)
+        # ingest checks itself if a cancel message was picked up (by any worker)
+        return await ingest.execute(config, message)
     elif job_type == 'cancel':
 
-        await cancel.execute(config, message)
+        return await cancel.execute(config, message)
 
     elif job_type == 'accession':
-        await accession.execute(config, message)
+        return await accession.execute(config, message)
 
     elif job_type == 'mapping':
 
-        await dataset.execute(config, message)
+        return await dataset.execute(config, message)
 
     elif job_type == 'deprecate':
 
-        await dataset.deprecate(config, message)
+        return await dataset.deprecate(config, message)
 
     elif job_type == 'release':
 
-        await dataset.release(config, message)
+        return await dataset.release(config, message)
 
     elif job_type == 'permission':
 
-        await dataset.permission(config, message)
+        return await dataset.permission(config, message)
 
     elif job_type == 'permission.deleted':
 
-        await dataset.delete_permission(config, message)
+        return await dataset.delete_permission(config, message)
 
 #    elif job_type == 'user':
 #
@@ -111,27 +163,27 @@ async def work(config, message):
 
     elif job_type == 'password.updated':
 
-        await user.password(config, message)
+        return await user.password(config, message)
 
     elif job_type == 'contact.updated':
 
-        await user.contact(config, message)
+        return await user.contact(config, message)
 
     elif job_type == 'keys.updated':
 
-        await user.keys(config, message)
+        return await user.keys(config, message)
 
     elif job_type == 'dac.dataset':
 
-        await dac.dataset(config, message)
+        return await dac.dataset(config, message)
 
     elif job_type == 'dac.members':
 
-        await dac.members(config, message)
+        return await dac.members(config, message)
 
     elif job_type == 'dac':
 
-        await dac.update(config, message)
+        return await dac.update(config, message)
 
 
     # elif job_type == 'heartbeat':
@@ -157,6 +209,45 @@ async def work(config, message):
 
 
 
+async def shutdown(config):
+    """Stop consuming, let the started jobs finish (within [jobs] drain_timeout), and requeue the other ones."""
+    global draining
+    if draining:
+        return
+    draining = True
+    timeout = config.getfloat('jobs', 'drain_timeout', fallback=600)
+    LOG.warning('Shutting down: draining the in-flight jobs')
+
+    await config.mq.stop_consuming()
+
+    # The jobs still waiting for a slot go back to the queue
+    waiting = [task for task, started in in_flight.items() if not started]
+    for task in waiting:
+        task.cancel()
+
+    running = [task for task, started in in_flight.items() if started]
+    if running:
+        LOG.info('Waiting for %d jobs to finish (at most %.0f seconds)', len(running), timeout)
+        _, pending = await asyncio.wait(running, timeout=timeout)
+        if pending:
+            # Cleaning up their staging files (or partial replicas), and requeuing their messages
+            LOG.warning('Interrupting %d jobs', len(pending))
+            for task in pending:
+                task.cancel()
+    await asyncio.gather(*waiting, *running, return_exceptions=True)
+
+    me = asyncio.current_task()
+    others = [task for task in background_tasks if task is not me]
+    for task in others:
+        task.cancel()
+    await asyncio.gather(*others, return_exceptions=True)
+
+    await config.mq.close()
+    await config.db.close()
+    LOG.info('Shutdown completed')
+    asyncio.get_running_loop().stop()
+
+
 def capture_all_errors(func):
     async def wrapper(*args, **kwargs):
         try:
@@ -167,40 +258,89 @@ def capture_all_errors(func):
     return wrapper
 
 @capture_all_errors
-async def main(conf_file):
+async def main(config):
 
-    os.umask(0o007) # no world permissions
+    run_in_background(metrics.serve(config))
 
-    config = conf.Configuration(conf_file)
-    LOG.debug('Config ready: %s', config)
+    # Compiling the JSON schemas, once
+    if schemas.enabled(config):
+        schemas.load(config)
 
     # pinging the DB first
     await config.db.ping()
 
+    # Loading the session keys we have seen so far
+    if config.session_keys.enabled:
+        await config.session_keys.warm()
+        run_in_background(config.session_keys.run_refresh())
+
+    # Sending the messages to Central EGA
+    if config.outbox.enabled:
+        run_in_background(config.outbox.relay(config.mq.publish_many))
+
+    if config.get('verification', 'policy', fallback='full') == 'deferred':
+        if not has_statements(config, *verify.DEFERRED_STATEMENTS):
+            raise ValueError(f'Deferred verifications need {", ".join(verify.DEFERRED_STATEMENTS)} in [db]')
+        run_in_background(verify.run_deferred(config))
+
     LOG.info('Setup completed')
 
     async def do_work(message):
+        if draining: # delivered right before the consumer was cancelled
+            await message.channel.basic_nack(message.delivery.delivery_tag, requeue=True)
+            return
+        task = asyncio.current_task()
+        in_flight[task] = False
         try:
             await work(config, FEGAMessage(message))
         except Exception as e:
             LOG.error('ERROR: %r', e, exc_info=True)
+        finally:
+            in_flight.pop(task, None)
+
+    # Drain on SIGTERM (eg a rolling deploy) or Ctrl-C
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, lambda: run_in_background(shutdown(config)))
 
     LOG.info('Consuming')
-    return await config.mq.consume(do_work)
+    consumers = routing.load(config)
+    if not consumers: # all the job types from the same queue
+        await config.mq.consume(do_work)
+    else:
+        await routing.start(config, do_work, consumers)
 
+    # Reconnect and consume again, if the broker goes away
+    run_in_background(config.mq.supervise())
 
 
-if __name__ == '__main__':
 
-    if len(sys.argv) < 2:
-        command = ' '.join(sys.orig_argv)
-        print(f'Usage: {command} <conf_file>')
-        sys.exit(1)
-    loop = asyncio.get_event_loop()
-    loop.create_task(main(sys.argv[1]))
+def serve(config):
+    """Run the event loop (until the shutdown stops it)."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.create_task(main(config))
     try:
         loop.run_forever()
     except KeyboardInterrupt as e:
         LOG.warning('Cancelled')
         sys.exit(1)
 
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        command = ' '.join(sys.orig_argv)
+        print(f'Usage: {command} <conf_file>')
+        sys.exit(1)
+
+    os.umask(0o007) # no world permissions
+
+    config = conf.Configuration(sys.argv[1])
+    LOG.debug('Config ready: %s', config)
+
+    workers = config.getint('supervisor', 'workers', fallback=0)
+    if workers > 0: # pre-forking
+        supervisor.run(config, workers, serve)
+    else:
+        serve(config)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Bulk import of an existing archive into the vault DB.
+
+Instead of one upsert_file and one mapping message per file,
+the manifest is streamed with COPY into private.backfill_table,
+and then merged (set-based) into the file and dataset tables,
+in parallel partitions.
+
+The manifest is a tab-separated file, with a header line and the columns:
+
+    accession  relative_path  header  payload_size  payload_checksum  decrypted_checksum  [display_name]  [dataset]
+
+The header is hex-encoded (and already re-encrypted for the master key).
+A file in several datasets is listed once per dataset.
+
+Usage: python -m code.backfill <conf_file> <manifest> (or - for stdin)
+"""
+
+import sys
+import logging
+import asyncio
+import csv
+import time
+import zlib
+
+import asyncpg
+
+from .utils import conf
+
+LOG = logging.getLogger(__name__)
+
+COLUMNS = ('stable_id', 'relative_path', 'header', 'payload_size',
+           'payload_checksum', 'decrypted_checksum', 'display_name', 'dataset_stable_id', 'partition')
+
+def parse(row, partitions):
+    """Convert a manifest row into a backfill_table record."""
+    accession = row['accession'].strip()
+    if not accession:
+        raise ValueError('Missing accession')
+    relative_path = row['relative_path'].strip()
+    if not relative_path:
+        raise ValueError('Missing relative_path')
+    return (accession,
+            relative_path,
+            bytes.fromhex(row['header']),
+            int(row['payload_size']),
+            row['payload_checksum'] or None,
+            row['decrypted_checksum'] or None,
+            row.get('display_name') or None,
+            row.get('dataset') or None,
+            zlib.crc32(accession.encode()) % partitions)
+
+def read_manifest(infile, partitions, batch_size, errors):
+    """Yield the records by batches. The invalid rows are collected in errors."""
+    reader = csv.DictReader(infile, delimiter='\t')
+    batch = []
+    for row in reader:
+        try:
+            batch.append(parse(row, partitions))
+        except Exception as e:
+            LOG.error('Line %d: %r', reader.line_num, e)
+            errors.append(reader.line_num)
+            continue
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def copy(pool, infile, partitions, batch_size):
+    """Stream the manifest into the staging table. Return the number of rows and the invalid lines."""
+    errors = []
+    count = 0
+    start = time.monotonic()
+    async with pool.acquire() as conn:
+        await conn.execute('TRUNCATE private.backfill_table') # leftovers of a previous run
+        for batch in read_manifest(infile, partitions, batch_size, errors):
+            await conn.copy_records_to_table('backfill_table', schema_name='private',
+                                             records=batch, columns=COLUMNS)
+            count += len(batch)
+            LOG.info('Copied %d rows (%.0f rows/s)', count, count / max(time.monotonic() - start, 1e-3))
+    return count, errors
+
+async def merge(pool, partitions, parallel):
+    """Merge the staging table, partitions in parallel. Return the number of new files."""
+    async with pool.acquire() as conn:
+        datasets = await conn.fetchval('SELECT public.merge_backfill_datasets()')
+    LOG.info('%d new datasets', datasets)
+
+    sem = asyncio.Semaphore(parallel)
+    done = 0
+    start = time.monotonic()
+
+    async def merge_partition(partition):
+        nonlocal done
+        async with sem, pool.acquire() as conn:
+            files = await conn.fetchval('SELECT public.merge_backfill($1)', partition)
+        done += 1
+        LOG.info('Partition %d merged: %d new files (%d/%d partitions, %.1f s)',
+                 partition, files, done, partitions, time.monotonic() - start)
+        return files
+
+    return sum(await asyncio.gather(*(merge_partition(p) for p in range(partitions))))
+
+
+async def run(config, manifest):
+    partitions = config.getint('backfill', 'partitions', fallback=16)
+    parallel = config.getint('backfill', 'parallel', fallback=4)
+    batch_size = config.getint('backfill', 'batch_size', fallback=10000)
+
+    dsn = config.getsensitive('db', 'connection', raw=True)
+    if isinstance(dsn, bytes):  # secret to str
+        dsn = dsn.decode()
+    # Its own pool: no prepared statements, and no statement timeout (a partition can take a while)
+    pool = await asyncpg.create_pool(dsn, min_size=1, max_size=parallel, command_timeout=None,
+                                     server_settings={'statement_timeout': '0'})
+    try:
+        LOG.info('Copying %s', manifest)
+        if manifest == '-':
+            count, errors = await copy(pool, sys.stdin, partitions, batch_size)
+        else:
+            with open(manifest, newline='') as infile:
+                count, errors = await copy(pool, infile, partitions, batch_size)
+        if errors:
+            LOG.error('%d invalid rows: nothing merged', len(errors))
+            return 1
+
+        LOG.info('Merging %d rows in %d partitions (%d in parallel)', count, partitions, parallel)
+        files = await merge(pool, partitions, parallel)
+        LOG.info('Backfill completed: %d new files', files)
+
+        async with pool.acquire() as conn:
+            await conn.execute('TRUNCATE private.backfill_table')
+        return 0
+    finally:
+        await pool.close()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        command = ' '.join(sys.orig_argv)
+        print(f'Usage: {command} <conf_file> <manifest>')
+        sys.exit(1)
+
+    config = conf.Configuration(sys.argv[1])
+    sys.exit(asyncio.run(run(config, sys.argv[2])))
@@ -2,8 +2,45 @@ import logging
 import os
 from pathlib import Path
 
+from crypt4gh import header
+
+from ..utils import staging
+
 LOG = logging.getLogger(__name__)
 
+def replica_locations(config):
+    """Return the locations where the files are archived.
+
+    The first one is the vault. The others are backups.
+    """
+    sections = config.get('accession', 'replicas', fallback='vault, backup')
+    return [config.get(section.strip(), 'location') for section in sections.split(',') if section.strip()]
+
+def job_size(config, job_type, data):
+    """Return the size of the file the job works on (0 if unknown).
+
+    Only a stat, to schedule the small files first.
+    """
+    try:
+        if job_type == 'ingest':
+            prefix = config.get('inbox', 'location', raw=True)
+        elif job_type == 'accession':
+            prefix = config.get('staging', 'location', raw=True)
+        else:
+            return 0
+        return os.stat(os.path.join(prefix % data['user'], data['filepath'].strip('/'))).st_size
+    except Exception as e:
+        LOG.debug('No size for the %s job: %r', job_type, e)
+        return 0
+
+def reencrypt_header(config, packets):
+    """Re-encrypt the decrypted header packets for the master key."""
+    # Note: we do not use an ephemeral key: the service key is the sender
+    master_key = (0, config.service_key.private(), config.master_pubkey)
+    master_packets = [encrypted_packet for packet in packets
+                      for encrypted_packet in header.encrypt(packet, [master_key])]
+    return header.serialize(master_packets)
+
 # the clean_empty defaults to False to avoid a datarace
 def clean_staging(config, data, clean_empty=False):
     try:
@@ -13,6 +50,7 @@ def clean_staging(config, data, clean_empty=False):
         staging_path = os.path.join(staging_prefix % username, filepath.strip('/') )
         LOG.info('Cleaning %s', staging_path)
         p = Path(staging_path)
+        staging.remove_info(config, staging_path)
         p.unlink()
     except Exception as e:
         LOG.warning('Ignoring staging file error: %r', e)
@@ -7,50 +7,46 @@ import hashlib
 from functools import partial
 import asyncio
 from pathlib import Path
+from contextlib import ExitStack
 from hmac import compare_digest
 
 from crypt4gh import header, lib as c4gh
 import asyncpg
 
-from . import clean_staging
-from ..utils import exceptions
+from . import clean_staging, replica_locations, reencrypt_header, verify
+from ..utils import exceptions, staging, fastcopy
 
 LOG = logging.getLogger(__name__)
 
-CHUNKSIZE = 1024 * 1024
-
 def name2fs(name):
     """Convert a name to a file system relative path."""
     return os.path.join(*list(name[i:i+3] for i in range(0, len(name), 3)))
 
-async def checkum_and_compare(path, orgmd):
-    LOG.debug('Reading again file %s', path)
+async def copy_payload(infile, outfile, offset, count, method):
     loop = asyncio.get_running_loop()
-    md = hashlib.sha256()
-    with open(path, 'rb') as f:
-        while True:
-            # Making it asyncio
-            do_read = partial(f.read, CHUNKSIZE)
-            blob = await loop.run_in_executor(None, do_read) # default thread pool
-            if not blob:
-                break # We were at the end
-            md.update(blob)
-
-    c = md.hexdigest()
-    
-    if not compare_digest(c, orgmd): # could use c != orgmd
-        LOG.error('Backup failed: different checksums for the payloads')
-        LOG.error('* md1: %s', c)
-        LOG.error('* md2: %s', orgmd)
-        raise exceptions.ChecksumsNotMatching(path, c, orgmd)
+    do_copy = partial(fastcopy.copy_range, infile.fileno(), outfile.fileno(), offset, count, method=method)
+    used = await loop.run_in_executor(None, do_copy) # default thread pool
+    LOG.debug('Copied %d bytes to %s using %s', count, outfile.name, used)
+
+def remove_replicas(replica_paths):
+    # Don't leave partial or corrupt replicas: an existing vault path means an archived file
+    LOG.warning('Removing the replicas')
+    for path in replica_paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
 
 async def send_completion(config, staging_path, message):
+    # Publish the same message back
+    # (first, so that the staging file is kept if the broker did not confirm it)
+    if not await config.mq.cega_publish(message.parsed, 'files.completed', correlation_id=message.header.properties.content_type):
+        raise exceptions.PublishError('files.completed')
+
     # Success: Clean the staging path
     LOG.info('Cleaning staging path: %s', staging_path)
     clean_staging(config, message.parsed)
-    
-    # Publish the same message back
-    await config.mq.cega_publish(message.parsed, 'files.completed', correlation_id=message.header.properties.content_type)
+    return { 'routing_key': 'files.completed', 'message': message.parsed }
 
 
 async def execute(config, message):
@@ -63,110 +59,112 @@ async def execute(config, message):
     LOG.info('Processing %s: %s', username, filepath)
 
     staging_prefix = config.get('staging', 'location', raw=True)
-    vault_prefix = config.get('vault', 'location')
-    backup_prefix = config.get('backup', 'location')
 
     staging_path = os.path.join(staging_prefix % username, filepath.strip('/') )
     LOG.debug('Staging path: %s', staging_path)
 
     relative_path = name2fs(accession_id)
-    vault_path = os.path.join(vault_prefix, relative_path)
+    replica_paths = [os.path.join(prefix, relative_path) for prefix in replica_locations(config)]
+    vault_path = replica_paths[0]
     LOG.debug('Vault path: %s', vault_path)
+    for backup_path in replica_paths[1:]:
+        LOG.debug('Backup path: %s', backup_path)
 
-    backup_path = os.path.join(backup_prefix, relative_path)
-    LOG.debug('Backup path: %s', backup_path)
-
-    # Create directories
-    vpath = Path(vault_path)
-    bpath = Path(backup_path)
-
-    if vpath.exists(): # do nothing and return early
+    if Path(vault_path).exists(): # do nothing and return early
         LOG.info('Vault path already exists')
         return await send_completion(config, staging_path, message)
 
-    vpath.parent.mkdir(parents=True, exist_ok=True)
-    bpath.parent.mkdir(parents=True, exist_ok=True)
-
-    # Checksuming the payload
-    md_sha256 = hashlib.sha256()
-    
-    with open(staging_path, 'rb') as infile, open(vault_path, 'wb') as vfile, open(backup_path, 'wb') as bfile:
-
-        LOG.debug('Reencrypting the header')
-        try:
-            service_key = (0, config.service_key.private(), None) # not checking the sender
-            # Get session keys
-            header_packets = header.parse(infile)
-            decrypted_packets, _ = header.decrypt(header_packets, [service_key])  # don't bother with ignored packets
-            if not decrypted_packets: # no packets were decrypted
-                raise ValueError('No supported encryption method')
-
-            data_packets, _ = header.partition_packets(decrypted_packets)
-
-            # if edit_packet:
-            #     raise exceptions.FromUser('Support for Crypt4GH edit list has been removed')
-
-        except Exception as e:
-            LOG.error('Decryption error: %r', e)
-            raise exceptions.Crypt4GHHeaderDecryptionError() from e
-
-
-        # The master key.
-        # Note: we do not use an ephemeral key: the service key is the sender
-        master_key = (0, service_key[1], config.master_pubkey)
-
-        # The infile is left right at the position of the payload
-        # Decrypt and re-encrypt the header
-        master_packets = [encrypted_packet for packet in decrypted_packets
-                          for encrypted_packet in header.encrypt(packet, [master_key])]
-        master_header = header.serialize(master_packets)
-
-        LOG.info('Copying / Checksuming the payload')
-        loop = asyncio.get_running_loop()
-        while True:
-            # Making it asyncio
-            do_read = partial(infile.read, CHUNKSIZE)
-            blob = await loop.run_in_executor(None, do_read) # default thread pool
-            #blob = infile.read(CHUNKSIZE)
-            
-            if not blob:
-                break # We were at the end
-            
-            md_sha256.update(blob)
-
-            # Copy the chunk
-            # Note: we should use shutil.copyfile (which uses fastcopy or sendfile)
-            do_write = partial(vfile.write, blob)
-            await loop.run_in_executor(None, do_write)
-            do_write = partial(bfile.write, blob)
-            await loop.run_in_executor(None, do_write)
-
-    # Read the encrypted payload checksum
-    payload_sha256_checksum = md_sha256.hexdigest()
-
-    # Flush the file system and its cache here?
-    # os.fsync()
-
-    # We now read the Vault file again
-    await checkum_and_compare(vault_path, payload_sha256_checksum)
-    # Same for the backup file
-    await checkum_and_compare(backup_path, payload_sha256_checksum)
-
-    # encrypted payload size
-    encrypted_filesize = os.path.getsize(vault_path)
-
-    # We read the decrypted_checksum from the message, we don't compute it at this stage
-    decrypted_sha256_checksum = data.get('decrypted_checksums', [{}])[0].get('value')
-
-    # Save to database
-    LOG.debug('Saving to database')
-    await config.db.save_file(filepath,
-                              encrypted_filesize,
-                              master_header,
-                              payload_sha256_checksum,
-                              decrypted_sha256_checksum,
-                              accession_id,
-                              relative_path)
+    # Create directories
+    for path in replica_paths:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+    # Did the ingestion record the payload checksum?
+    info = staging.load_info(config, staging_path)
+
+    try:
+        with open(staging_path, 'rb') as infile, ExitStack() as stack:
+
+            outfiles = [stack.enter_context(open(path, 'wb')) for path in replica_paths]
+
+            if info and 'master_header' in info:
+                LOG.debug('Using the header re-encrypted by the ingestion')
+                master_header = bytes.fromhex(info['master_header'])
+                payload_start = info['header_size']
+            else:
+                LOG.debug('Reencrypting the header')
+                try:
+                    service_key = (0, config.service_key.private(), None) # not checking the sender
+                    # Get session keys
+                    header_packets = header.parse(infile)
+                    decrypted_packets, _ = header.decrypt(header_packets, [service_key])  # don't bother with ignored packets
+                    if not decrypted_packets: # no packets were decrypted
+                        raise ValueError('No supported encryption method')
+
+                    # if edit_packet:
+                    #     raise exceptions.FromUser('Support for Crypt4GH edit list has been removed')
+
+                except Exception as e:
+                    LOG.error('Decryption error: %r', e)
+                    raise exceptions.Crypt4GHHeaderDecryptionError() from e
+
+                # Decrypt and re-encrypt the header
+                master_header = reencrypt_header(config, decrypted_packets)
+
+                # The infile is left right at the position of the payload
+                payload_start = infile.tell()
+                if info and payload_start != info['header_size']:
+                    raise exceptions.FEGASystemError(f'Unexpected header size for {staging_path}')
+
+            payload_size = os.fstat(infile.fileno()).st_size - payload_start
+
+            # Copy the payload inside the kernel, if the file systems allow it
+            copy_method = config.get('accession', 'copy_method', fallback='auto')
+            LOG.info('Copying the payload (%s)', copy_method)
+
+            # Fan out to all replicas at the same time (they are usually on different mounts)
+            copies = [copy_payload(infile, outfile, payload_start, payload_size, copy_method) for outfile in outfiles]
+
+            # Read the encrypted payload checksum
+            if info:
+                await asyncio.gather(*copies)
+                payload_sha256_checksum = info['payload_checksum']
+            else:
+                # Checksuming in parallel, mostly from the page cache
+                LOG.info('Checksuming the payload')
+                *_, payload_sha256_checksum = await asyncio.gather(*copies,
+                                                                   verify.checksum(staging_path, offset=payload_start))
+
+        # Flush the file system and its cache here?
+        # os.fsync()
+
+        # We now verify all the replicas, in parallel
+        verification = await verify.execute(config, replica_paths, payload_sha256_checksum,
+                                            staging_path, payload_start, payload_size)
+
+        # encrypted payload size
+        encrypted_filesize = os.path.getsize(vault_path)
+        if info and encrypted_filesize != info['payload_size']:
+            raise exceptions.FEGASystemError(f'Unexpected payload size for {vault_path}')
+
+        # We read the decrypted_checksum from the message, we don't compute it at this stage
+        decrypted_sha256_checksum = data.get('decrypted_checksums', [{}])[0].get('value')
+        if not decrypted_sha256_checksum and info:
+            decrypted_sha256_checksum = info['decrypted_checksum']
+
+        # Save to database
+        LOG.debug('Saving to database')
+        await config.db.save_file(filepath,
+                                  encrypted_filesize,
+                                  master_header,
+                                  payload_sha256_checksum,
+                                  decrypted_sha256_checksum,
+                                  accession_id,
+                                  relative_path)
+        await verify.record(config, accession_id, verification)
+    except BaseException: # including a failed verification, and the cancellation when shutting down
+        # Until the file and its verification are saved, the replicas should not look archived
+        remove_replicas(replica_paths)
+        raise
 
     # All good: send completion
     return await send_completion(config, staging_path, message)
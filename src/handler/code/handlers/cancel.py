@@ -1,12 +1,16 @@
 import logging
 
 from . import clean_staging
+from ..utils import cancellation
 
 LOG = logging.getLogger(__name__)
 
 async def execute(config, message):
 
-    clean_staging(config, message.parsed)
+    data = message.parsed
+    # Tell the (possibly running) ingestion to stop
+    cancellation.cancel(config, data['user'], data['filepath'], message.header.properties.correlation_id)
+    clean_staging(config, data)
     
 
 
@@ -8,13 +8,13 @@ LOG = logging.getLogger(__name__)
 #    LOG.debug('DAC response: %s', response)
 
 async def dataset(config, message):
-    response = await config.db.fetchval('on_dac_dataset_update', message.content)
+    response = await config.batcher.fetchval('on_dac_dataset_update', message)
     LOG.debug('DAC-dataset response: %s', response)
 
 async def update(config, message):
-    response = await config.db.fetchval('on_dac_update', message.content)
+    response = await config.batcher.fetchval('on_dac_update', message)
     LOG.debug('DAC update response: %s', response)
 
 async def members(config, message):
-    response = await config.db.fetchval('on_dac_members_update', message.content)
+    response = await config.batcher.fetchval('on_dac_members_update', message)
     LOG.debug('DAC-user update response: %s', response)
@@ -13,8 +13,8 @@ from pathlib import Path
 from crypt4gh import header, lib as c4gh
 import asyncpg
 
-from . import clean_staging
-from ..utils import exceptions
+from . import clean_staging, reencrypt_header
+from ..utils import exceptions, staging, cancellation
 
 LOG = logging.getLogger(__name__)
 
@@ -25,21 +25,94 @@ def clean_staging_on_failure(func):
         except exceptions.AlreadyInProgress as e:
             LOG.warning('Ignoring: %r', e)
             # raise e
+        except exceptions.IngestionCancelled as e:
+            LOG.warning('Cleaning staging: %r', e)
+            clean_staging(config, message.parsed)
+        except asyncio.CancelledError: # shutting down: the message is requeued
+            LOG.warning('Interrupted: cleaning staging')
+            clean_staging(config, message.parsed)
+            raise
         except Exception as e:
             LOG.error('Cleaning staging on error: %s', e)
             clean_staging(config, message.parsed)
             raise e
     return wrapper
 
+#############################################################################
+# Ingestion pipeline
+#
+# The payload goes through 3 stages, connected by bounded queues:
+#   reader -> staging writer + checksum of the encrypted payload
+#          -> decryptor + checksum (see utils/decrypt.py)
+# so that the disk reads, the disk writes and the decryption overlap.
+# An empty segment marks the end of the payload.
+#############################################################################
+
+async def read_stage(infile, *queues, checkpoint=None, every=256):
+    loop = asyncio.get_running_loop()
+    count = 0
+    while True:
+        count += 1
+        if checkpoint and count % every == 0:
+            checkpoint()
+        # Making it asyncio
+        do_read = partial(infile.read, c4gh.CIPHER_SEGMENT_SIZE)
+        ciphersegment = await loop.run_in_executor(None, do_read) # default thread pool
+        for q in queues:
+            await q.put(ciphersegment) # wait if the queue is full
+        if not ciphersegment:
+            break # We were at the last segment. Exits the loop
+
+def write_and_digest(outfile, md, ciphersegment):
+    outfile.write(ciphersegment)
+    md.update(ciphersegment)
+
+async def write_stage(outfile, queue, md):
+    loop = asyncio.get_running_loop()
+    while True:
+        ciphersegment = await queue.get()
+        if not ciphersegment:
+            break
+        # Copy and checksum the chunk
+        do_write = partial(write_and_digest, outfile, md, ciphersegment)
+        await loop.run_in_executor(None, do_write) # default thread pool
+
+async def run_stages(*stages):
+    """Run the stages concurrently and cancel them all if one fails.
+
+    Otherwise, the other stages would wait forever on their queues.
+    """
+    tasks = [asyncio.create_task(stage) for stage in stages]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result() # raise the stage exception, if any
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 @clean_staging_on_failure
 async def execute(config, message):
 
     data = message.parsed
     filepath = data['filepath']
     username = data['user']
+    correlation_id = message.header.properties.correlation_id
 
     LOG.info('Processing %s: %s', username, filepath)
 
+    # Did another worker pick up a cancel message already?
+    if cancellation.is_cancelled(config, username, filepath, correlation_id):
+        LOG.warning('Ingestion cancelled: %s', filepath)
+        return
+
+    # or while we copy the file
+    def check_cancelled():
+        if cancellation.is_cancelled(config, username, filepath, correlation_id):
+            raise exceptions.IngestionCancelled(filepath)
+
     inbox_prefix = config.get('inbox', 'location', raw=True)
     staging_prefix = config.get('staging', 'location', raw=True)
     
@@ -78,7 +151,12 @@ async def execute(config, message):
         try:
             service_key = (0, config.service_key.private(), None) # not checking the sender
             # Get session keys
-            session_keys, edit_list = header.deconstruct(infile, [service_key])
+            header_packets = header.parse(infile)
+            decrypted_packets, _ = header.decrypt(header_packets, [service_key])  # don't bother with ignored packets
+            if not decrypted_packets: # no packets were decrypted
+                raise ValueError('No supported encryption method')
+            data_packets, edit_packet = header.partition_packets(decrypted_packets)
+            session_keys = [header.parse_enc_packet(packet) for packet in data_packets]
         except Exception as e:
             LOG.error('Decryption error: %r', e)
             raise exceptions.Crypt4GHHeaderDecryptionError() from e
@@ -87,10 +165,17 @@ async def execute(config, message):
         if not session_keys:
             raise exceptions.SessionKeyDecryptionError('No session keys found')
 
-        if edit_list:
+        if edit_packet:
             raise exceptions.FromUser('Support for Crypt4GH edit list has been removed')
 
-           
+        # Was a session key already used for another file?
+        session_key_checksums = [config.session_keys.digest(key) for key in session_keys]
+        await config.session_keys.check(session_key_checksums, username, filepath)
+
+        # Re-encrypt the header for the master key now,
+        # so accession does not have to decrypt it again
+        master_header = reencrypt_header(config, decrypted_packets)
+
         # The infile is left right at the position of the payload
         pos = infile.tell()
 
@@ -102,41 +187,48 @@ async def execute(config, message):
         # Verifying the payload and calculating the checksums of the original content
         LOG.debug('Verifying payload')
         md_sha256 = hashlib.sha256()
+        # and the checksum of the encrypted payload, for the accession step
+        payload_sha256 = hashlib.sha256()
 
         LOG.info('Decrypting / Copying / Checksuming the payload')
-        loop = asyncio.get_running_loop()
+        read_ahead = config.getint('ingest', 'read_ahead', fallback=4)
+        LOG.debug('Pipeline read-ahead: %d segments', read_ahead)
+        to_staging = asyncio.Queue(maxsize=read_ahead)
+        to_decrypt = asyncio.Queue(maxsize=read_ahead)
         try:
             # Decrypting chunk by chunk in memory. No trace on disk.
             start_time = time.time()
-            while True:
-                # Making it asyncio
-                do_read = partial(infile.read, c4gh.CIPHER_SEGMENT_SIZE)
-                ciphersegment = await loop.run_in_executor(None, do_read) # default thread pool
-                #ciphersegment = infile.read(c4gh.CIPHER_SEGMENT_SIZE)
-
-                ciphersegment_len = len(ciphersegment)
-                if ciphersegment_len == 0:
-                    break # We were at the last segment. Exits the loop
-                assert( ciphersegment_len > c4gh.CIPHER_DIFF )
-
-                # Copy the chunk
-                do_write = partial(outfile.write, ciphersegment)
-                await loop.run_in_executor(None, do_write) # default thread pool
-                # outfile.write(ciphersegment)
-
-                # Decrypt the segment
-                segment = c4gh.decrypt_block(ciphersegment, session_keys)
-                md_sha256.update(segment)
-
+            await run_stages(read_stage(infile, to_staging, to_decrypt, checkpoint=check_cancelled),
+                             write_stage(outfile, to_staging, payload_sha256),
+                             config.decryptor.digest(to_decrypt, session_keys, md_sha256))
             LOG.debug('Elpased time: %.2f seconds', time.time() - start_time)
             LOG.info('Verification completed')
 
+        except exceptions.IngestionCancelled:
+            raise
         except Exception as v: # capture any error here
             raise exceptions.Crypt4GHPayloadDecryptionError() from v
 
+        # Cancelled during the last segments (checked only every so often)?
+        check_cancelled()
+
         # Add decrypted checksums to message
         decrypted_payload_checksum = md_sha256.hexdigest()
         data['decrypted_checksums'] = [{'type': 'sha256', 'value': decrypted_payload_checksum}] # for accession id
 
+        # Accept the session keys
+        await config.session_keys.save(session_key_checksums, username, filepath)
+
+        # Record what accession would otherwise have to re-read
+        staging.save_info(config, staging_path, {
+            'header_size': pos,
+            'payload_size': infile.tell() - pos,
+            'payload_checksum': payload_sha256.hexdigest(),
+            'decrypted_checksum': decrypted_payload_checksum,
+            'master_header': master_header.hex(),
+        })
+
         # Publish the verified message
-        await config.mq.cega_publish(data, 'files.verified', correlation_id=message.header.properties.content_type)
+        if not await config.mq.cega_publish(data, 'files.verified', correlation_id=message.header.properties.content_type):
+            raise exceptions.PublishError('files.verified')
+        return { 'routing_key': 'files.verified', 'message': data }
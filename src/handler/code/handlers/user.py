@@ -9,13 +9,13 @@ LOG = logging.getLogger(__name__)
 #    LOG.debug('User update response: %s', response)
 
 async def password(config, message):
-    response = await config.db.fetchval('on_user_password_update', message.content) 
+    response = await config.batcher.fetchval('on_user_password_update', message) 
     LOG.debug('Dataset permission response: %s', response)
 
 async def keys(config, message):
-    response = await config.db.fetchval('on_user_keys_update', message.content) 
+    response = await config.batcher.fetchval('on_user_keys_update', message) 
     LOG.debug('Dataset permission response: %s', response)
 
 async def contact(config, message):
-    response = await config.db.fetchval('on_user_contact_update', message.content) 
+    response = await config.batcher.fetchval('on_user_contact_update', message) 
     LOG.debug('Dataset permission response: %s', response)
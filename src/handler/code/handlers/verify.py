@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Verifying the archived copies.
+
+The policy is set in the [verification] section:
+
+* full: re-read the whole copies and compare their checksum (likely from the page cache)
+* direct: flush the copies to disk and evict them from the page cache, before re-reading them
+* sampled: compare random ranges of the copies with the staging file
+* deferred: queue a (direct) full verification, run during off-peak hours
+
+Each verification is recorded in the database.
+"""
+
+import logging
+import os
+import hashlib
+import random
+from functools import partial
+import asyncio
+from datetime import datetime, time
+from hmac import compare_digest
+
+from . import replica_locations
+from ..utils import exceptions
+from ..utils.db import has_statements
+
+LOG = logging.getLogger(__name__)
+
+CHUNKSIZE = 1024 * 1024
+
+POLICIES = ('full', 'direct', 'sampled', 'deferred')
+
+def drop_cache(f):
+    """Flush the file to disk and evict it from the page cache."""
+    fd = f.fileno()
+    os.fsync(fd)
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+async def checksum(path, offset=0, bypass_cache=False):
+    loop = asyncio.get_running_loop()
+    md = hashlib.sha256()
+    with open(path, 'rb') as f:
+        if bypass_cache:
+            await loop.run_in_executor(None, drop_cache, f)
+        f.seek(offset)
+        while True:
+            # Making it asyncio
+            do_read = partial(f.read, CHUNKSIZE)
+            blob = await loop.run_in_executor(None, do_read) # default thread pool
+            if not blob:
+                break # We were at the end
+            md.update(blob)
+        if bypass_cache: # don't leave it in the cache either
+            await loop.run_in_executor(None, drop_cache, f)
+    return md.hexdigest()
+
+async def checkum_and_compare(path, orgmd, bypass_cache=False):
+    LOG.debug('Reading again file %s', path)
+    c = await checksum(path, bypass_cache=bypass_cache)
+
+    if not compare_digest(c, orgmd): # could use c != orgmd
+        LOG.error('Backup failed: different checksums for the payloads')
+        LOG.error('* md1: %s', c)
+        LOG.error('* md2: %s', orgmd)
+        raise exceptions.ChecksumsNotMatching(path, c, orgmd)
+
+def read_ranges(path, offset, positions, size):
+    md = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for pos in positions:
+            md.update(os.pread(f.fileno(), size, offset + pos))
+    return md.hexdigest()
+
+async def sample_and_compare(path, source_path, source_offset, payload_size, samples, sample_size):
+    LOG.debug('Sampling file %s', path)
+    filesize = os.path.getsize(path)
+    if filesize != payload_size:
+        raise exceptions.ChecksumsNotMatching(path, f'size: {filesize}', f'size: {payload_size}')
+
+    # Random ranges, and always the last one
+    count = (payload_size + sample_size - 1) // sample_size
+    last = max(count - 1, 0)
+    positions = random.sample(range(last), min(samples, last)) + [last]
+    positions = [i * sample_size for i in sorted(positions)]
+
+    loop = asyncio.get_running_loop()
+    c, orgmd = await asyncio.gather(
+        loop.run_in_executor(None, read_ranges, path, 0, positions, sample_size),
+        loop.run_in_executor(None, read_ranges, source_path, source_offset, positions, sample_size)
+    )
+    if not compare_digest(c, orgmd):
+        LOG.error('Backup failed: different samples for the payloads')
+        raise exceptions.ChecksumsNotMatching(path, c, orgmd)
+
+async def execute(config, replica_paths, payload_checksum, staging_path, payload_start, payload_size):
+    """Verify the replicas according to the policy.
+
+    Returns the verification status to record: passed or pending.
+    Raises ChecksumsNotMatching if the verification fails.
+    """
+    policy = config.get('verification', 'policy', fallback='full')
+    LOG.info('Verifying the replicas (%s)', policy)
+
+    if policy == 'full':
+        await asyncio.gather(*(checkum_and_compare(path, payload_checksum) for path in replica_paths))
+        return 'passed'
+
+    if policy == 'direct':
+        await asyncio.gather(*(checkum_and_compare(path, payload_checksum, bypass_cache=True) for path in replica_paths))
+        return 'passed'
+
+    if policy == 'sampled':
+        samples = config.getint('verification', 'samples', fallback=16)
+        sample_size = config.getint('verification', 'sample_size', fallback=65536)
+        await asyncio.gather(*(sample_and_compare(path, staging_path, payload_start, payload_size, samples, sample_size)
+                               for path in replica_paths))
+        return 'passed'
+
+    if policy == 'deferred':
+        return 'pending'
+
+    raise ValueError(f'Invalid verification policy: {policy}')
+
+async def record(config, accession_id, status):
+    if not has_statements(config, 'verification_query'):
+        LOG.debug('Not recording the verification: no verification_query in [db]')
+        return
+    policy = config.get('verification', 'policy', fallback='full')
+    await config.db.fetchval('verification_query', accession_id, policy, status, None)
+
+
+#############################################################################
+# Deferred verifications
+#############################################################################
+
+DEFERRED_STATEMENTS = ('verification_query', 'claim_verifications_query', 'complete_verification_query')
+
+def in_window(window, now=None):
+    """Check if we are in the off-peak window, formatted as HH:MM-HH:MM."""
+    start, end = (time.fromisoformat(t.strip()) for t in window.split('-'))
+    now = now or datetime.now().time()
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end # over midnight
+
+async def run_deferred(config):
+    window = config.get('verification', 'deferred_window', fallback='01:00-05:00')
+    interval = config.getfloat('verification', 'deferred_interval', fallback=300)
+    batch = config.getint('verification', 'deferred_batch', fallback=10)
+    locations = replica_locations(config)
+    LOG.info('Deferred verifications during %s', window)
+
+    while True:
+        try:
+            if in_window(window):
+                rows = await config.db.fetch('claim_verifications_query', batch)
+                for row in rows:
+                    paths = [os.path.join(location, row['relative_path']) for location in locations]
+                    try:
+                        await asyncio.gather(*(checkum_and_compare(path, row['payload_checksum'], bypass_cache=True)
+                                               for path in paths))
+                        status, details = 'passed', None
+                    except Exception as e:
+                        LOG.error('Deferred verification failed for %s: %r', row['stable_id'], e)
+                        status, details = 'failed', repr(e)
+                        await config.mq.lega_publish({ 'error': details, 'accession_id': row['stable_id'] }, 'system.error')
+                    await config.db.fetchval('complete_verification_query', row['id'], status, details)
+                if rows:
+                    continue # there might be more
+        except Exception as e:
+            LOG.error('Deferred verifications error: %r', e)
+        await asyncio.sleep(interval)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Pre-forking supervisor.
+
+With [supervisor] workers = N, the parent process loads the configuration
+and unlocks the service key once, and then forks N worker processes,
+each with its own event loop, and broker and database connections.
+The workers inherit the unlocked key and the resolved [db] and [broker] connections
+(a secret:// value can only be read once anyway).
+
+The parent restarts the workers that exit, forwards SIGTERM to them (so they drain),
+and reports their aggregated health over HTTP, on [supervisor] health_port.
+Each worker serves its own metrics on [metrics] port + 1 + its index,
+and uses its own outbox file.
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+LOG = logging.getLogger(__name__)
+
+class Supervisor():
+
+    __slots__ = (
+        'config',
+        'count',
+        'target',
+        'workers',
+        'restarts',
+        'stopping',
+        'min_uptime',
+    )
+
+    def __init__(self, config, count, target):
+        self.config = config
+        self.count = count
+        self.target = target # target(config) runs a worker
+        self.workers = {} # pid -> (index, start time)
+        self.restarts = 0
+        self.stopping = False
+        self.min_uptime = config.getfloat('supervisor', 'min_uptime', fallback=10)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {len(self.workers)}/{self.count} workers>'
+
+    def prepare(self):
+        """Load, once, what the workers inherit."""
+        LOG.info('Unlocking the service key')
+        self.config.service_key.private()
+        self.config.master_pubkey # the public key bytes
+        # Each worker (and each restarted one) connects again: resolve the connections here
+        for section in ('db', 'broker'):
+            value = self.config.getsensitive(section, 'connection', raw=True, fallback=None)
+            if value is None:
+                continue
+            if isinstance(value, bytes):  # secret to str
+                value = value.decode()
+            self.config.set(section, 'connection', f'value://{value}')
+
+    def worker_config(self, index):
+        """Adjust the configuration of the worker at that index (in the child)."""
+        config = self.config
+        port = config.getint('metrics', 'port', fallback=None)
+        if port:
+            config.set('metrics', 'port', str(port + 1 + index))
+        outbox = config.outbox # its own file, kept across restarts
+        if outbox.enabled:
+            outbox.path = outbox.path.with_name(f'{outbox.path.stem}.{index}{outbox.path.suffix}')
+        return config
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0: # child
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                LOG.info('Worker %d started (pid %d)', index, os.getpid())
+                self.target(self.worker_config(index))
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException as e:
+                LOG.error('Worker %d error: %r', index, e, exc_info=True)
+            finally:
+                os._exit(code)
+        self.workers[pid] = (index, time.monotonic())
+
+    def stop(self, signum, frame):
+        LOG.warning('Stopping the workers')
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def health(self):
+        alive = len(self.workers)
+        return {
+            'status': 'ok' if alive == self.count and not self.stopping else 'degraded',
+            'workers': self.count,
+            'alive': alive,
+            'restarts': self.restarts,
+            'pids': sorted(self.workers),
+        }
+
+    def serve_health(self):
+        port = self.config.getint('supervisor', 'health_port', fallback=None)
+        if not port:
+            return
+        host = self.config.get('supervisor', 'health_host', fallback='0.0.0.0')
+        supervisor = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                health = supervisor.health()
+                body = json.dumps(health).encode()
+                self.send_response(200 if health['status'] == 'ok' else 503)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): # quiet
+                pass
+
+        server = ThreadingHTTPServer((host, port), HealthHandler)
+        LOG.info('Serving the health of the workers on %s:%d', host, port)
+        threading.Thread(target=server.serve_forever, daemon=True, name='health').start()
+
+    def run(self):
+        self.prepare()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for index in range(self.count):
+            self.spawn(index)
+        self.serve_health() # after the first fork: the workers don't get the thread
+
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.workers.pop(pid, (None, None))
+            if index is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                LOG.info('Worker %d (pid %d) exited with %d', index, pid, code)
+                continue
+            LOG.error('Worker %d (pid %d) exited with %d: restarting it', index, pid, code)
+            self.restarts += 1
+            if time.monotonic() - started < self.min_uptime: # don't spin on a crash loop
+                time.sleep(self.min_uptime)
+            if not self.stopping:
+                self.spawn(index)
+
+        LOG.info('All workers exited')
+
+
+def run(config, count, target):
+    Supervisor(config, count, target).run()
@@ -6,17 +6,21 @@ from socket import gethostname
 from pwd import getpwuid
 import os
 import ssl
+import time
+import random
 
 import aiormq
 import pamqp
 from yarl import URL
 
+from . import metrics
+
 CONNECTION_EXCEPTIONS = (
     RuntimeError,
     ConnectionError,
     OSError,
     aiormq.exceptions.AMQPError,
-    asyncio.CancelledError,
+    # not asyncio.CancelledError: a job cancelled while publishing is requeued
     pamqp.exceptions.PAMQPException
 ) + tuple(
     pamqp.exceptions.CLASS_MAPPING.values(),
@@ -30,6 +34,12 @@ class MQConnection():
     __slots__ = (
         'connection',
         'consumer',
+        'channels',
+        'subscriptions',
+        'consumer_tags',
+        'closing',
+        'supervised',
+        'ready',
         'publisher',
         'lock',
         'conf',
@@ -42,6 +52,12 @@ class MQConnection():
     def __init__(self, conf, conf_section='broker'):
         self.connection = None
         self.consumer = None # aiormq.Channel
+        self.channels = [] # consuming channels (the consumer channel first)
+        self.subscriptions = [] # to consume again after a reconnection
+        self.consumer_tags = [] # (channel, consumer tag)
+        self.closing = False
+        self.supervised = False
+        self.ready = asyncio.Event()
         self.publisher = None # aiormq.Channel
         self.lock = asyncio.Lock()
         self.conf = conf
@@ -112,9 +128,18 @@ class MQConnection():
             await self.connection.connect(self.connection_properties)
             LOG.debug('Creating the consumer and publisher channels')
             self.consumer = await self.connection.channel()
-            self.publisher = await self.connection.channel()
+            self.channels = []
+            self.consumer_tags = []
+            # Publisher confirms: we know when the broker has taken responsibility for a message
+            self.publisher = await self.connection.channel(publisher_confirms=True)
+            self.ready.set()
+
+    async def consume(self, on_message, queue=None, prefetch_count=None, declare=False):
+        """Consume from the queue (by default, the [broker] queue).
 
-    async def consume(self, on_message):
+        The first consumer uses the consumer channel, the other ones get their own channel,
+        so they each have their own QoS.
+        """
         if self.consumer is None:
             await self.connect()
         if self.consumer.is_closed:
@@ -123,70 +148,217 @@ class MQConnection():
             self.consumer = None
             await self.connect()
 
-        LOG.debug('QOS to 1')
-        await self.consumer.basic_qos(prefetch_count=1)
-        queue = self.conf.get(self.conf_section, 'queue')
-        LOG.debug('Start consuming from %s', queue)
+        # The messages are processed concurrently, and acked (or nacked) individually,
+        # possibly out of order
+        if prefetch_count is None:
+            prefetch_count = self.conf.getint(self.conf_section, 'prefetch_count', fallback=1)
+        queue = queue or self.conf.get(self.conf_section, 'queue')
         assert queue, "No queue specified"
-        return await self.consumer.basic_consume(queue, on_message)
+        subscription = (on_message, queue, prefetch_count, declare)
+        self.subscriptions.append(subscription)
+        return await self._subscribe(*subscription)
 
-    async def publish(self, message, exchange, routing_key, correlation_id=None, timeout=None):
-        LOG.debug("Publishing to exchange: %s [routing key: %s]", exchange, routing_key)
+    async def _subscribe(self, on_message, queue, prefetch_count, declare):
+        channel = self.consumer
+        if self.channels: # already consuming on the consumer channel
+            channel = await self.connection.channel()
+        self.channels.append(channel)
+
+        LOG.debug('QOS to %d for %s', prefetch_count, queue)
+        await channel.basic_qos(prefetch_count=prefetch_count)
+        if declare:
+            await channel.queue_declare(queue, durable=True)
+        LOG.debug('Start consuming from %s', queue)
+        consume_ok = await channel.basic_consume(queue, on_message)
+        self.consumer_tags.append((channel, consume_ok.consumer_tag))
+        return consume_ok
+
+    async def stop_consuming(self):
+        """Cancel the consumers: no new messages are delivered."""
+        self.closing = True # and don't reconnect
+        for channel, consumer_tag in self.consumer_tags:
+            LOG.debug('Cancelling consumer %s', consumer_tag)
+            try:
+                await channel.basic_cancel(consumer_tag)
+            except Exception as e:
+                LOG.warning('Could not cancel consumer %s: %r', consumer_tag, e)
+        self.consumer_tags = []
+
+    async def close(self):
+        self.closing = True
+        if self.connection is not None:
+            LOG.info('Closing the broker connection')
+            await asyncio.gather(self.connection.close(), return_exceptions=True)
+
+    def is_healthy(self):
+        return (self.connection is not None and not self.connection.is_closed
+                and self.publisher is not None and not self.publisher.is_closed
+                and all(not channel.is_closed for channel in self.channels))
+
+    async def reconnect(self):
+        """Reconnect, and consume again from the same queues, with the same QoS."""
+        if self.connection is not None:
+            await asyncio.gather(self.connection.close(), return_exceptions=True)
+        await self.connect()
+        for subscription in self.subscriptions:
+            await self._subscribe(*subscription)
+
+    async def supervise(self):
+        """Watch the connection and its channels, and reconnect when they are lost.
+
+        The reconnection attempts are spaced with an exponential backoff (with jitter).
+        Meanwhile, the publishers wait for the connection to be back.
+        """
+        interval = self.conf.getfloat(self.conf_section, 'watch_interval', fallback=1)
+        backoff_min = self.conf.getfloat(self.conf_section, 'reconnect_backoff_min', fallback=0.5)
+        backoff_max = self.conf.getfloat(self.conf_section, 'reconnect_backoff_max', fallback=30)
+        self.supervised = True
+        metrics.gauge('fega_broker_connected', 1)
+
+        while not self.closing:
+            await asyncio.sleep(interval)
+            if self.closing or self.is_healthy():
+                continue
+
+            LOG.warning('Lost the connection to the broker')
+            self.ready.clear()
+            metrics.gauge('fega_broker_connected', 0)
+            down_since = time.monotonic()
+            delay = backoff_min
+            while not self.closing:
+                metrics.inc('fega_broker_reconnect_attempts_total')
+                try:
+                    await self.reconnect()
+                    break
+                except Exception as e:
+                    LOG.error('Reconnection to the broker failed: %r (retrying in about %.1f seconds)', e, delay)
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, backoff_max)
+
+            downtime = time.monotonic() - down_since
+            LOG.info('Reconnected to the broker after %.1f seconds', downtime)
+            metrics.inc('fega_broker_reconnects_total')
+            metrics.observe('fega_broker_downtime_seconds', downtime)
+            metrics.gauge('fega_broker_connected', 1)
+
+    async def forward(self, message, queue):
+        """Publish the (raw) message as-is to that queue, and return True if the broker confirmed it."""
         try:
-            if self.publisher is None:
-                LOG.debug("First connecting")
-                await self.connect()
-            if self.publisher.is_closed:
-                LOG.debug("Publisher Channel closed: reconnecting")
-                await asyncio.gather(self.connection.close(), return_exceptions=False)
-                self.publisher = None
-                await self.connect()
-
-            if self.publisher is None:
-                return False
-
-            properties = {
-                'delivery_mode': 2,
-                'content_type': 'text/plain',
-            }
-            if correlation_id:
-                properties['correlation_id'] = correlation_id
-
-            _message = message
-            if not (isinstance(_message, str) or isinstance(_message, bytes)):
-                _message = json.dumps(_message, indent=4)
-                properties['content_type']='application/json'
-
-            if not isinstance(message, bytes):
-                _message = _message.encode()
-
-            await self.publisher.basic_publish(_message,
-                                               exchange=exchange,
-                                               routing_key=routing_key,
-                                               properties=aiormq.spec.Basic.Properties(**properties)
-                                               )
-            return True
+            await self._ensure_publisher()
+            confirmation = await self.publisher.basic_publish(message.body,
+                                                              exchange='', # default exchange: routing to the queue name
+                                                              routing_key=queue,
+                                                              properties=message.header.properties)
+            return isinstance(confirmation, aiormq.spec.Basic.Ack)
+        except Exception as e:
+            LOG.error('Message not forwarded to %s: %r', queue, e)
+            return False
+
+    async def _ensure_publisher(self):
+        if self.supervised:
+            # The supervisor reconnects: wait for it
+            timeout = self.conf.getfloat(self.conf_section, 'confirm_timeout', fallback=30)
+            await asyncio.wait_for(self.ready.wait(), timeout=timeout)
+            return
+        if self.publisher is None:
+            LOG.debug("First connecting")
+            await self.connect()
+        if self.publisher.is_closed:
+            LOG.debug("Publisher Channel closed: reconnecting")
+            await asyncio.gather(self.connection.close(), return_exceptions=False)
+            self.publisher = None
+            await self.connect()
+
+    @staticmethod
+    def _prepare(message, correlation_id=None):
+        properties = {
+            'delivery_mode': 2,
+            'content_type': 'text/plain',
+        }
+        if correlation_id:
+            properties['correlation_id'] = correlation_id
+
+        _message = message
+        if not (isinstance(_message, str) or isinstance(_message, bytes)):
+            _message = json.dumps(_message, separators=(',', ':')) # compact
+            properties['content_type']='application/json'
+
+        if not isinstance(_message, bytes):
+            _message = _message.encode()
+
+        return _message, aiormq.spec.Basic.Properties(**properties)
+
+    async def _publish_confirmed(self, message, exchange, routing_key, correlation_id=None, timeout=None):
+        body, properties = self._prepare(message, correlation_id=correlation_id)
+        try:
+            # The publisher channel is in confirm mode: this waits for the broker ack (or nack)
+            confirmation = await self.publisher.basic_publish(body,
+                                                              exchange=exchange,
+                                                              routing_key=routing_key,
+                                                              properties=properties,
+                                                              timeout=timeout)
+        except (aiormq.exceptions.DeliveryError, asyncio.TimeoutError) as e:
+            LOG.error('Message to %s [routing key: %s] not confirmed: %r', exchange, routing_key, e)
+            return False
+        if not isinstance(confirmation, aiormq.spec.Basic.Ack):
+            LOG.error('Message to %s [routing key: %s] nacked by the broker', exchange, routing_key)
+            return False
+        return True
+
+    async def publish_many(self, messages, exchange, timeout=None):
+        """Publish the (message, routing_key, correlation_id) triplets.
+
+        Many publishes are outstanding at once, and their confirms are awaited in batches
+        (of ``confirm_batch`` messages).
+        Returns a list of booleans: True if that message was confirmed by the broker.
+        """
+        messages = list(messages)
+        results = [False] * len(messages)
+        if not messages:
+            return results
+        batch = self.conf.getint(self.conf_section, 'confirm_batch', fallback=256)
+        if timeout is None:
+            timeout = self.conf.getfloat(self.conf_section, 'confirm_timeout', fallback=30)
+        LOG.debug("Publishing %d messages to exchange: %s", len(messages), exchange)
+        try:
+            await self._ensure_publisher()
+            for start in range(0, len(messages), batch):
+                chunk = messages[start:start+batch]
+                confirmed = await asyncio.gather(*(self._publish_confirmed(message, exchange, routing_key,
+                                                                           correlation_id=correlation_id,
+                                                                           timeout=timeout)
+                                                   for message, routing_key, correlation_id in chunk))
+                results[start:start+len(chunk)] = confirmed
+            return results
         except aiormq.exceptions.ProbableAuthenticationError as e:
             LOG.error('Authentication Error: %s', e)
-            return False
+            return results
         except CONNECTION_EXCEPTIONS as e:
             LOG.warning('Connection attempt to "%s" failed. ', self)
             LOG.error('%r', e)
-            # Cleanup
-            await asyncio.gather(self.connection.close(e), return_exceptions=False)
-            del self.publisher
+            # Cleanup (unless the supervisor takes care of it)
+            if self.connection is not None and not self.supervised:
+                await asyncio.gather(self.connection.close(e), return_exceptions=True)
             self.publisher = None # Channel will be close
-            return False
+            return results
         except Exception as e:
-            LOG.error("Message not sent: %r", e)
-            return False
+            LOG.error("Messages not sent: %r", e)
+            return results
+
+    async def publish(self, message, exchange, routing_key, correlation_id=None, timeout=None):
+        """Publish one message and return True if the broker confirmed it."""
+        LOG.debug("Publishing to exchange: %s [routing key: %s]", exchange, routing_key)
+        results = await self.publish_many([(message, routing_key, correlation_id)], exchange, timeout=timeout)
+        return results[0]
 
     async def lega_publish(self, message, routing_key, **kwargs):
         exchange = self.conf.get(self.conf_section, 'lega_exchange')
-        await self.publish(message, exchange, routing_key, **kwargs)
+        return await self.publish(message, exchange, routing_key, **kwargs)
 
-    async def cega_publish(self, message, routing_key, **kwargs):
+    async def cega_publish(self, message, routing_key, correlation_id=None, **kwargs):
         exchange = self.conf.get(self.conf_section, 'cega_exchange')
-        await self.publish(message, exchange, routing_key, **kwargs)
-
-
+        if self.conf.outbox.enabled:
+            # Stored durably: the outbox relay sends it, whenever the broker is reachable
+            await self.conf.outbox.append(exchange, routing_key, message, correlation_id=correlation_id)
+            return True
+        return await self.publish(message, exchange, routing_key, correlation_id=correlation_id, **kwargs)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Micro-batching of the metadata messages.
+
+The metadata messages (dataset, user and dac updates) arriving within a short window
+(or up to max_items of them) are sent together to the database, in one round trip,
+as a jsonb array (see public.process_message_batch, dispatching on the message type).
+They are processed in arrival order, in one transaction, each message in its own savepoint.
+The batches are sent one at a time, in order, so the messages stay ordered across batches.
+
+Each message still gets its own result (or error), so the acks and nacks stay per message.
+A deadlock or a serialization failure rolls back the whole batch, which is then retried
+(the messages are requeued if it still fails).
+
+The batch goes through the [db] on_batch statement only: process_message_batch calls
+the public.process_*_message functions itself, and the on_* statements of [db] are not used.
+Disable the batching to use other statements.
+"""
+
+import logging
+import asyncio
+import json
+
+import asyncpg
+
+from .exceptions import FEGASystemError, TransientError
+from .db import has_statements
+
+LOG = logging.getLogger(__name__)
+
+class MessageBatcher():
+
+    __slots__ = (
+        'conf',
+        'conf_section',
+        'enabled',
+        'max_items',
+        'window',
+        'pending',
+        'timer',
+        'tasks',
+        'lock',
+        'retries',
+        'retry_delay',
+    )
+
+    def __init__(self, conf, conf_section='batching'):
+        self.conf = conf
+        self.conf_section = conf_section
+        self.enabled = conf.getboolean(conf_section, 'enabled', fallback=False)
+        if self.enabled and not has_statements(conf, 'on_batch'):
+            LOG.warning('Batching disabled: no on_batch in [db]')
+            self.enabled = False
+        self.max_items = conf.getint(conf_section, 'max_items', fallback=100)
+        self.window = conf.getfloat(conf_section, 'window', fallback=0.05) # in seconds
+        self.retries = conf.getint(conf_section, 'retries', fallback=3)
+        self.retry_delay = conf.getfloat(conf_section, 'retry_delay', fallback=0.1) # in seconds, doubled each time
+        self.pending = [] # (json-str, future)
+        self.timer = None
+        self.tasks = set()
+        self.lock = asyncio.Lock() # one batch at a time (and a Lock wakes up its waiters in order)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: up to {self.max_items} messages every {self.window}s>'
+
+    async def fetchval(self, stmt, message):
+        """Process the message with the stmt query, or in the next batch."""
+        if not self.enabled:
+            try:
+                return await self.conf.db.fetchval(stmt, message.content)
+            except asyncpg.TransactionRollbackError as e: # deadlock or serialization failure
+                raise TransientError(repr(e)) from e
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((message.content, future)) # the already formatted data, as json-str
+        if len(self.pending) >= self.max_items:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self.send(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    @staticmethod
+    def fail(batch, error):
+        LOG.error('Batch error: %r', error)
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    async def send(self, batch):
+        payload = '[' + ','.join(content for content, _ in batch) + ']'
+        async with self.lock:
+            LOG.debug('Sending a batch of %d messages', len(batch))
+            attempt = 0
+            while True:
+                try:
+                    results = json.loads(await self.conf.db.fetchval('on_batch', payload))
+                    break
+                except asyncpg.TransactionRollbackError as e: # deadlock or serialization failure
+                    if attempt < self.retries:
+                        delay = self.retry_delay * 2**attempt
+                        attempt += 1
+                        LOG.warning('Batch rolled back (%r): retrying in %.2f seconds', e, delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    error = TransientError(repr(e))
+                except Exception as e:
+                    error = e
+                return self.fail(batch, error)
+
+        if not isinstance(results, list) or len(results) != len(batch): # or some messages would wait forever
+            return self.fail(batch, FEGASystemError(f'Unexpected batch results: {len(batch)} messages sent'))
+
+        for (_, future), result in zip(batch, results):
+            if future.done(): # cancelled
+                continue
+            if 'error' in result:
+                future.set_exception(FEGASystemError(result['error']))
+            else:
+                future.set_result(result.get('response'))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""A simple Bloom filter, for items that are already uniformly distributed (like checksums)."""
+
+import math
+
+class BloomFilter():
+    """Bloom filter over bytes items.
+
+    It never returns false negatives: if ``item in filter`` is False, the item was never added.
+    It returns false positives with a probability close to ``error_rate``,
+    as long as there are less than ``capacity`` items.
+    """
+
+    __slots__ = ('size', 'hashes', 'bits', 'count')
+
+    def __init__(self, capacity, error_rate=0.001):
+        assert capacity > 0 and 0 < error_rate < 1, "Invalid Bloom filter parameters"
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))) # in bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {self.count} items, {self.size} bits, {self.hashes} hashes>'
+
+    def _positions(self, item):
+        # Double hashing (Kirsch-Mitzenmacher), from the first 16 bytes of the item.
+        # The items are expected to be hashes already.
+        h1 = int.from_bytes(item[:8], 'little')
+        h2 = int.from_bytes(item[8:16], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
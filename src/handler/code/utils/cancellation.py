@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""Registry of cancelled ingestions.
+
+A cancel message leaves a tombstone, keyed by (user, filepath, correlation id).
+An ingestion checks for its tombstone when it starts, and regularly while it copies the file.
+
+The tombstones live on the staging file system, which is shared by all the handler instances.
+They are removed after a while (see ``[staging] tombstones_ttl``).
+"""
+
+import logging
+import os
+import time
+import hashlib
+from pathlib import Path
+
+LOG = logging.getLogger(__name__)
+
+_last_prune = 0
+
+def location(config):
+    path = config.get('staging', 'tombstones', fallback=None)
+    if path:
+        return Path(path)
+    staging_prefix = config.get('staging', 'location', raw=True)
+    return Path(staging_prefix % '') / '.tombstones'
+
+def tombstone(config, user, filepath, correlation_id):
+    key = '\0'.join((user, filepath.strip('/'), correlation_id or ''))
+    return location(config) / hashlib.sha256(key.encode()).hexdigest()
+
+def cancel(config, user, filepath, correlation_id):
+    path = tombstone(config, user, filepath, correlation_id)
+    LOG.info('Tombstone for %s: %s', filepath, path.name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    prune(config)
+
+def is_cancelled(config, user, filepath, correlation_id):
+    return tombstone(config, user, filepath, correlation_id).exists()
+
+def prune(config):
+    """Remove the old tombstones (at most once an hour)."""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < 3600:
+        return
+    _last_prune = now
+    ttl = config.getint('staging', 'tombstones_ttl', fallback=7*24*3600)
+    try:
+        with os.scandir(location(config)) as entries:
+            for entry in entries:
+                if entry.stat().st_mtime < now - ttl:
+                    LOG.debug('Removing old tombstone %s', entry.name)
+                    os.unlink(entry.path)
+    except Exception as e:
+        LOG.warning('Ignoring tombstone pruning error: %r', e)
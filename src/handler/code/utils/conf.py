@@ -23,7 +23,7 @@ from logging.config import fileConfig, dictConfig
 from pathlib import Path
 import json
 
-from . import amqp, db, key
+from . import amqp, db, key, decrypt, scheduler, session_keys, outbox, batching, idempotency
 
 LOG = logging.getLogger(__name__)
 
@@ -114,6 +114,12 @@ class Configuration(configparser.RawConfigParser):
                  '_db',
                  '_service_key',
                  '_master_pubkey',
+                 '_decryptor',
+                 '_scheduler',
+                 '_session_keys',
+                 '_outbox',
+                 '_batcher',
+                 '_idempotency',
                  )
 
     def __init__(self, conf_file):
@@ -123,6 +129,12 @@ class Configuration(configparser.RawConfigParser):
         self._db = None
         self._service_key = None
         self._master_pubkey = None
+        self._decryptor = None
+        self._scheduler = None
+        self._session_keys = None
+        self._outbox = None
+        self._batcher = None
+        self._idempotency = None
         # Load the configuration settings
         super().__init__(self,
                          delimiters=('=', ':'),
@@ -212,6 +224,42 @@ class Configuration(configparser.RawConfigParser):
             self._db = db.DBConnection(self, conf_section='db')
         return self._db
 
+    @property
+    def decryptor(self):
+        if self._decryptor is None:
+            self._decryptor = decrypt.DecryptionEngine(self, conf_section='ingest')
+        return self._decryptor
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            self._scheduler = scheduler.JobScheduler(self, conf_section='jobs')
+        return self._scheduler
+
+    @property
+    def session_keys(self):
+        if self._session_keys is None:
+            self._session_keys = session_keys.SessionKeyRegistry(self, conf_section='session_keys')
+        return self._session_keys
+
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = outbox.Outbox(self, conf_section='outbox')
+        return self._outbox
+
+    @property
+    def batcher(self):
+        if self._batcher is None:
+            self._batcher = batching.MessageBatcher(self, conf_section='batching')
+        return self._batcher
+
+    @property
+    def idempotency(self):
+        if self._idempotency is None:
+            self._idempotency = idempotency.IdempotencyCache(self, conf_section='idempotency')
+        return self._idempotency
+
 
     # Loading the key from its storage (be it from file, or from a remote location)
     # the key_config section in the config file should describe how
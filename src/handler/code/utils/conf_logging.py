@@ -2,21 +2,30 @@
 """Handling correlation id across all logs."""
 
 from logging import Logger
+from contextvars import ContextVar
 
 class _wrapper():
-    """Wrapper class for the correlation id."""
+    """Wrapper class for the correlation id.
 
-    value = None
+    Each asyncio task has its own value, since messages are processed concurrently.
+    """
+
+    def __init__(self):
+        self.value = ContextVar('correlation_id', default=None)
 
     def get(self):
-        return self.value
+        return self.value.get()
 
     def set(self, v):
-        self.value = v
+        self.value.set(v)
 
 
 _cid = _wrapper()
 
+def set_correlation_id(v):
+    """Inject the correlation id in the log records of the current task."""
+    _cid.set(v)
+
 
 class LEGALogger(Logger):
     """Logger with a correlation id injected in the log records.
@@ -6,27 +6,84 @@ from socket import gethostname
 from pwd import getpwuid
 import os
 import ssl
+import re
+from functools import partial
+import time
+from contextlib import asynccontextmanager
 
 import asyncpg
 import pamqp
 from yarl import URL
 
+from . import metrics
+
 LOG = logging.getLogger(__name__)
 
+class Statements():
+    """The SQL statements of the [db] section, resolved once.
+
+    Any setting whose value is an SQL query is a statement, named after its key.
+    """
+
+    __slots__ = (
+        'queries',
+    )
+
+    SQL = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE|CALL)\b', re.IGNORECASE)
+
+    def __init__(self, conf, conf_section='db'):
+        defaults = conf.defaults()
+        self.queries = {name: query
+                        for name, query in conf.items(conf_section, raw=True)
+                        if name not in defaults and self.SQL.match(query)}
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {", ".join(sorted(self.queries))}>'
+
+    def __iter__(self):
+        return iter(self.queries.items())
+
+    def __contains__(self, name):
+        return name in self.queries
+
+    def get(self, name):
+        return self.queries.get(name)
+
+    def discard(self, name):
+        self.queries.pop(name, None)
+
+
+def has_statements(conf, *names, conf_section='db'):
+    """Check if the [db] section has all these statements.
+
+    The optional features are off when their statements are not configured.
+    """
+    statements = Statements(conf, conf_section=conf_section) if conf.has_section(conf_section) else ()
+    return all(name in statements for name in names)
+
+
 class DBConnection():
-    """ Connection abstraction """
+    """ Connection abstraction
+
+    The statements are called by name. Each one is prepared on a pool connection
+    the first time it runs there, and then reused from the asyncpg statement cache
+    of that connection (see statement_cache_size).
+    They are all checked once, when connecting: the invalid ones are logged and skipped.
+    """
 
     __slots__ = (
         'connection',
         'conf',
-        'conf_section'
+        'conf_section',
+        'statements',
     )
 
     def __init__(self, conf, conf_section='db'):
         self.connection = None
         self.conf = conf
         self.conf_section = conf_section
-        
+        self.statements = None
+
     def __str__(self):
         return str(self.connection) if self.connection else self.__class__.__name__
 
@@ -41,103 +98,110 @@ class DBConnection():
         if isinstance(dsn, bytes):  # secret to str
             dsn = dsn.decode()
 
-        LOG.debug('Creating the DB connection pool')
-        self.connection = await asyncpg.create_pool(dsn)
+        self.statements = Statements(self.conf, conf_section=self.conf_section)
+        LOG.debug('DB statements: %r', self.statements)
+
+        # Pool sizing and timeouts
+        getint = partial(self.conf.getint, self.conf_section, fallback=None)
+        getfloat = partial(self.conf.getfloat, self.conf_section, fallback=None)
+        server_settings = {}
+        statement_timeout = getint('statement_timeout') # in ms, enforced by Postgres
+        if statement_timeout is not None:
+            server_settings['statement_timeout'] = str(statement_timeout)
+        idle_timeout = getint('idle_in_transaction_session_timeout') # in ms
+        if idle_timeout is not None:
+            server_settings['idle_in_transaction_session_timeout'] = str(idle_timeout)
+        options = {
+            'min_size': getint('pool_min_size'),
+            'max_size': getint('pool_max_size'),
+            'max_queries': getint('pool_max_queries'),
+            'max_inactive_connection_lifetime': getfloat('pool_max_inactive_lifetime'),
+            'command_timeout': getfloat('command_timeout'), # in seconds, enforced by asyncpg
+            'timeout': getfloat('connect_timeout'),
+            'statement_cache_size': getint('statement_cache_size'), # per connection (asyncpg defaults to 100)
+        }
+        options = {k: v for k, v in options.items() if v is not None}
+        if server_settings:
+            options['server_settings'] = server_settings
+
+        LOG.debug('Creating the DB connection pool: %s', options)
+        self.connection = await asyncpg.create_pool(dsn, **options)
+        metrics.gauge('fega_db_pool_max_size', self.connection.get_max_size())
         #LOG.info('Connection to %s', self.connection.url.with_password('****'))
         await self.connection.execute('SELECT 1') # ping
-
-    async def dataset_mapping(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'dataset_mapping', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
+        await self._check(self.connection)
+
+    async def _check(self, pool):
+        """Prepare each statement once, and skip the ones the database rejects (eg a missing function)."""
+        async with pool.acquire() as conn:
+            for name, query in list(self.statements):
+                try:
+                    await conn.prepare(query)
+                except asyncpg.PostgresError as e:
+                    LOG.error('Skipping the %s statement: %r', name, e)
+                    self.statements.discard(name)
+
+    async def pool(self):
         if not self.connection:
             await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
-
-    async def dataset_release(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'dataset_release', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
-
-    async def dataset_deprecated(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'dataset_deprecated', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
-
-    async def dataset_permission(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'dataset_permission', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
-
-    async def dataset_delete_permission(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'dataset_delete_permission', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
-
-    async def save_dac(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'dac_query', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
+        return self.connection
+
+    def _pool_usage(self, pool):
+        size = pool.get_size()
+        metrics.gauge('fega_db_pool_size', size)
+        metrics.gauge('fega_db_pool_connections_in_use', size - pool.get_idle_size())
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Acquire a pool connection, recording how long we waited for it."""
+        pool = await self.pool()
+        timeout = self.conf.getfloat(self.conf_section, 'pool_acquire_timeout', fallback=None)
+        start = time.monotonic()
+        try:
+            async with pool.acquire(timeout=timeout) as conn:
+                metrics.observe('fega_db_pool_acquire_seconds', time.monotonic() - start)
+                self._pool_usage(pool)
+                yield conn
+        finally:
+            self._pool_usage(pool) # once released
+
+    @asynccontextmanager
+    async def statement(self, stmt):
+        """Acquire a pool connection, and yield it with the query of that statement."""
+        async with self.acquire() as conn: # connecting first, if needed
+            query = self.statements.get(stmt)
+            if query is None:
+                raise Exception(f'Invalid Vault DB configuration: no {stmt} statement')
+            yield conn, query
 
     async def save_file(self, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, 'save_query', raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
+        return await self.fetchval('save_query', *args, **kwargs)
 
     async def fetchval(self, stmt, *args, **kwargs):
-
-        query = self.conf.get(self.conf_section, stmt, raw=True)
-        if not query:
-            raise Exception('Invalid Vault DB configuration')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.fetchval(query, *args, **kwargs)
+        async with self.statement(stmt) as (conn, query):
+            with metrics.timer('fega_db_query_seconds', statement=stmt):
+                return await conn.fetchval(query, *args, **kwargs)
+
+    async def fetch(self, stmt, *args, **kwargs):
+        async with self.statement(stmt) as (conn, query):
+            with metrics.timer('fega_db_query_seconds', statement=stmt):
+                return await conn.fetch(query, *args, **kwargs)
+
+    async def iterate(self, stmt, *args, prefetch=10000):
+        """Stream the rows, using a server-side cursor."""
+        async with self.statement(stmt) as (conn, query):
+            async with conn.transaction(): # cursors need a transaction
+                with metrics.timer('fega_db_query_seconds', statement=stmt):
+                    async for record in conn.cursor(query, *args, prefetch=prefetch):
+                        yield record
+
+    async def close(self):
+        if self.connection is not None:
+            LOG.info('Closing the DB connection pool')
+            await self.connection.close()
+            self.connection = None
 
     async def ping(self):
         LOG.debug('Pinging the DB')
-
-        if not self.connection:
-            await self.connect()
-
-        return await self.connection.execute('SELECT 1')
+        pool = await self.pool()
+        return await pool.execute('SELECT 1')
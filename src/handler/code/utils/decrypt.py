@@ -0,0 +1,98 @@
+import logging
+import os
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from crypt4gh import lib as c4gh
+
+LOG = logging.getLogger(__name__)
+
+def decrypt_segments(ciphersegments, session_keys):
+    """Decrypt a batch of cipher segments.
+
+    It runs in a worker (thread or process) of the pool.
+    The underlying libsodium calls release the GIL.
+    """
+    return [c4gh.decrypt_block(ciphersegment, session_keys) for ciphersegment in ciphersegments]
+
+def update_digest(md, segments):
+    for segment in segments:
+        md.update(segment)
+
+
+class DecryptionEngine():
+    """Decrypting the Crypt4GH segments on multiple cores.
+
+    Each cipher segment is independent: we send batches of them to a pool of workers,
+    and fold the plaintext into the checksum, in segment order.
+    """
+
+    __slots__ = (
+        'conf',
+        'conf_section',
+        'workers',
+        'batch_size',
+        'executor',
+    )
+
+    def __init__(self, conf, conf_section='ingest'):
+        self.conf = conf
+        self.conf_section = conf_section
+        self.workers = conf.getint(conf_section, 'decrypt_workers', fallback=(os.cpu_count() or 1))
+        self.batch_size = conf.getint(conf_section, 'decrypt_batch', fallback=16)
+        self.executor = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {self.workers} workers, batches of {self.batch_size} segments>'
+
+    def get_executor(self):
+        if self.executor is None:
+            kind = self.conf.get(self.conf_section, 'decrypt_executor', fallback='thread')
+            LOG.debug('Creating a %s pool with %d workers', kind, self.workers)
+            if kind == 'process':
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            elif kind == 'thread':
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='decrypt')
+            else:
+                raise ValueError(f'Invalid decrypt_executor: {kind}')
+        return self.executor
+
+    async def digest(self, queue, session_keys, md):
+        """Consume the cipher segments from the queue and update the checksum with their plaintext.
+
+        An empty segment marks the end of the payload.
+        """
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        pending = deque() # batches being decrypted, in segment order
+        batch = []
+
+        async def fold():
+            segments = await pending.popleft()
+            # hashlib releases the GIL too: don't stall the event loop
+            await loop.run_in_executor(None, update_digest, md, segments)
+
+        try:
+            while True:
+                ciphersegment = await queue.get()
+                if ciphersegment:
+                    assert( len(ciphersegment) > c4gh.CIPHER_DIFF )
+                    batch.append(ciphersegment)
+
+                if batch and (len(batch) >= self.batch_size or not ciphersegment):
+                    pending.append(loop.run_in_executor(executor, decrypt_segments, batch, session_keys))
+                    batch = []
+
+                # Keep all workers busy, but not more
+                while len(pending) > self.workers:
+                    await fold()
+
+                if not ciphersegment:
+                    break # We were at the last segment. Exits the loop
+
+            while pending:
+                await fold()
+        finally:
+            for fut in pending: # in case of errors
+                fut.cancel()
@@ -107,6 +107,16 @@ class AlreadyInProgress(Warning):
         return f'Warning: File already in progress or existing: {self.path}'
 
 
+class IngestionCancelled(Warning):
+    """Raised when an ingestion has been cancelled."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return f'Warning: Ingestion cancelled: {self.path}'
+
+
 class ChecksumsNotMatching(Exception):
     """Raised when 2 checksums don't match."""
 
@@ -121,6 +131,25 @@ class ChecksumsNotMatching(Exception):
     def __repr__(self):
         return f'Checksums for {self.path} do not match:\n* {self.md1}\n* {self.md2}'
 
+class PublishError(Exception):
+    """Raised when the broker did not confirm a message."""
+
+    def __init__(self, routing_key):
+        self.routing_key = routing_key
+
+    def __str__(self):
+        return f'Message not confirmed by the broker [routing key: {self.routing_key}]'
+
+    def __repr__(self):
+        return str(self)
+
+class TransientError(Exception):
+    """Raised on a transient database error (deadlock, serialization failure).
+
+    The message is requeued, instead of rejected.
+    """
+    pass
+
 class RejectMessage(Exception):
     pass
 
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Copying a range of a file, inside the kernel when possible.
+
+We try, in order:
+
+* ``copy_file_range``: the data does not leave the kernel, and some file systems can even clone it (reflinks, server-side copy on NFS 4.2, ...)
+* ``sendfile``: the data does not leave the kernel
+* a buffered copy, through python
+
+If a method is not supported by the source and destination file systems, we fall back to the next one.
+So we do too if it stops short (some file systems report 0 bytes copied instead of an error),
+and we raise if the copy is still incomplete after the last one.
+These functions are blocking: run them in an executor.
+"""
+
+import logging
+import os
+import errno
+
+from .exceptions import FEGASystemError
+
+LOG = logging.getLogger(__name__)
+
+CHUNKSIZE = 1024 * 1024 * 64 # max bytes per system call
+
+# Errors telling us the method is not supported for those file descriptors
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM)
+
+def _copy_file_range(infd, outfd, offset, count):
+    while count > 0:
+        n = os.copy_file_range(infd, outfd, min(count, CHUNKSIZE), offset)
+        if n == 0:
+            break # EOF
+        offset += n
+        count -= n
+
+def _sendfile(infd, outfd, offset, count):
+    while count > 0:
+        n = os.sendfile(outfd, infd, offset, min(count, CHUNKSIZE))
+        if n == 0:
+            break # EOF
+        offset += n
+        count -= n
+
+def _buffered(infd, outfd, offset, count):
+    while count > 0:
+        blob = os.pread(infd, min(count, 1024 * 1024), offset)
+        if not blob:
+            break # EOF
+        view = memoryview(blob)
+        while view:
+            n = os.write(outfd, view)
+            view = view[n:]
+        offset += len(blob)
+        count -= len(blob)
+
+METHODS = {
+    'copy_file_range': _copy_file_range,
+    'sendfile': _sendfile,
+    'buffered': _buffered,
+}
+
+def copy_range(infd, outfd, offset, count, method='auto'):
+    """Copy `count` bytes of `infd`, starting at `offset`, to `outfd` (at its current position).
+
+    Returns the name of the method that completed the copy.
+    Raises FEGASystemError if fewer bytes could be copied (eg the source file is shorter).
+    """
+    if method == 'auto':
+        methods = list(METHODS)
+    elif method in METHODS:
+        methods = [method]
+    else:
+        raise ValueError(f'Invalid copy method: {method}')
+
+    start = os.lseek(outfd, 0, os.SEEK_CUR)
+    for name in methods:
+        # in case the previous method failed or stopped half-way
+        done = os.lseek(outfd, 0, os.SEEK_CUR) - start
+        try:
+            METHODS[name](infd, outfd, offset + done, count - done)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or name == methods[-1]:
+                raise
+            LOG.debug('%s not supported (%s): falling back', name, errno.errorcode.get(e.errno, e.errno))
+            continue
+        done = os.lseek(outfd, 0, os.SEEK_CUR) - start
+        if done == count:
+            return name
+        LOG.warning('%s stopped after %d of %d bytes', name, done, count)
+
+    raise FEGASystemError(f'Incomplete copy: {done} of {count} bytes')
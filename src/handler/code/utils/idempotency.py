@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Skipping the redelivered messages.
+
+A message is identified by its correlation id, its job type and the digest of its payload.
+When a job completes, its result (the message it emitted) is recorded in the database,
+which is the source of truth, and in an in-memory LRU cache in front of it.
+A duplicate is then acked right away, and its original result is re-emitted.
+
+Only completed jobs are recorded, ie the ones returning the message they emitted.
+A job that failed, or returned nothing (eg skipped because already in progress, or cancelled)
+is processed again when redelivered.
+"""
+
+import logging
+import hashlib
+import json
+from collections import OrderedDict
+
+from .db import has_statements
+from .exceptions import TransientError
+
+LOG = logging.getLogger(__name__)
+
+STATEMENTS = ('processed_message_query', 'record_processed_message_query')
+
+class IdempotencyCache():
+
+    __slots__ = (
+        'conf',
+        'conf_section',
+        'job_types',
+        'capacity',
+        'lru',
+    )
+
+    def __init__(self, conf, conf_section='idempotency'):
+        self.conf = conf
+        self.conf_section = conf_section
+        job_types = conf.get(conf_section, 'job_types', fallback='ingest, accession')
+        self.job_types = set(t.strip() for t in job_types.split(',') if t.strip())
+        if self.job_types and not has_statements(conf, *STATEMENTS):
+            LOG.warning('Idempotency cache disabled: no %s in [db]', ', '.join(STATEMENTS))
+            self.job_types = set()
+        self.capacity = conf.getint(conf_section, 'capacity', fallback=10000)
+        self.lru = OrderedDict() # key -> result
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {len(self.lru)}/{self.capacity} for {", ".join(sorted(self.job_types))}>'
+
+    def applies(self, job_type):
+        return job_type in self.job_types or '*' in self.job_types
+
+    @staticmethod
+    def key(correlation_id, job_type, body):
+        md = hashlib.sha256()
+        md.update((correlation_id or '').encode())
+        md.update(b'\0')
+        md.update(job_type.encode())
+        md.update(b'\0')
+        md.update(hashlib.sha256(body).digest())
+        return md.hexdigest()
+
+    @staticmethod
+    def completed(result):
+        return isinstance(result, dict) and bool(result.get('routing_key'))
+
+    def _remember(self, key, result):
+        self.lru[key] = result
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    async def lookup(self, key):
+        """Return the recorded result, or None if not completed yet."""
+        result = self.lru.get(key)
+        if result is not None:
+            self.lru.move_to_end(key)
+            return result
+        try:
+            response = await self.conf.db.fetchval('processed_message_query', key)
+        except Exception as e: # don't reject the message: try again later
+            raise TransientError(f'Idempotency lookup failed: {e!r}') from e
+        if response is None:
+            return None
+        result = json.loads(response)
+        if not self.completed(result): # not a final result
+            return None
+        self._remember(key, result)
+        return result
+
+    async def record(self, key, job_type, correlation_id, result):
+        """Record the result of a completed job. Return False if it was not recorded.
+
+        The job is done (and its message emitted) by then: a failure is only logged,
+        and the message would only be processed again if redelivered to another process.
+        """
+        if not self.completed(result):
+            LOG.debug('Not recording the %s job: not completed', job_type)
+            return False
+        self._remember(key, result)
+        try:
+            await self.conf.db.fetchval('record_processed_message_query', key, job_type, correlation_id, json.dumps(result))
+        except Exception as e:
+            LOG.error('Could not record the %s job: %r', job_type, e)
+            return False
+        return True
+
+    async def replay(self, result, correlation_id):
+        """Re-emit the message emitted the first time."""
+        routing_key = result.get('routing_key')
+        if not routing_key:
+            return
+        LOG.info('Re-emitting the original %s message', routing_key)
+        await self.conf.mq.cega_publish(result['message'], routing_key, correlation_id=correlation_id)
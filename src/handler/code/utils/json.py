@@ -1,8 +1,12 @@
 import logging
 
-from json import loads as parse_json
+try:
+    from orjson import loads as parse_json # faster, if available
+except ImportError:
+    from json import loads as parse_json
 
 from .exceptions import FEGASystemError
+from . import schemas
 
 LOG = logging.getLogger(__name__)
 
@@ -30,10 +34,13 @@ class FEGAMessage:
             # if message.header.properties.content_type != 'application/json':
             #     raise FEGASystemError('Not an "application/json" message')
             try:
-                self.__parsed = parse_json(self.content)
+                self.__parsed = parse_json(self.body) # from the raw bytes (content is decoded only if needed)
             except Exception as e:
                 LOG.error('Malformatted JSON: %s', e)
                 raise FEGASystemError(repr(e))
 
         return self.__parsed
 
+    def validate(self):
+        """Check the message against the schema for its type."""
+        schemas.validate(self.parsed)
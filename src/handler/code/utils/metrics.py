@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Metrics, in the Prometheus text format.
+
+A module-level registry of counters, gauges and summaries (sum and count),
+served over HTTP on the [metrics] port (no server if the port is not set).
+"""
+
+import logging
+import asyncio
+import time
+
+LOG = logging.getLogger(__name__)
+
+_counters = {}   # (name, labels) -> value
+_gauges = {}
+_summaries = {}  # (name, labels) -> [sum, count]
+_help = {}
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def describe(name, text):
+    _help[name] = text
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    _gauges[_key(name, labels)] = value
+
+def observe(name, value, **labels):
+    s = _summaries.setdefault(_key(name, labels), [0, 0])
+    s[0] += value
+    s[1] += 1
+
+class timer():
+    """Observe the time spent in the block (in seconds)."""
+
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.monotonic() - self.start, **self.labels)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    content = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+    return '{' + content + '}'
+
+def render():
+    lines = []
+    seen = set()
+
+    def header(name, kind):
+        if name in seen:
+            return
+        seen.add(name)
+        if name in _help:
+            lines.append(f'# HELP {name} {_help[name]}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(_counters.items()):
+        header(name, 'counter')
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), value in sorted(_gauges.items()):
+        header(name, 'gauge')
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), (total, count) in sorted(_summaries.items()):
+        header(name, 'summary')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        await reader.readuntil(b'\r\n\r\n') # we serve the same page for any request
+        body = render().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                     b'Connection: close\r\n\r\n' + body)
+        await writer.drain()
+    except Exception as e:
+        LOG.debug('Metrics request error: %r', e)
+    finally:
+        writer.close()
+
+async def serve(conf, conf_section='metrics'):
+    port = conf.getint(conf_section, 'port', fallback=None)
+    if not port:
+        LOG.debug('No metrics server')
+        return
+    host = conf.get(conf_section, 'host', fallback='0.0.0.0')
+    server = await asyncio.start_server(_handle, host, port)
+    LOG.info('Serving the metrics on %s:%d', host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""Durable outbox for the messages to Central EGA.
+
+The messages are first appended to a local SQLite database,
+and a background relay drains it to the broker, in batches, with publisher confirms.
+A message is removed from the outbox only once the broker confirmed it,
+so a broker outage delays the messages, but does not lose them (they might be sent twice though).
+
+Each handler instance must have its own outbox file, on a persistent volume,
+and not on a volume shared by several instances (like the staging area):
+the outbox is only enabled with an explicit location, where {hostname} is replaced
+by the host name (eg the container name), and a file can only be opened by one process.
+"""
+
+import logging
+import asyncio
+import json
+import time
+import random
+import sqlite3
+import fcntl
+import socket
+from pathlib import Path
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id             INTEGER PRIMARY KEY AUTOINCREMENT,
+    exchange       TEXT NOT NULL,
+    routing_key    TEXT NOT NULL,
+    correlation_id TEXT,
+    content_type   TEXT NOT NULL,
+    body           BLOB NOT NULL,
+    attempts       INTEGER NOT NULL DEFAULT 0,
+    created_at     REAL NOT NULL
+)
+'''
+
+class Outbox():
+
+    __slots__ = (
+        'conf',
+        'conf_section',
+        'enabled',
+        'path',
+        'db',
+        'lock',
+        'executor',
+        'wakeup',
+    )
+
+    def __init__(self, conf, conf_section='outbox'):
+        self.conf = conf
+        self.conf_section = conf_section
+        location = conf.get(conf_section, 'location', fallback=None)
+        self.enabled = conf.getboolean(conf_section, 'enabled', fallback=bool(location))
+        if self.enabled and not location:
+            raise ValueError(f'[{conf_section}] location is required: a file per handler instance')
+        self.path = Path(location.format(hostname=socket.gethostname())) if location else None
+        self.db = None
+        self.lock = None
+        # The SQLite connection is used by one thread only
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self.wakeup = asyncio.Event()
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {self.path}>'
+
+    # Blocking functions, run in the outbox thread
+
+    def _open(self):
+        if self.db is None:
+            LOG.info('Opening the outbox: %s', self.path)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Only one process per outbox file
+            self.lock = open(self.path.with_name(self.path.name + '.lock'), 'w')
+            try:
+                fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.lock.close()
+                self.lock = None
+                raise ValueError(f'The outbox {self.path} is already used by another process')
+            db = sqlite3.connect(self.path)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=FULL') # durable once appended
+            db.execute(SCHEMA)
+            self.db = db
+        return self.db
+
+    def _append(self, exchange, routing_key, correlation_id, content_type, body):
+        db = self._open()
+        with db: # committed when we leave
+            db.execute('INSERT INTO outbox (exchange, routing_key, correlation_id, content_type, body, created_at) '
+                       'VALUES (?, ?, ?, ?, ?, ?)',
+                       (exchange, routing_key, correlation_id, content_type, body, time.time()))
+
+    def _fetch(self, limit):
+        return self._open().execute('SELECT id, exchange, routing_key, correlation_id, content_type, body '
+                                    'FROM outbox ORDER BY id LIMIT ?', (limit,)).fetchall()
+
+    def _delete(self, ids):
+        db = self._open()
+        with db: # one transaction
+            db.executemany('DELETE FROM outbox WHERE id = ?', ((i,) for i in ids))
+
+    def _retry(self, ids):
+        db = self._open()
+        with db:
+            db.executemany('UPDATE outbox SET attempts = attempts + 1 WHERE id = ?', ((i,) for i in ids))
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    # Async interface
+
+    async def append(self, exchange, routing_key, message, correlation_id=None):
+        """Durably store the message. It is sent later by the relay."""
+        if isinstance(message, (str, bytes)):
+            content_type = 'text/plain'
+            body = message.encode() if isinstance(message, str) else message
+        else:
+            content_type = 'application/json'
+            body = json.dumps(message, separators=(',', ':')).encode()
+        await self._run(self._append, exchange, routing_key, correlation_id, content_type, body)
+        LOG.debug('Message for %s [routing key: %s] added to the outbox', exchange, routing_key)
+        self.wakeup.set()
+
+    async def relay(self, publish_many):
+        """Drain the outbox forever, using ``publish_many(messages, exchange)``.
+
+        ``publish_many`` gets a list of (message, routing_key, correlation_id)
+        and returns a list of booleans, True when the broker confirmed that message.
+        """
+        batch = self.conf.getint(self.conf_section, 'batch', fallback=100)
+        idle = self.conf.getfloat(self.conf_section, 'idle_interval', fallback=5)
+        backoff_min = self.conf.getfloat(self.conf_section, 'backoff_min', fallback=1)
+        backoff_max = self.conf.getfloat(self.conf_section, 'backoff_max', fallback=60)
+        delay = backoff_min
+        LOG.info('Relaying the outbox %s', self.path)
+
+        while True:
+            try:
+                self.wakeup.clear() # before fetching, so we don't miss an append
+                rows = await self._run(self._fetch, batch)
+                if not rows:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout=idle)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                confirmed, failed = [], []
+                # Consecutive messages for the same exchange, in order
+                for exchange, group in groupby(rows, key=lambda row: row[1]):
+                    group = list(group)
+                    messages = [(json.loads(body) if content_type == 'application/json' else body,
+                                 routing_key,
+                                 correlation_id)
+                                for _, _, routing_key, correlation_id, content_type, body in group]
+                    results = await publish_many(messages, exchange)
+                    for row, ok in zip(group, results):
+                        (confirmed if ok else failed).append(row[0])
+
+                if confirmed:
+                    await self._run(self._delete, confirmed)
+                    LOG.debug('Relayed %d messages', len(confirmed))
+                if not failed:
+                    delay = backoff_min
+                    continue
+
+                await self._run(self._retry, failed)
+                LOG.warning('%d messages not confirmed: retrying in %.1f seconds', len(failed), delay)
+            except Exception as e:
+                LOG.error('Outbox relay error: %r', e)
+
+            # Backoff, with some jitter
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, backoff_max)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Several consumers, so that the light jobs are not stuck behind the heavy ones.
+
+The messages from Central EGA all arrive in the [broker] queue.
+When [broker] consumers is set, a router picks them up, and forwards each of them
+(unchanged, and confirmed) to the queue of the consumer handling its job type.
+Each consumer has its own channel, prefetch and number of workers, for example:
+
+    [broker]
+    consumers = files, metadata
+
+    [consumer:files]
+    queue = jobs.files
+    job_types = ingest, accession
+    prefetch_count = 4
+
+    [consumer:metadata]
+    queue = jobs.metadata
+    job_types = *
+    prefetch_count = 50
+
+The consumer with job_types = * gets the job types not listed elsewhere.
+
+The workers of a consumer only limit its job types that are not in [jobs] prioritized:
+the prioritized ones all wait for their slot in the scheduler, which picks the smallest files first.
+Their limit is then the one in the [jobs] section, and the consumer prefetch is the pool it picks from.
+"""
+
+import logging
+import asyncio
+
+from .json import parse_json
+
+LOG = logging.getLogger(__name__)
+
+class Consumer():
+
+    __slots__ = (
+        'name',
+        'queue',
+        'job_types',
+        'prefetch_count',
+        'workers',
+    )
+
+    def __init__(self, conf, name):
+        conf_section = f'consumer:{name}'
+        self.name = name
+        self.queue = conf.get(conf_section, 'queue', fallback=f'jobs.{name}')
+        self.job_types = [t.strip() for t in conf.get(conf_section, 'job_types', fallback='*').split(',') if t.strip()]
+        self.prefetch_count = conf.getint(conf_section, 'prefetch_count', fallback=1)
+        # At most that many jobs run at once (defaults to the prefetch),
+        # except the prioritized ones, limited by the scheduler
+        self.workers = conf.getint(conf_section, 'workers', fallback=self.prefetch_count)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.name}: {self.queue} [{", ".join(self.job_types)}]>'
+
+
+def load(conf, conf_section='broker'):
+    names = conf.get(conf_section, 'consumers', fallback='')
+    return [Consumer(conf, name.strip()) for name in names.split(',') if name.strip()]
+
+def pick(consumers, job_type):
+    default = None
+    for consumer in consumers:
+        if job_type in consumer.job_types:
+            return consumer
+        if '*' in consumer.job_types and default is None:
+            default = consumer
+    return default or consumers[-1]
+
+def peek_job_type(message):
+    try:
+        return parse_json(message.body).get('type')
+    except Exception as e: # the consumer will report it
+        LOG.debug('Could not find the job type: %r', e)
+        return None
+
+async def start(config, on_message, consumers):
+    """Start the consumers, and then the router."""
+
+    prioritized = config.scheduler.prioritized
+
+    for consumer in consumers:
+        LOG.info('Consumer %r with %d workers', consumer, consumer.workers)
+        limit = asyncio.Semaphore(consumer.workers)
+
+        async def work(message, limit=limit):
+            # Not in arrival order: the scheduler picks among all of them
+            if peek_job_type(message) in prioritized:
+                return await on_message(message)
+            async with limit:
+                await on_message(message)
+
+        await config.mq.consume(work, queue=consumer.queue, prefetch_count=consumer.prefetch_count, declare=True)
+
+    async def route(message):
+        job_type = peek_job_type(message)
+        consumer = pick(consumers, job_type)
+        delivery_tag = message.delivery.delivery_tag
+        LOG.debug('Routing message %d (%s) to %s', delivery_tag, job_type, consumer.queue)
+        if await config.mq.forward(message, consumer.queue):
+            await message.channel.basic_ack(delivery_tag)
+        else:
+            LOG.error('Could not route message %d: requeuing it', delivery_tag)
+            await message.channel.basic_nack(delivery_tag, requeue=True)
+
+    prefetch_count = config.getint('broker', 'router_prefetch_count', fallback=100)
+    return await config.mq.consume(route, prefetch_count=prefetch_count)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Limiting the number of in-flight jobs, per job type.
+
+The broker delivers up to ``prefetch_count`` messages at once.
+Each job type then has its own limit (in the [jobs] section),
+so that cheap metadata messages progress while large files are ingested.
+
+When a slot frees up, the waiting jobs are not woken in arrival order:
+for the job types listed in [jobs] prioritized, the smallest files go first
+(shortest job first, to minimise the mean completion time).
+The waiting time counts as well (aging), and a job waiting for more than
+[jobs] max_wait seconds goes before any other, so large files are not starved.
+The other job types are woken in arrival order.
+"""
+
+import logging
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+
+SIZE_BUCKETS = ((100 * 1024**2, '100MB'),
+                (1024**3, '1GB'),
+                (10 * 1024**3, '10GB'),
+                (100 * 1024**3, '100GB'),
+                (1024**4, '1TB'))
+
+def size_bucket(size):
+    for limit, name in SIZE_BUCKETS:
+        if size <= limit:
+            return name
+    return '+Inf'
+
+
+class PrioritySlot():
+    """A semaphore waking the waiter with the lowest cost first.
+
+    The cost of a waiter is log2(size) - age/aging: doubling the size
+    is worth ``aging`` seconds of waiting.
+    """
+
+    __slots__ = (
+        'value',
+        'waiters',
+        'aging',
+        'max_wait',
+    )
+
+    def __init__(self, value, aging=600, max_wait=6*3600):
+        self.value = value
+        self.waiters = [] # [size, enqueued time, future]
+        self.aging = aging
+        self.max_wait = max_wait
+
+    def cost(self, waiter, now):
+        size, since, _ = waiter
+        age = now - since
+        if age >= self.max_wait:
+            return (0, since) # starving: before the others, in arrival order
+        return (1, math.log2(size + 1) - age / self.aging)
+
+    async def acquire(self, size=0):
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        loop = asyncio.get_running_loop()
+        waiter = [size, time.monotonic(), loop.create_future()]
+        self.waiters.append(waiter)
+        try:
+            await waiter[2]
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter[2].done() and not waiter[2].cancelled():
+                self.release() # we were given the slot, but don't use it
+            raise
+
+    def release(self):
+        self.value += 1
+        now = time.monotonic()
+        while self.value > 0 and self.waiters:
+            waiter = min(self.waiters, key=lambda w: self.cost(w, now))
+            self.waiters.remove(waiter)
+            if waiter[2].done():
+                continue
+            self.value -= 1
+            waiter[2].set_result(None)
+
+
+class JobScheduler():
+
+    __slots__ = (
+        'conf',
+        'conf_section',
+        'default',
+        'prioritized',
+        'slots',
+    )
+
+    def __init__(self, conf, conf_section='jobs'):
+        self.conf = conf
+        self.conf_section = conf_section
+        self.default = conf.getint(conf_section, 'max_in_flight', fallback=1)
+        prioritized = conf.get(conf_section, 'prioritized', fallback='ingest, accession')
+        self.prioritized = set(t.strip() for t in prioritized.split(',') if t.strip())
+        self.slots = {}
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {self.default} in-flight jobs by default>'
+
+    def _get(self, job_type):
+        s = self.slots.get(job_type)
+        if s is None:
+            limit = self.conf.getint(self.conf_section, job_type, fallback=self.default)
+            aging = self.conf.getfloat(self.conf_section, 'aging', fallback=600)
+            max_wait = self.conf.getfloat(self.conf_section, 'max_wait', fallback=6*3600)
+            LOG.debug('At most %d in-flight %s jobs', limit, job_type)
+            s = PrioritySlot(limit, aging=aging, max_wait=max_wait)
+            self.slots[job_type] = s
+        return s
+
+    @asynccontextmanager
+    async def slot(self, job_type, size=0):
+        """Wait for a free slot for that job type (smallest sizes first)."""
+        s = self._get(job_type)
+        start = time.monotonic()
+        await s.acquire(size if job_type in self.prioritized else 0)
+        metrics.observe('fega_job_queue_delay_seconds', time.monotonic() - start,
+                        job_type=job_type, size=size_bucket(size))
+        try:
+            yield
+        finally:
+            s.release()
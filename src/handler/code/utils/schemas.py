@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Validating the messages from Central EGA against the JSON schemas.
+
+The schemas (in src/handler/schemas, or [broker] schemas) are compiled once, at startup,
+into Python code (with fastjsonschema), and indexed by the message types they accept
+(ie their properties.type const or enum).
+A message for which there is no schema is not validated.
+It is on by default, and turned off with [broker] validate_messages = no.
+"""
+
+import logging
+import json
+from pathlib import Path
+
+import fastjsonschema
+
+from .exceptions import InvalidBrokerMessage
+
+LOG = logging.getLogger(__name__)
+
+_validators = {} # job type -> (schema name, validator)
+
+def enabled(conf, conf_section='broker'):
+    return conf.getboolean(conf_section, 'validate_messages', fallback=True)
+
+def load(conf, conf_section='broker'):
+    directory = conf.get(conf_section, 'schemas', fallback=None)
+    if not directory:
+        directory = Path(__file__).resolve().parents[2] / 'schemas' # next to the code
+    for path in sorted(Path(directory).glob('*.json')):
+        with open(path, 'rb') as f:
+            schema = json.load(f)
+        message_type = schema.get('properties', {}).get('type', {})
+        job_types = [message_type['const']] if 'const' in message_type else message_type.get('enum', [])
+        if not job_types: # not a message type we consume
+            continue
+        validator = fastjsonschema.compile(schema)
+        for job_type in job_types:
+            _validators[job_type] = (path.name, validator)
+    LOG.info('Loaded the schemas for %s', ', '.join(sorted(_validators)))
+
+def validate(data):
+    """Raise InvalidBrokerMessage if the message does not follow the schema for its type."""
+    if not isinstance(data, dict):
+        raise InvalidBrokerMessage('Not a JSON object')
+    entry = _validators.get(data.get('type'))
+    if entry is None:
+        return
+    name, validator = entry
+    try:
+        validator(data)
+    except fastjsonschema.JsonSchemaException as e:
+        raise InvalidBrokerMessage(f'{name}: {e.message}') from e
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Detecting session keys reuse.
+
+We store, in the vault database, a keyed hash of every accepted session key,
+along with the (user, filepath) it was used for.
+The same session key for another file means it was reused.
+
+An in-process Bloom filter, warmed at startup, sits in front of the database:
+the common case, a session key never seen, does not cost a database round trip.
+The filter is refreshed incrementally with the keys saved by the other handler instances,
+and the final insertion in the database catches the remaining races.
+"""
+
+import logging
+import hmac
+import hashlib
+import asyncio
+from datetime import timedelta
+
+from .bloom import BloomFilter
+from .db import has_statements
+from .exceptions import SessionKeyAlreadyUsedError
+
+LOG = logging.getLogger(__name__)
+
+STATEMENTS = ('session_keys_query', 'session_keys_used_query', 'session_keys_save_query')
+
+class SessionKeyRegistry():
+
+    __slots__ = (
+        'conf',
+        'conf_section',
+        'enabled',
+        'bloom',
+        'watermark',
+        '_hmac_key',
+    )
+
+    def __init__(self, conf, conf_section='session_keys'):
+        self.conf = conf
+        self.conf_section = conf_section
+        self.enabled = conf.getboolean(conf_section, 'enabled', fallback=True)
+        if self.enabled and not has_statements(conf, *STATEMENTS):
+            LOG.warning('Session keys reuse detection disabled: no %s in [db]', ', '.join(STATEMENTS))
+            self.enabled = False
+        capacity = conf.getint(conf_section, 'capacity', fallback=10_000_000)
+        error_rate = conf.getfloat(conf_section, 'error_rate', fallback=0.001)
+        self.bloom = BloomFilter(capacity, error_rate=error_rate)
+        self.watermark = None # latest created_at seen
+        self._hmac_key = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}: {self.bloom!r}>'
+
+    def digest(self, session_key):
+        if self._hmac_key is None:
+            self._hmac_key = hmac.new(self.conf.service_key.private(), b'LocalEGA session keys', hashlib.sha256).digest()
+        return hmac.new(self._hmac_key, session_key, hashlib.sha256).hexdigest()
+
+    def _add(self, record):
+        self.bloom.add(bytes.fromhex(record['checksum']))
+        created_at = record['created_at']
+        if self.watermark is None or created_at > self.watermark:
+            self.watermark = created_at
+
+    async def warm(self):
+        """Load all the stored checksums in the Bloom filter."""
+        if not self.enabled:
+            return
+        LOG.info('Loading the session keys checksums')
+        async for record in self.conf.db.iterate('session_keys_query', None):
+            self._add(record)
+        LOG.info('Session keys filter: %r', self.bloom)
+
+    async def refresh(self):
+        """Add the checksums saved since the last time (by us or other handlers)."""
+        # Overlap a bit, in case of late commits
+        since = self.watermark - timedelta(minutes=5) if self.watermark else None
+        async for record in self.conf.db.iterate('session_keys_query', since):
+            self._add(record)
+
+    async def run_refresh(self):
+        interval = self.conf.getfloat(self.conf_section, 'refresh_interval', fallback=60)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                LOG.error('Session keys refresh error: %r', e)
+
+    async def check(self, checksums, username, filepath):
+        """Raise SessionKeyAlreadyUsedError if one the checksums was used for another file."""
+        if not self.enabled:
+            return
+        maybe = [c for c in checksums if bytes.fromhex(c) in self.bloom]
+        if not maybe:
+            return # definitely never seen (at least at the last refresh)
+        LOG.debug('Session key possibly used: checking the database')
+        used = await self.conf.db.fetchval('session_keys_used_query', maybe, username, filepath)
+        if used:
+            raise SessionKeyAlreadyUsedError(used[0])
+
+    async def save(self, checksums, username, filepath):
+        """Save the checksums for that file.
+
+        Raises SessionKeyAlreadyUsedError if another file got it in the meantime.
+        """
+        if not self.enabled:
+            return
+        used = await self.conf.db.fetchval('session_keys_save_query', checksums, username, filepath)
+        for c in checksums:
+            self.bloom.add(bytes.fromhex(c))
+        if used:
+            raise SessionKeyAlreadyUsedError(used[0])
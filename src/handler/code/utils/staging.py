@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Information about the staging files.
+
+While ingesting a file, we read it entirely, so we record
+the header size, the encrypted payload size and checksum.
+The accession step then does not need to compute them again.
+
+The records are not stored next to the staging files, in the users' namespace
+(where an upload could collide with them), but in their own directory
+(``[staging] info``, default: .info in the staging area), named after a hash of the staging path.
+
+The record is signed with a key derived from the service key, and bound to the staging path:
+it is tamper-evident.
+"""
+
+import logging
+import os
+import json
+import hmac
+import hashlib
+from pathlib import Path
+
+from .exceptions import FEGASystemError
+
+LOG = logging.getLogger(__name__)
+
+def location(config):
+    path = config.get('staging', 'info', fallback=None)
+    if path:
+        return Path(path)
+    staging_prefix = config.get('staging', 'location', raw=True)
+    return Path(staging_prefix % '') / '.info'
+
+def info_path(config, staging_path):
+    key = os.fsencode(os.path.normpath(staging_path))
+    return location(config) / hashlib.sha256(key).hexdigest()
+
+def _signature(config, staging_path, payload):
+    key = hmac.new(config.service_key.private(), b'LocalEGA staging info', hashlib.sha256).digest()
+    h = hmac.new(key, digestmod=hashlib.sha256)
+    h.update(os.fsencode(staging_path))
+    h.update(b'\0')
+    h.update(payload)
+    return h.hexdigest()
+
+def save_info(config, staging_path, info):
+    payload = json.dumps(info, sort_keys=True, separators=(',', ':'))
+    record = {
+        'info': payload,
+        'signature': _signature(config, staging_path, payload.encode()),
+    }
+    path = info_path(config, staging_path)
+    LOG.debug('Saving staging info in %s', path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(record, f)
+
+def load_info(config, staging_path):
+    """Return the recorded information, or None if there is no record.
+
+    Raises FEGASystemError if the record has been tampered with.
+    """
+    path = info_path(config, staging_path)
+    try:
+        with open(path, 'r') as f:
+            record = json.load(f)
+    except FileNotFoundError:
+        LOG.debug('No staging info for %s', staging_path)
+        return None
+
+    payload = record.get('info', '')
+    signature = _signature(config, staging_path, payload.encode())
+    if not hmac.compare_digest(signature, record.get('signature', '')):
+        raise FEGASystemError(f'Invalid signature for the staging info of {staging_path}')
+    return json.loads(payload)
+
+def remove_info(config, staging_path):
+    try:
+        info_path(config, staging_path).unlink()
+    except FileNotFoundError:
+        pass
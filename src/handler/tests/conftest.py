@@ -0,0 +1,110 @@
+import sys
+import json
+import textwrap
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent)) # the handler code package, not the stdlib one
+
+from code.utils import conf
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    """Return a function building a Configuration from an INI string."""
+    def _make(content=''):
+        path = tmp_path / 'conf.ini'
+        path.write_text(textwrap.dedent(content))
+        with pytest.warns(UserWarning): # no logging supplied
+            return conf.Configuration(str(path))
+    return _make
+
+
+@pytest.fixture
+def keys(tmp_path):
+    """The configuration of a generated service key and master public key."""
+    from crypt4gh.keys import c4gh
+    seckey, pubkey = tmp_path / 'service.sec', tmp_path / 'master.pub'
+    c4gh.generate(str(seckey), str(pubkey), passphrase=b'secret')
+    return f"""
+    [DEFAULT]
+    master_pubkey = master
+    service_key = service
+
+    [master]
+    loader_class = C4GHFilePubKey
+    filepath = {pubkey}
+
+    [service]
+    loader_class = C4GHFileKey
+    passphrase = secret
+    filepath = {seckey}
+    """
+
+
+@pytest.fixture
+def encrypt(keys, tmp_path):
+    """Return a function writing a Crypt4GH file of the given data, for the service key."""
+    import io
+    from crypt4gh import lib
+    from crypt4gh.keys import get_private_key, get_public_key
+    seckey = get_private_key(str(tmp_path / 'service.sec'), lambda: 'secret')
+    pubkey = get_public_key(str(tmp_path / 'master.pub')) # the service key pair
+    def _encrypt(path, data):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'wb') as outfile:
+            lib.encrypt([(0, seckey, pubkey)], io.BytesIO(data), outfile)
+        return path
+    return _encrypt
+
+
+# Fakes of the broker, shared by the handler tests
+
+class Channel:
+    """A consumer channel, recording the acks and nacks."""
+    def __init__(self):
+        self.calls = []
+    async def basic_ack(self, tag):
+        self.calls.append(('ack', tag))
+    async def basic_nack(self, tag, requeue=True):
+        self.calls.append(('nack', tag, requeue))
+
+class Publisher:
+    """The broker connection, recording the published messages (all confirmed)."""
+    def __init__(self):
+        self.published = []
+    async def cega_publish(self, message, routing_key, correlation_id=None, **kwargs):
+        self.published.append((routing_key, dict(message)))
+        return True
+    async def lega_publish(self, message, routing_key, correlation_id=None, **kwargs):
+        self.published.append((routing_key, dict(message)))
+        return True
+
+
+@pytest.fixture
+def publisher():
+    return Publisher()
+
+
+@pytest.fixture
+def job_message():
+    """Return a function building a message as the handlers get it: parsed, with its properties."""
+    def _message(parsed, correlation_id='corr'):
+        return SimpleNamespace(parsed=dict(parsed),
+                               header=SimpleNamespace(properties=SimpleNamespace(correlation_id=correlation_id,
+                                                                                 content_type='application/json')))
+    return _message
+
+
+@pytest.fixture
+def delivery():
+    """Return a function building a delivery from the broker, each on its own channel."""
+    def _delivery(tag, body):
+        return SimpleNamespace(body=json.dumps(body).encode(), channel=Channel(),
+                               delivery=SimpleNamespace(delivery_tag=tag),
+                               header=SimpleNamespace(properties=SimpleNamespace(correlation_id=f'corr{tag}',
+                                                                                 content_type='application/json')))
+    return _delivery
@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import io
+import os
+
+import pytest
+from crypt4gh import header
+
+from code.handlers import ingest, accession
+from code.utils import staging, exceptions
+
+DATA = os.urandom(3 * 65536 + 321)
+
+class DB:
+    def __init__(self):
+        self.saved = []
+    async def save_file(self, *args):
+        self.saved.append(args)
+
+@pytest.fixture
+def config(make_config, keys, tmp_path, publisher):
+    config = make_config(keys + f"""
+    [inbox]
+    location = {tmp_path}/inbox/%s
+
+    [staging]
+    location = {tmp_path}/staging/%s
+
+    [vault]
+    location = {tmp_path}/vault
+
+    [backup]
+    location = {tmp_path}/backup
+
+    [accession]
+    replicas = vault, backup
+    """)
+    config._mq = publisher
+    config._db = DB()
+    return config
+
+@pytest.fixture
+def staged(config, encrypt, tmp_path, job_message):
+    """Ingest a file, and return the accession message."""
+    encrypt(tmp_path / 'inbox' / 'jane' / 'file.c4gh', DATA)
+    result = asyncio.run(ingest.execute(config, job_message({'user': 'jane', 'filepath': 'file.c4gh'})))
+    return dict(result['message'], accession_id='EGAF00000000001')
+
+def payload(config, tmp_path):
+    path = tmp_path / 'staging' / 'jane' / 'file.c4gh'
+    return path.read_bytes()[staging.load_info(config, str(path))['header_size']:]
+
+def test_all_replicas_written_and_verified(config, staged, job_message, tmp_path):
+    expected = payload(config, tmp_path)
+    result = asyncio.run(accession.execute(config, job_message(staged)))
+    assert result['routing_key'] == 'files.completed'
+
+    relative_path = accession.name2fs('EGAF00000000001')
+    for location in ('vault', 'backup'):
+        assert (tmp_path / location / relative_path).read_bytes() == expected
+
+    (filepath, size, _, payload_checksum, decrypted_checksum, accession_id, path), = config.db.saved
+    assert (filepath, size, accession_id, path) == ('file.c4gh', len(expected), 'EGAF00000000001', relative_path)
+    assert payload_checksum == hashlib.sha256(expected).hexdigest()
+    assert decrypted_checksum == hashlib.sha256(DATA).hexdigest()
+    assert not (tmp_path / 'staging' / 'jane' / 'file.c4gh').exists() # cleaned
+
+def test_partial_replicas_removed_on_failure(config, staged, job_message, tmp_path):
+    config.set('accession', 'copy_method', 'bogus')
+    with pytest.raises(ValueError):
+        asyncio.run(accession.execute(config, job_message(staged)))
+    relative_path = accession.name2fs('EGAF00000000001')
+    assert not (tmp_path / 'vault' / relative_path).exists()
+    assert not (tmp_path / 'backup' / relative_path).exists()
+    assert config.db.saved == []
+
+@pytest.mark.parametrize('policy', ['full', 'sampled'])
+def test_corrupt_replicas_removed(config, staged, job_message, tmp_path, monkeypatch, policy):
+    config.read_dict({'verification': {'policy': policy}})
+    relative_path = accession.name2fs('EGAF00000000001')
+    copy_payload = accession.copy_payload
+    async def corrupt_copy(infile, outfile, *args):
+        await copy_payload(infile, outfile, *args)
+        if 'backup' in outfile.name:
+            os.pwrite(outfile.fileno(), b'corrupt', 0)
+    monkeypatch.setattr(accession, 'copy_payload', corrupt_copy)
+
+    with pytest.raises(exceptions.ChecksumsNotMatching):
+        asyncio.run(accession.execute(config, job_message(staged)))
+    assert not (tmp_path / 'vault' / relative_path).exists() # not taken for an archived file
+    assert not (tmp_path / 'backup' / relative_path).exists()
+    assert config.db.saved == []
+    assert 'files.completed' not in [key for key, _ in config.mq.published]
+
+@pytest.mark.parametrize('step', ['execute', 'record']) # verifying, or saving it
+def test_replicas_removed_when_interrupted_before_saved(config, staged, job_message, tmp_path, monkeypatch, step):
+    relative_path = accession.name2fs('EGAF00000000001')
+    entered = None
+    async def hang(*args):
+        entered.set()
+        await asyncio.sleep(3600)
+    monkeypatch.setattr(accession.verify, step, hang)
+
+    async def interrupted():
+        nonlocal entered
+        entered = asyncio.Event()
+        task = asyncio.create_task(accession.execute(config, job_message(staged)))
+        await entered.wait()
+        assert (tmp_path / 'vault' / relative_path).exists()
+        task.cancel() # the drain timeout
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(interrupted())
+    assert not (tmp_path / 'vault' / relative_path).exists()
+    assert not (tmp_path / 'backup' / relative_path).exists()
+
+    # Redelivered: archived, not taken for an archived file
+    monkeypatch.undo()
+    config.db.saved.clear()
+    assert asyncio.run(accession.execute(config, job_message(staged)))['routing_key'] == 'files.completed'
+    assert len(config.db.saved) == 1
+
+def session_keys(config, master_header):
+    packets = header.parse(io.BytesIO(master_header))
+    decrypted, _ = header.decrypt(packets, [(0, config.service_key.private(), None)]) # the master key pair
+    data_packets, _ = header.partition_packets(decrypted)
+    return [header.parse_enc_packet(packet) for packet in data_packets]
+
+def test_reuses_the_header_reencrypted_by_ingest(config, staged, job_message, tmp_path, monkeypatch):
+    staging_file = tmp_path / 'staging' / 'jane' / 'file.c4gh'
+    info = staging.load_info(config, str(staging_file))
+    inbox_keys = session_keys(config, (tmp_path / 'inbox' / 'jane' / 'file.c4gh').read_bytes())
+
+    def no_decryption(*args):
+        raise AssertionError('The header should not be decrypted again')
+    monkeypatch.setattr(accession.header, 'decrypt', no_decryption)
+    asyncio.run(accession.execute(config, job_message(staged)))
+
+    (_, _, master_header, *_), = config.db.saved
+    assert master_header == bytes.fromhex(info['master_header'])
+    monkeypatch.undo()
+    assert session_keys(config, master_header) == inbox_keys
+
+def test_reencrypts_the_header_without_a_record(config, staged, job_message, tmp_path):
+    staging_file = tmp_path / 'staging' / 'jane' / 'file.c4gh'
+    staging.remove_info(config, str(staging_file))
+    inbox_keys = session_keys(config, staging_file.read_bytes())
+
+    asyncio.run(accession.execute(config, job_message(staged)))
+    (_, _, master_header, payload_checksum, *_), = config.db.saved
+    assert session_keys(config, master_header) == inbox_keys
+    vault_file = tmp_path / 'vault' / accession.name2fs('EGAF00000000001')
+    assert payload_checksum == hashlib.sha256(vault_file.read_bytes()).hexdigest()
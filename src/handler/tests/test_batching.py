@@ -0,0 +1,134 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import asyncpg
+import pytest
+
+from code.utils.exceptions import FEGASystemError, TransientError
+
+BATCHING = """
+[batching]
+enabled = yes
+max_items = 2
+window = 0.01
+retries = 2
+retry_delay = 0.001
+
+[db]
+on_batch = SELECT * FROM public.process_message_batch($1)
+"""
+
+class BatchDB:
+    """Answers each message with its own content, or with the queued failures first."""
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.batches = []
+        self.running = 0
+        self.max_running = 0
+
+    async def fetchval(self, stmt, payload):
+        assert stmt == 'on_batch'
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0.005) # long enough for the next batch to be flushed
+            if self.failures:
+                raise self.failures.pop(0)
+            messages = json.loads(payload)
+            self.batches.append(messages)
+            return json.dumps([{'error': m['error']} if 'error' in m else {'response': m}
+                               for m in messages])
+        finally:
+            self.running -= 1
+
+def message(**content):
+    return SimpleNamespace(content=json.dumps(content))
+
+@pytest.fixture
+def batcher(make_config):
+    def _batcher(db):
+        config = make_config(BATCHING)
+        config._db = db
+        return config.batcher
+    return _batcher
+
+def test_batches_are_sent_one_at_a_time_in_order(batcher):
+    db = BatchDB()
+    b = batcher(db)
+    async def run():
+        return await asyncio.gather(*(b.fetchval('on_batch', message(n=n)) for n in range(7)))
+    results = asyncio.run(run())
+    assert [r['n'] for r in results] == list(range(7))
+    assert db.max_running == 1
+    assert [m['n'] for batch in db.batches for m in batch] == list(range(7))
+    assert max(len(batch) for batch in db.batches) == 2
+
+def test_retries_the_batch_on_deadlock(batcher):
+    db = BatchDB([asyncpg.DeadlockDetectedError('deadlock'), asyncpg.SerializationError('serialization')])
+    b = batcher(db)
+    async def run():
+        return await asyncio.gather(b.fetchval('on_batch', message(n=0)), b.fetchval('on_batch', message(n=1)))
+    assert asyncio.run(run()) == [{'n': 0}, {'n': 1}]
+    assert len(db.batches) == 1
+
+def test_transient_error_after_the_retries(batcher):
+    db = BatchDB([asyncpg.DeadlockDetectedError('deadlock')] * 3)
+    b = batcher(db)
+    async def run():
+        return await asyncio.gather(b.fetchval('on_batch', message(n=0)),
+                                    b.fetchval('on_batch', message(n=1)),
+                                    return_exceptions=True)
+    results = asyncio.run(run())
+    assert all(isinstance(r, TransientError) for r in results)
+    assert db.batches == []
+
+def test_errors_are_per_message(batcher):
+    b = batcher(BatchDB())
+    async def run():
+        return await asyncio.gather(b.fetchval('on_batch', message(n=0)),
+                                    b.fetchval('on_batch', message(n=1, error='bad dataset')),
+                                    return_exceptions=True)
+    ok, error = asyncio.run(run())
+    assert ok == {'n': 0}
+    assert isinstance(error, FEGASystemError)
+
+@pytest.mark.parametrize('results', ['[{"response": 1}]', 'null'])
+def test_missing_results_fail_the_batch(batcher, results):
+    class ShortDB:
+        async def fetchval(self, stmt, payload):
+            return results
+    b = batcher(ShortDB())
+    async def run():
+        return await asyncio.wait_for(asyncio.gather(b.fetchval('on_batch', message(n=0)),
+                                                     b.fetchval('on_batch', message(n=1)),
+                                                     return_exceptions=True), 1) # not waiting forever
+    assert all(isinstance(r, FEGASystemError) for r in asyncio.run(run()))
+
+def test_unbatched_deadlock_is_transient(make_config):
+    class DeadlockDB:
+        async def fetchval(self, stmt, *args):
+            raise asyncpg.DeadlockDetectedError('deadlock')
+    config = make_config(BATCHING.replace('enabled = yes', 'enabled = no'))
+    config._db = DeadlockDB()
+    with pytest.raises(TransientError):
+        asyncio.run(config.batcher.fetchval('dataset_query', message(n=0)))
+
+
+@pytest.mark.parametrize('error, requeue', [
+    (TransientError('deadlock'), True),
+    (FEGASystemError('boom'), False),
+])
+def test_transient_errors_are_requeued(error, requeue, delivery):
+    from code.__main__ import ack_nack_on_exception
+
+    @ack_nack_on_exception
+    async def work(message):
+        raise error
+
+    msg = delivery(7, {})
+    try:
+        asyncio.run(work(msg))
+    except FEGASystemError:
+        assert not requeue # reported, and dead-lettered
+    assert msg.channel.calls == [('nack', 7, requeue)]
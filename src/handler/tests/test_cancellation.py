@@ -0,0 +1,93 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from code.handlers import ingest, cancel
+from code.utils import cancellation
+
+DATA = os.urandom(300 * 65536)
+
+@pytest.fixture
+def message(job_message):
+    def _message(filepath, correlation_id):
+        return job_message({'type': 'ingest', 'user': 'jane', 'filepath': filepath}, correlation_id=correlation_id)
+    return _message
+
+@pytest.fixture
+def config(make_config, keys, tmp_path, publisher):
+    config = make_config(keys + f"""
+    [inbox]
+    location = {tmp_path}/inbox/%s
+
+    [staging]
+    location = {tmp_path}/staging/%s
+    tombstones_ttl = 60
+    """)
+    config._mq = publisher
+    return config
+
+def test_tombstone_per_correlation_id(config, message, tmp_path):
+    asyncio.run(cancel.execute(config, message('/dir/file.c4gh', 'first')))
+    assert cancellation.is_cancelled(config, 'jane', 'dir/file.c4gh', 'first')
+    assert not cancellation.is_cancelled(config, 'jane', 'dir/file.c4gh', 'second') # a later upload
+    assert not cancellation.is_cancelled(config, 'john', 'dir/file.c4gh', 'first')
+    assert cancellation.location(config) == tmp_path / 'staging' / '.tombstones'
+
+def test_cancelled_before_the_ingestion(config, message, encrypt, tmp_path):
+    encrypt(tmp_path / 'inbox' / 'jane' / 'file.c4gh', DATA[:1000])
+    asyncio.run(cancel.execute(config, message('file.c4gh', 'corr')))
+    assert asyncio.run(ingest.execute(config, message('file.c4gh', 'corr'))) is None
+    assert not (tmp_path / 'staging' / 'jane' / 'file.c4gh').exists()
+    assert config.mq.published == []
+
+def test_cancelled_during_the_ingestion(config, message, encrypt, tmp_path, monkeypatch):
+    encrypt(tmp_path / 'inbox' / 'jane' / 'file.c4gh', DATA)
+
+    # The cancel message arrives after a few segments were copied
+    read_stage = ingest.read_stage
+    async def slow_read_stage(infile, *queues, **kwargs):
+        async def cancel_later():
+            await asyncio.sleep(0.05)
+            await cancel.execute(config, message('file.c4gh', 'corr'))
+        task = asyncio.create_task(cancel_later())
+        try:
+            await read_stage(infile, *queues, **dict(kwargs, every=1))
+        finally:
+            task.cancel()
+    write_and_digest = ingest.write_and_digest
+    def slow_write_and_digest(*args):
+        time.sleep(0.001)
+        write_and_digest(*args)
+    monkeypatch.setattr(ingest, 'read_stage', slow_read_stage)
+    monkeypatch.setattr(ingest, 'write_and_digest', slow_write_and_digest)
+
+    assert asyncio.run(ingest.execute(config, message('file.c4gh', 'corr'))) is None
+    assert not (tmp_path / 'staging' / 'jane' / 'file.c4gh').exists()
+    assert config.mq.published == []
+
+def test_cancelled_after_the_last_checkpoint(config, message, encrypt, tmp_path, monkeypatch):
+    encrypt(tmp_path / 'inbox' / 'jane' / 'file.c4gh', DATA[:10 * 65536]) # fewer segments than between checkpoints
+
+    # The cancel message arrives once all the segments are read
+    read_stage = ingest.read_stage
+    async def read_then_cancel(*args, **kwargs):
+        await read_stage(*args, **kwargs)
+        await cancel.execute(config, message('file.c4gh', 'corr'))
+    monkeypatch.setattr(ingest, 'read_stage', read_then_cancel)
+
+    assert asyncio.run(ingest.execute(config, message('file.c4gh', 'corr'))) is None
+    assert not (tmp_path / 'staging' / 'jane' / 'file.c4gh').exists()
+    assert config.mq.published == []
+
+def test_prune(config, monkeypatch):
+    cancellation.cancel(config, 'jane', 'old.c4gh', 'corr')
+    old = cancellation.tombstone(config, 'jane', 'old.c4gh', 'corr')
+    os.utime(old, (time.time() - 120, time.time() - 120))
+    cancellation.cancel(config, 'jane', 'new.c4gh', 'corr')
+
+    monkeypatch.setattr(cancellation, '_last_prune', 0)
+    cancellation.prune(config)
+    assert not old.exists()
+    assert cancellation.is_cancelled(config, 'jane', 'new.c4gh', 'corr')
@@ -0,0 +1,53 @@
+import re
+import configparser
+from pathlib import Path
+
+import pytest
+
+from code.utils import db
+
+HANDLER = Path(__file__).resolve().parents[1]
+SAMPLES = [HANDLER / 'conf.ini.sample',
+           HANDLER.parents[1] / 'deploy' / 'docker' / 'lega.ini.sample']
+
+def used_statements():
+    """The statements the code looks up by name."""
+    pattern = re.compile(r"\.(?:fetchval|fetch|iterate|statement)\('([a-z_]+)'")
+    return {name for path in (HANDLER / 'code').rglob('*.py') for name in pattern.findall(path.read_text())}
+
+@pytest.mark.parametrize('sample', SAMPLES, ids=lambda p: p.name)
+def test_samples_have_all_the_statements(sample):
+    config = configparser.RawConfigParser(delimiters=('=', ':'), comment_prefixes=('#', ';'))
+    config.read(sample)
+    statements = db.Statements(config)
+    missing = used_statements() - set(name for name, _ in statements)
+    assert not missing
+
+def test_features_are_off_without_their_statements(make_config):
+    config = make_config("""
+    [db]
+    save_query = SELECT 1
+
+    [batching]
+    enabled = yes
+    """)
+    assert not config.session_keys.enabled
+    assert not config.idempotency.applies('ingest')
+    assert not config.batcher.enabled
+
+def test_features_are_on_with_their_statements(make_config):
+    config = make_config("""
+    [db]
+    session_keys_query = SELECT * FROM public.session_keys_since($1)
+    session_keys_used_query = SELECT * FROM public.session_keys_used($1, $2, $3)
+    session_keys_save_query = SELECT * FROM public.save_session_keys($1, $2, $3)
+    processed_message_query = SELECT * FROM public.processed_message($1)
+    record_processed_message_query = SELECT * FROM public.record_processed_message($1, $2, $3, $4)
+    on_batch = SELECT * FROM public.process_message_batch($1)
+
+    [batching]
+    enabled = yes
+    """)
+    assert config.session_keys.enabled
+    assert config.idempotency.applies('ingest')
+    assert config.batcher.enabled
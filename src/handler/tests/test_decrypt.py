@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+from nacl.bindings import crypto_aead_chacha20poly1305_ietf_encrypt as seal
+
+from code.utils.decrypt import DecryptionEngine
+
+SESSION_KEY = os.urandom(32)
+SEGMENTS = [os.urandom(65536) for _ in range(9)] + [os.urandom(1000)]
+
+def ciphersegment(segment):
+    nonce = os.urandom(12)
+    return nonce + seal(segment, None, nonce, SESSION_KEY)
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_digest_in_segment_order(make_config, executor):
+    config = make_config(f"""
+    [ingest]
+    decrypt_executor = {executor}
+    decrypt_workers = 3
+    decrypt_batch = 2
+    """)
+    engine = config.decryptor
+
+    async def run():
+        queue = asyncio.Queue(maxsize=4)
+        md = hashlib.sha256()
+        async def feed():
+            for segment in SEGMENTS:
+                await queue.put(ciphersegment(segment))
+            await queue.put(b'')
+        await asyncio.gather(feed(), engine.digest(queue, [SESSION_KEY], md))
+        return md.hexdigest()
+
+    try:
+        assert asyncio.run(run()) == hashlib.sha256(b''.join(SEGMENTS)).hexdigest()
+    finally:
+        engine.executor.shutdown()
+
+def test_wrong_key(make_config):
+    engine = DecryptionEngine(make_config(''))
+
+    async def run():
+        queue = asyncio.Queue()
+        for segment in SEGMENTS:
+            queue.put_nowait(ciphersegment(segment))
+        queue.put_nowait(b'')
+        await engine.digest(queue, [os.urandom(32)], hashlib.sha256())
+
+    try:
+        with pytest.raises(ValueError):
+            asyncio.run(run())
+    finally:
+        engine.executor.shutdown()
+
+def test_invalid_executor(make_config):
+    engine = DecryptionEngine(make_config("""
+    [ingest]
+    decrypt_executor = gpu
+    """))
+    with pytest.raises(ValueError):
+        engine.get_executor()
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+import code.__main__ as handler
+from code.utils.json import FEGAMessage
+
+class Connection:
+    def __init__(self):
+        self.calls = []
+    async def stop_consuming(self):
+        self.calls.append('stop_consuming')
+    async def close(self):
+        self.calls.append('close')
+
+@pytest.fixture
+def config(make_config, monkeypatch):
+    config = make_config("""
+    [jobs]
+    max_in_flight = 1
+    drain_timeout = 0.2
+    """)
+    config._mq = Connection()
+    config._db = Connection()
+
+    async def dispatch(config, message, job_type):
+        await asyncio.sleep(0.05 if job_type == 'dataset' else 10)
+    monkeypatch.setattr(handler, 'dispatch', dispatch)
+    monkeypatch.setattr(handler, 'in_flight', {})
+    monkeypatch.setattr(handler, 'draining', False)
+    monkeypatch.setattr(handler, 'background_tasks', set())
+    return config
+
+def test_drain(config, delivery):
+    messages = [FEGAMessage(delivery(n, {'type': job_type}))
+                for n, job_type in [(1, 'dataset'), (2, 'dataset'), (3, 'slow')]]
+
+    async def do_work(message): # as in main
+        task = asyncio.current_task()
+        handler.in_flight[task] = False
+        try:
+            await handler.work(config, message)
+        finally:
+            handler.in_flight.pop(task, None)
+
+    async def scenario():
+        for message in messages:
+            asyncio.create_task(do_work(message))
+        await asyncio.sleep(0.01) # 1 and 3 started, 2 waits for its slot
+        handler.run_in_background(handler.shutdown(config))
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.create_task(scenario())
+        loop.call_later(5, loop.stop) # in case it does not stop
+        loop.run_forever()
+    finally:
+        loop.close()
+
+    assert messages[0].channel.calls == [('ack', 1)] # finished
+    assert messages[1].channel.calls == [('nack', 2, True)] # not started: requeued
+    assert messages[2].channel.calls == [('nack', 3, True)] # interrupted after the drain timeout
+    assert config.mq.calls == ['stop_consuming', 'close']
+    assert config.db.calls == ['close']
+    assert handler.in_flight == {}
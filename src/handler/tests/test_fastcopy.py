@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from code.utils import fastcopy
+from code.utils.exceptions import FEGASystemError
+
+DATA = os.urandom(3 * 1024 * 1024 + 17)
+
+@pytest.fixture
+def files(tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(DATA)
+    with open(src, 'rb') as infile, open(tmp_path / 'dst', 'wb') as outfile:
+        yield infile.fileno(), outfile.fileno(), tmp_path / 'dst'
+
+@pytest.mark.parametrize('method', ['auto', *fastcopy.METHODS])
+def test_copies_the_range(files, method):
+    infd, outfd, dst = files
+    if method != 'buffered' and not hasattr(os, method):
+        pytest.skip(f'No {method} here')
+    os.write(outfd, b'header')
+    assert fastcopy.copy_range(infd, outfd, 100, len(DATA) - 100, method=method) in fastcopy.METHODS
+    assert dst.read_bytes() == b'header' + DATA[100:]
+
+def test_falls_back_when_a_method_stops_short(files, monkeypatch):
+    infd, outfd, dst = files
+    calls = []
+    def copy_file_range(src, dst, count, offset_src):
+        calls.append(offset_src)
+        if offset_src: # some file systems return 0 instead of an error
+            return 0
+        return os.write(dst, os.pread(src, 1000, offset_src))
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range, raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    assert fastcopy.copy_range(infd, outfd, 0, len(DATA)) == 'buffered'
+    assert calls == [0, 1000]
+    assert dst.read_bytes() == DATA
+
+@pytest.mark.parametrize('method', ['auto', 'buffered'])
+def test_raises_on_a_short_copy(files, method):
+    infd, outfd, _ = files
+    with pytest.raises(FEGASystemError):
+        fastcopy.copy_range(infd, outfd, 0, len(DATA) + 1, method=method) # beyond EOF
+
+def test_raises_when_copy_file_range_copies_nothing(files, monkeypatch):
+    infd, outfd, _ = files
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    with pytest.raises(FEGASystemError):
+        fastcopy.copy_range(infd, outfd, 0, len(DATA), method='copy_file_range')
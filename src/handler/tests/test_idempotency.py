@@ -0,0 +1,76 @@
+import asyncio
+import json
+
+import pytest
+
+from code.utils import idempotency
+from code.utils.exceptions import TransientError
+
+STATEMENTS = """
+[db]
+processed_message_query = SELECT * FROM public.processed_message($1)
+record_processed_message_query = SELECT * FROM public.record_processed_message($1, $2, $3, $4)
+"""
+
+class RecordingDB:
+    """The processed_message_table, in memory."""
+    def __init__(self):
+        self.rows = {}
+        self.calls = []
+
+    async def fetchval(self, stmt, *args):
+        self.calls.append(stmt)
+        if stmt == 'processed_message_query':
+            return self.rows.get(args[0])
+        if stmt == 'record_processed_message_query':
+            key, _, _, result = args
+            self.rows[key] = result
+
+@pytest.fixture
+def cache(make_config):
+    config = make_config(STATEMENTS)
+    config._db = RecordingDB()
+    return config.idempotency
+
+COMPLETED = {'routing_key': 'files.verified', 'message': {'filepath': 'a.c4gh'}}
+
+def test_records_completed_jobs(cache):
+    key = cache.key('corr', 'ingest', b'{}')
+    assert asyncio.run(cache.record(key, 'ingest', 'corr', COMPLETED))
+    assert asyncio.run(cache.lookup(key)) == COMPLETED
+    cache.lru.clear()
+    assert asyncio.run(cache.lookup(key)) == COMPLETED # from the database
+
+@pytest.mark.parametrize('result', [None, {}, {'routing_key': None}])
+def test_does_not_record_unfinished_jobs(cache, result):
+    # eg AlreadyInProgress, or cancelled: the redelivery must be processed again
+    key = cache.key('corr', 'ingest', b'{}')
+    assert not asyncio.run(cache.record(key, 'ingest', 'corr', result))
+    assert cache.conf.db.calls == []
+    assert key not in cache.lru
+    assert asyncio.run(cache.lookup(key)) is None
+
+def test_ignores_empty_recorded_results(cache):
+    key = cache.key('corr', 'ingest', b'{}')
+    cache.conf.db.rows[key] = json.dumps({}) # recorded by an earlier version
+    assert asyncio.run(cache.lookup(key)) is None
+    assert key not in cache.lru
+
+def test_key_depends_on_the_payload(cache):
+    assert cache.key('corr', 'ingest', b'a') != cache.key('corr', 'ingest', b'b')
+    assert cache.key('corr', 'ingest', b'a') != cache.key('corr', 'accession', b'a')
+
+class FailingDB:
+    async def fetchval(self, stmt, *args):
+        raise OSError('connection lost')
+
+def test_lookup_failure_is_transient(cache):
+    cache.conf._db = FailingDB()
+    with pytest.raises(TransientError): # requeued
+        asyncio.run(cache.lookup(cache.key('corr', 'ingest', b'{}')))
+
+def test_record_failure_does_not_fail_the_job(cache):
+    cache.conf._db = FailingDB()
+    key = cache.key('corr', 'ingest', b'{}')
+    assert not asyncio.run(cache.record(key, 'ingest', 'corr', COMPLETED))
+    assert asyncio.run(cache.lookup(key)) == COMPLETED # still skipped by this process
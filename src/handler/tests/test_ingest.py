@@ -0,0 +1,69 @@
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+from code.handlers import ingest
+from code.utils import staging, exceptions
+
+DATA = os.urandom(5 * 65536 + 123) # a few segments, and a partial one
+
+@pytest.fixture
+def config(make_config, keys, tmp_path, publisher):
+    config = make_config(keys + f"""
+    [inbox]
+    location = {tmp_path}/inbox/%s
+
+    [staging]
+    location = {tmp_path}/staging/%s
+
+    [ingest]
+    read_ahead = 2
+    decrypt_workers = 2
+    decrypt_batch = 2
+    """)
+    config._mq = publisher
+    return config
+
+def test_ingest(config, encrypt, tmp_path, job_message):
+    inbox_file = encrypt(tmp_path / 'inbox' / 'jane' / 'dir' / 'file.c4gh', DATA)
+    result = asyncio.run(ingest.execute(config, job_message({'type': 'ingest', 'user': 'jane', 'filepath': '/dir/file.c4gh'})))
+
+    checksums = [{'type': 'sha256', 'value': hashlib.sha256(DATA).hexdigest()}]
+    assert result['routing_key'] == 'files.verified'
+    assert result['message']['decrypted_checksums'] == checksums
+    assert config.mq.published == [('files.verified', result['message'])]
+
+    # The staging file is a copy of the inbox file
+    staging_file = tmp_path / 'staging' / 'jane' / 'dir' / 'file.c4gh'
+    encrypted = inbox_file.read_bytes()
+    assert staging_file.read_bytes() == encrypted
+
+    info = staging.load_info(config, str(staging_file))
+    payload = encrypted[info['header_size']:]
+    assert info['payload_size'] == len(payload)
+    assert info['payload_checksum'] == hashlib.sha256(payload).hexdigest()
+    assert info['decrypted_checksum'] == checksums[0]['value']
+
+def test_corrupted_payload(config, encrypt, tmp_path, job_message):
+    inbox_file = encrypt(tmp_path / 'inbox' / 'jane' / 'file.c4gh', DATA)
+    encrypted = bytearray(inbox_file.read_bytes())
+    encrypted[-100] ^= 1
+    inbox_file.write_bytes(encrypted)
+
+    with pytest.raises(exceptions.Crypt4GHPayloadDecryptionError):
+        asyncio.run(ingest.execute(config, job_message({'type': 'ingest', 'user': 'jane', 'filepath': 'file.c4gh'})))
+    assert not (tmp_path / 'staging' / 'jane' / 'file.c4gh').exists() # cleaned
+    assert config.mq.published == []
+
+def test_failing_stage_cancels_the_others():
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError('boom')
+    waiting = asyncio.Queue(maxsize=1)
+    async def run():
+        # would wait forever for a segment
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(ingest.run_stages(failing(), waiting.get()), 5)
+    asyncio.run(run())
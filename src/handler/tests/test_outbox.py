@@ -0,0 +1,142 @@
+import os
+import asyncio
+import socket
+
+import pytest
+
+from code.utils import outbox
+
+@pytest.fixture
+def config(make_config, tmp_path):
+    return make_config(f"""
+    [outbox]
+    location = {tmp_path}/outbox/{{hostname}}.sqlite
+    idle_interval = 0.05
+    backoff_min = 0.01
+    backoff_max = 0.02
+    """)
+
+class Broker:
+    """Confirming the messages, except the ones listed in nack."""
+    def __init__(self, nack=()):
+        self.received = []
+        self.nack = set(nack)
+
+    async def publish_many(self, messages, exchange):
+        results = []
+        for message, routing_key, correlation_id in messages:
+            self.received.append((exchange, routing_key, message, correlation_id))
+            key = message['n'] if isinstance(message, dict) else message
+            results.append(key not in self.nack)
+        return results
+
+async def relay_until(box, broker, count, timeout=5):
+    async def received():
+        while len(broker.received) < count:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05) # let it delete the confirmed ones
+    task = asyncio.create_task(box.relay(broker.publish_many))
+    try:
+        await asyncio.wait_for(received(), timeout)
+    finally:
+        task.cancel()
+
+async def pending(box):
+    return [row[0] for row in await box._run(box._fetch, 100)]
+
+
+def test_disabled_without_location(make_config):
+    config = make_config('')
+    assert not config.outbox.enabled
+    assert config.outbox.path is None
+
+def test_location_required_when_enabled(make_config):
+    config = make_config("""
+    [outbox]
+    enabled = yes
+    """)
+    with pytest.raises(ValueError):
+        config.outbox
+
+def test_per_instance_location(config, tmp_path):
+    assert config.outbox.enabled
+    assert config.outbox.path == tmp_path / 'outbox' / f'{socket.gethostname()}.sqlite'
+
+def test_one_process_per_file(config, make_config):
+    config.outbox._open()
+    other = outbox.Outbox(config)
+    with pytest.raises(ValueError):
+        other._open()
+
+def test_relay_in_order(config):
+    broker = Broker()
+    async def run():
+        box = config.outbox
+        for n in range(5):
+            await box.append('cega', 'files.verified', {'n': n}, correlation_id=f'c{n}')
+        await box.append('lega', 'system.error', 'plain text')
+        await relay_until(box, broker, 6)
+        return await pending(box)
+    assert asyncio.run(run()) == []
+    assert [m for _, _, m, _ in broker.received] == [{'n': n} for n in range(5)] + [b'plain text']
+    assert broker.received[0] == ('cega', 'files.verified', {'n': 0}, 'c0')
+    assert broker.received[-1][0] == 'lega'
+
+def test_unconfirmed_messages_are_retried(config):
+    broker = Broker(nack={1})
+    async def run():
+        box = config.outbox
+        for n in range(3):
+            await box.append('cega', 'files.verified', {'n': n})
+        await relay_until(box, broker, 4) # the 3, and the retry of the 2nd
+        broker.nack.clear()
+        await relay_until(box, broker, len(broker.received) + 1)
+        return await pending(box)
+    assert asyncio.run(run()) == []
+    assert [m['n'] for _, _, m, _ in broker.received].count(1) >= 2
+
+def test_replay_after_crash(config):
+    # A worker stores the messages, and dies before relaying them
+    pid = os.fork()
+    if pid == 0:
+        try:
+            async def append():
+                for n in range(3):
+                    await config.outbox.append('cega', 'files.completed', {'n': n})
+            asyncio.run(append())
+        finally:
+            os._exit(0) # no cleanup
+    os.waitpid(pid, 0)
+
+    # The restarted worker sends them
+    broker = Broker()
+    async def run():
+        box = outbox.Outbox(config)
+        await relay_until(box, broker, 3)
+        return await pending(box)
+    assert asyncio.run(run()) == []
+    assert [m['n'] for _, _, m, _ in broker.received] == [0, 1, 2]
+
+def test_replay_after_crash_while_relaying(config):
+    # The broker confirmed, but the worker died before removing them from the outbox
+    pid = os.fork()
+    if pid == 0:
+        try:
+            async def crash(messages, exchange):
+                os._exit(0)
+            async def run():
+                for n in range(2):
+                    await config.outbox.append('cega', 'files.completed', {'n': n})
+                await config.outbox.relay(crash)
+            asyncio.run(run())
+        finally:
+            os._exit(1)
+    os.waitpid(pid, 0)
+
+    broker = Broker()
+    async def run():
+        box = outbox.Outbox(config)
+        await relay_until(box, broker, 2)
+        return await pending(box)
+    assert asyncio.run(run()) == [] # sent again: at least once
+    assert [m['n'] for _, _, m, _ in broker.received] == [0, 1]
@@ -0,0 +1,124 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from code.utils import routing
+
+CONSUMERS = """
+[broker]
+queue = from_cega
+consumers = files, metadata
+
+[consumer:files]
+queue = jobs.files
+job_types = ingest, accession
+prefetch_count = 4
+workers = 2
+
+[consumer:metadata]
+job_types = *
+prefetch_count = 50
+"""
+
+@pytest.fixture
+def config(make_config):
+    return make_config(CONSUMERS)
+
+def test_load(config):
+    files, metadata = routing.load(config)
+    assert (files.queue, files.job_types, files.prefetch_count, files.workers) == ('jobs.files', ['ingest', 'accession'], 4, 2)
+    assert (metadata.queue, metadata.job_types, metadata.prefetch_count, metadata.workers) == ('jobs.metadata', ['*'], 50, 50)
+
+def test_no_consumers(make_config):
+    assert routing.load(make_config('[broker]\nqueue = from_cega\n')) == []
+
+@pytest.mark.parametrize('job_type, name', [
+    ('ingest', 'files'),
+    ('accession', 'files'),
+    ('dataset', 'metadata'),
+    (None, 'metadata'), # invalid messages are reported by the default consumer
+])
+def test_pick(config, job_type, name):
+    assert routing.pick(routing.load(config), job_type).name == name
+
+def test_pick_without_default(make_config):
+    config = make_config(CONSUMERS.replace('job_types = *', 'job_types = dataset'))
+    assert routing.pick(routing.load(config), 'user').name == 'metadata' # the last one
+
+def test_peek_job_type():
+    assert routing.peek_job_type(SimpleNamespace(body=b'{"type": "ingest"}')) == 'ingest'
+    assert routing.peek_job_type(SimpleNamespace(body=b'not json')) is None
+
+
+class MQ:
+    def __init__(self, reachable=True):
+        self.consumers = {} # queue -> (on_message, prefetch_count)
+        self.forwarded = []
+        self.reachable = reachable
+    async def consume(self, on_message, queue=None, prefetch_count=None, declare=False):
+        self.consumers[queue or 'from_cega'] = (on_message, prefetch_count)
+    async def forward(self, message, queue):
+        self.forwarded.append((queue, message.body))
+        return self.reachable
+
+def test_router_forwards_to_the_consumer_queues(config, delivery):
+    config._mq = mq = MQ()
+    asyncio.run(routing.start(config, None, routing.load(config)))
+    assert {queue: prefetch for queue, (_, prefetch) in mq.consumers.items()} == {
+        'jobs.files': 4, 'jobs.metadata': 50, 'from_cega': 100,
+    }
+
+    route, _ = mq.consumers['from_cega']
+    messages = [delivery(1, {'type': 'ingest'}), delivery(2, {'type': 'dataset'})]
+    for message in messages:
+        asyncio.run(route(message))
+    assert [queue for queue, _ in mq.forwarded] == ['jobs.files', 'jobs.metadata']
+    assert [message.channel.calls for message in messages] == [[('ack', 1)], [('ack', 2)]]
+
+def test_router_requeues_when_not_forwarded(config, delivery):
+    config._mq = mq = MQ(reachable=False)
+    asyncio.run(routing.start(config, None, routing.load(config)))
+    route, _ = mq.consumers['from_cega']
+    message = delivery(1, {'type': 'ingest'})
+    asyncio.run(route(message))
+    assert message.channel.calls == [('nack', 1, True)]
+
+def test_workers_per_consumer(make_config, delivery):
+    config = make_config(CONSUMERS + '[jobs]\nprioritized = accession\n')
+    config._mq = mq = MQ()
+    running = peak = 0
+    async def on_message(message):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        await routing.start(config, on_message, routing.load(config))
+        work, _ = mq.consumers['jobs.files']
+        await asyncio.gather(*(work(delivery(n, {'type': 'ingest'})) for n in range(5)))
+    asyncio.run(run())
+    assert peak == 2
+
+def test_prioritized_jobs_are_picked_by_the_scheduler(make_config, delivery):
+    # As shipped: 4 workers, but the scheduler picks the ingestions among the 20 prefetched ones
+    config = make_config(CONSUMERS.replace('prefetch_count = 4', 'prefetch_count = 20').replace('workers = 2', 'workers = 4')
+                         + '[jobs]\ningest = 2\n')
+    config._mq = mq = MQ()
+    started = []
+    async def on_message(message):
+        size = json.loads(message.body)['size']
+        async with config.scheduler.slot('ingest', size=size):
+            started.append(size)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await routing.start(config, on_message, routing.load(config))
+        work, _ = mq.consumers['jobs.files']
+        sizes = [2**30] * 18 + [10, 20] # the small files last
+        await asyncio.gather(*(work(delivery(n, {'type': 'ingest', 'size': size})) for n, size in enumerate(sizes)))
+    asyncio.run(run())
+    assert started[2:4] == [10, 20] # right after the first two
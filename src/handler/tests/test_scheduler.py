@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import pytest
+
+from code.utils.scheduler import PrioritySlot
+
+MB, GB = 1024**2, 1024**3
+
+JOBS = """
+[jobs]
+max_in_flight = 2
+ingest = 1
+"""
+
+@pytest.fixture
+def scheduler(make_config):
+    return make_config(JOBS).scheduler
+
+async def job(scheduler, job_type, log, size=0, duration=0.01):
+    async with scheduler.slot(job_type, size=size):
+        log.append(('start', job_type, size))
+        await asyncio.sleep(duration)
+        log.append(('end', job_type, size))
+
+def max_running(log, job_type=None):
+    running = peak = 0
+    for event, t, _ in log:
+        if job_type and t != job_type:
+            continue
+        running += 1 if event == 'start' else -1
+        peak = max(peak, running)
+    return peak
+
+def test_limits_per_job_type(scheduler):
+    log = []
+    async def run():
+        await asyncio.gather(*(job(scheduler, 'ingest', log) for _ in range(3)),
+                             *(job(scheduler, 'dataset', log) for _ in range(4)))
+    asyncio.run(run())
+    assert max_running(log, 'ingest') == 1
+    assert max_running(log, 'dataset') == 2
+
+def test_light_jobs_are_not_blocked_by_heavy_ones(scheduler):
+    log = []
+    async def run():
+        heavy = asyncio.create_task(job(scheduler, 'ingest', log, duration=0.5))
+        await asyncio.sleep(0.01)
+        await asyncio.wait_for(job(scheduler, 'dataset', log), 0.2)
+        heavy.cancel()
+    asyncio.run(run())
+    assert log[:3] == [('start', 'ingest', 0), ('start', 'dataset', 0), ('end', 'dataset', 0)]
+
+def test_cancelled_waiter_frees_its_place(scheduler):
+    log = []
+    async def run():
+        first = asyncio.create_task(job(scheduler, 'ingest', log, duration=0.05))
+        await asyncio.sleep(0)
+        waiting = asyncio.create_task(job(scheduler, 'ingest', log))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        await first
+        await asyncio.wait_for(job(scheduler, 'ingest', log), 1) # the slot is free again
+    asyncio.run(run())
+    assert log.count(('start', 'ingest', 0)) == 2
+
+
+# Size-aware priorities
+
+def wake_order(slot, waiters):
+    """The order in which the waiters (size, seconds waited) get the slot."""
+    now = time.monotonic()
+    order = []
+    async def run():
+        tasks = []
+        for size, waited in waiters:
+            task = asyncio.create_task(slot.acquire(size))
+            await asyncio.sleep(0)
+            slot.waiters[-1][1] = now - waited
+            task.add_done_callback(lambda _, size=size: order.append(size))
+            tasks.append(task)
+        for _ in waiters:
+            slot.release()
+            await asyncio.sleep(0)
+    asyncio.run(run())
+    return order
+
+def test_smallest_first():
+    slot = PrioritySlot(0)
+    assert wake_order(slot, [(10 * GB, 0), (MB, 0), (GB, 0)]) == [MB, GB, 10 * GB]
+
+def test_aging():
+    slot = PrioritySlot(0, aging=60)
+    # waiting 10 minutes is worth 10 doublings: more than the 1024 times larger file
+    assert wake_order(slot, [(GB, 11 * 60), (MB, 0)]) == [GB, MB]
+    assert wake_order(slot, [(GB, 9 * 60), (MB, 0)]) == [MB, GB]
+
+def test_starving_jobs_go_first():
+    slot = PrioritySlot(0, aging=1e9, max_wait=3600)
+    assert wake_order(slot, [(MB, 0), (10 * GB, 3601), (GB, 3700)]) == [GB, 10 * GB, MB]
+
+def test_arrival_order_when_not_prioritized(make_config):
+    scheduler = make_config(JOBS + 'dataset = 1\nprioritized = ingest\n').scheduler
+    log = []
+    async def run():
+        await asyncio.gather(job(scheduler, 'dataset', log, size=3),
+                             job(scheduler, 'dataset', log, size=2),
+                             job(scheduler, 'dataset', log, size=1))
+    asyncio.run(run())
+    assert [size for event, _, size in log if event == 'start'] == [3, 2, 1]
@@ -0,0 +1,59 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+
+from code.utils import schemas
+from code.utils.exceptions import InvalidBrokerMessage
+
+DOC = Path(__file__).resolve().parents[1] / 'Messages format.md'
+
+def documented_examples():
+    """The JSON examples of the messages documentation."""
+    blocks = re.findall(r'```json\n(.*?)```', DOC.read_text(), re.S)
+    return [json.loads(block) for block in blocks]
+
+@pytest.fixture(scope='module', autouse=True)
+def validators():
+    class NoConf:
+        def get(self, section, option, fallback=None):
+            return fallback
+    schemas.load(NoConf())
+
+
+@pytest.mark.parametrize('message', documented_examples(), ids=lambda m: m.get('type', 'unknown'))
+def test_documented_examples_are_valid(message):
+    schemas.validate(message)
+
+def test_consumed_types_have_a_schema():
+    documented = {m.get('type') for m in documented_examples()}
+    for job_type in ('ingest', 'accession', 'cancel', 'mapping', 'release', 'deprecate',
+                     'permission', 'permission.deleted', 'dac', 'dac.dataset', 'dac.members',
+                     'password.updated', 'keys.updated', 'contact.updated'):
+        assert job_type in schemas._validators, job_type
+        if job_type != 'deprecate': # not documented
+            assert job_type in documented, job_type
+
+def test_permission_with_no_expiration():
+    message = next(m for m in documented_examples() if m.get('type') == 'permission')
+    for expires_at in ('None', None, '2030-01-01T00:00:00+00:00'):
+        schemas.validate(dict(message, expires_at=expires_at))
+
+@pytest.mark.parametrize('job_type, field', [('permission', 'user'),
+                                             ('permission', 'dataset_id'),
+                                             ('dac.members', 'users'),
+                                             ('mapping', 'accession_ids')])
+def test_missing_field_is_rejected(job_type, field):
+    message = next(m for m in documented_examples() if m.get('type') == job_type)
+    message = {k: v for k, v in message.items() if k != field}
+    with pytest.raises(InvalidBrokerMessage):
+        schemas.validate(message)
+
+def test_not_an_object():
+    with pytest.raises(InvalidBrokerMessage):
+        schemas.validate(['permission'])
+
+def test_enabled_by_default(make_config):
+    assert schemas.enabled(make_config(''))
+    assert not schemas.enabled(make_config('[broker]\nvalidate_messages = no\n'))
@@ -0,0 +1,97 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from code.utils.bloom import BloomFilter
+from code.utils.exceptions import SessionKeyAlreadyUsedError
+
+STATEMENTS = """
+[db]
+session_keys_query = SELECT * FROM public.session_keys_since($1)
+session_keys_used_query = SELECT * FROM public.session_keys_used($1, $2, $3)
+session_keys_save_query = SELECT * FROM public.save_session_keys($1, $2, $3)
+"""
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    items = [os.urandom(32) for _ in range(1000)]
+    for item in items:
+        bloom.add(item)
+    assert all(item in bloom for item in items) # no false negatives
+    false_positives = sum(os.urandom(32) in bloom for _ in range(10000))
+    assert false_positives < 300 # about 1%
+
+
+class DB:
+    """The session keys table, in memory."""
+    def __init__(self):
+        self.rows = {} # checksum -> (user, filepath, created_at)
+        self.calls = []
+
+    async def iterate(self, stmt, since):
+        assert stmt == 'session_keys_query'
+        for checksum, (_, _, created_at) in list(self.rows.items()):
+            if since is None or created_at >= since:
+                yield {'checksum': checksum, 'created_at': created_at}
+
+    def _used(self, checksums, user, filepath):
+        return [c for c in checksums if c in self.rows and self.rows[c][:2] != (user, filepath)]
+
+    async def fetchval(self, stmt, checksums, user, filepath):
+        self.calls.append(stmt)
+        used = self._used(checksums, user, filepath)
+        if stmt == 'session_keys_save_query' and not used:
+            for c in checksums:
+                self.rows.setdefault(c, (user, filepath, datetime.now()))
+        return used
+
+@pytest.fixture
+def registry(make_config, keys):
+    config = make_config(keys + STATEMENTS + """
+    [session_keys]
+    capacity = 1000
+    """)
+    config._db = DB()
+    return config.session_keys
+
+def test_new_keys_do_not_query_the_database(registry):
+    checksums = [registry.digest(os.urandom(32))]
+    asyncio.run(registry.check(checksums, 'jane', 'a.c4gh'))
+    assert registry.conf.db.calls == []
+
+def test_reused_key(registry):
+    checksums = [registry.digest(os.urandom(32))]
+    asyncio.run(registry.save(checksums, 'jane', 'a.c4gh'))
+    asyncio.run(registry.check(checksums, 'jane', 'a.c4gh')) # the same file again
+    with pytest.raises(SessionKeyAlreadyUsedError):
+        asyncio.run(registry.check(checksums, 'jane', 'b.c4gh'))
+
+def test_keys_saved_by_other_instances(registry):
+    checksum = registry.digest(os.urandom(32))
+    registry.conf.db.rows[checksum] = ('john', 'x.c4gh', datetime.now() - timedelta(days=1))
+    asyncio.run(registry.warm())
+    with pytest.raises(SessionKeyAlreadyUsedError):
+        asyncio.run(registry.check([checksum], 'jane', 'b.c4gh'))
+
+    later = registry.digest(os.urandom(32))
+    registry.conf.db.rows[later] = ('john', 'y.c4gh', datetime.now())
+    asyncio.run(registry.refresh())
+    assert bytes.fromhex(later) in registry.bloom
+
+def test_race_caught_on_save(registry):
+    checksum = registry.digest(os.urandom(32))
+    asyncio.run(registry.check([checksum], 'jane', 'b.c4gh')) # not seen yet
+    registry.conf.db.rows[checksum] = ('john', 'x.c4gh', datetime.now()) # saved meanwhile, elsewhere
+    with pytest.raises(SessionKeyAlreadyUsedError):
+        asyncio.run(registry.save([checksum], 'jane', 'b.c4gh'))
+
+def test_digest_is_keyed(registry):
+    key = os.urandom(32)
+    assert registry.digest(key) == registry.digest(key)
+    assert registry.digest(key) != registry.digest(os.urandom(32))
+
+def test_disabled_without_statements(make_config, keys):
+    config = make_config(keys)
+    assert not config.session_keys.enabled
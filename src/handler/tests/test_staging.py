@@ -0,0 +1,69 @@
+import pytest
+
+from code.utils import staging
+from code.utils.exceptions import FEGASystemError
+from code.handlers import clean_staging
+
+INFO = {'header_size': 124, 'payload_size': 65564, 'payload_checksum': 'ab' * 32}
+
+@pytest.fixture
+def config(make_config, keys, tmp_path):
+    return make_config(keys + f"""
+    [staging]
+    location = {tmp_path}/staging/%s
+    """)
+
+def staged(tmp_path, user, name):
+    path = tmp_path / 'staging' / user / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'crypt4gh')
+    return path
+
+def test_roundtrip(config, tmp_path):
+    path = staged(tmp_path, 'jane', 'dir/file.c4gh')
+    staging.save_info(config, str(path), INFO)
+    assert staging.load_info(config, str(path)) == INFO
+
+def test_no_record(config, tmp_path):
+    assert staging.load_info(config, str(staged(tmp_path, 'jane', 'file.c4gh'))) is None
+
+def test_outside_the_users_tree(config, tmp_path):
+    path = staged(tmp_path, 'jane', 'file.c4gh')
+    staging.save_info(config, str(path), INFO)
+    assert not list((tmp_path / 'staging' / 'jane').glob('.*'))
+    assert staging.info_path(config, str(path)).parent == tmp_path / 'staging' / '.info'
+
+def test_uploads_do_not_collide_with_records(config, tmp_path):
+    # The old sidecar of foo was .foo.info, next to it
+    foo = staged(tmp_path, 'jane', 'foo')
+    sidecar_like = staged(tmp_path, 'jane', '.foo.info')
+    staging.save_info(config, str(foo), INFO)
+    staging.save_info(config, str(sidecar_like), dict(INFO, payload_size=1))
+    assert staging.load_info(config, str(foo)) == INFO
+    assert sidecar_like.read_bytes() == b'crypt4gh' # untouched
+
+    clean_staging(config, {'user': 'jane', 'filepath': '.foo.info'})
+    assert staging.load_info(config, str(foo)) == INFO
+
+def test_tampered_record(config, tmp_path):
+    path = staged(tmp_path, 'jane', 'file.c4gh')
+    staging.save_info(config, str(path), INFO)
+    record = staging.info_path(config, str(path))
+    record.write_text(record.read_text().replace('65564', '65565'))
+    with pytest.raises(FEGASystemError):
+        staging.load_info(config, str(path))
+
+def test_record_bound_to_its_path(config, tmp_path):
+    a = staged(tmp_path, 'jane', 'a.c4gh')
+    b = staged(tmp_path, 'jane', 'b.c4gh')
+    staging.save_info(config, str(a), INFO)
+    staging.info_path(config, str(a)).rename(staging.info_path(config, str(b)))
+    with pytest.raises(FEGASystemError):
+        staging.load_info(config, str(b))
+
+def test_cleaned_with_the_staging_file(config, tmp_path):
+    path = staged(tmp_path, 'jane', 'dir/file.c4gh')
+    staging.save_info(config, str(path), INFO)
+    clean_staging(config, {'user': 'jane', 'filepath': '/dir/file.c4gh'})
+    assert not path.exists()
+    assert staging.load_info(config, str(path)) is None
@@ -0,0 +1,67 @@
+import os
+import signal
+import time
+
+import pytest
+
+from code import supervisor
+
+@pytest.fixture
+def config(make_config, keys, tmp_path):
+    return make_config(keys + f"""
+    [staging]
+    location = {tmp_path}/staging/%s
+
+    [metrics]
+    port = 9100
+
+    [outbox]
+    location = {tmp_path}/outbox/{{hostname}}.sqlite
+
+    [supervisor]
+    min_uptime = 0
+    """)
+
+def test_prepare_loads_the_keys(config):
+    s = supervisor.Supervisor(config, 2, target=None)
+    s.prepare()
+    assert len(config.service_key.private()) == 32
+    assert len(config.master_pubkey) == 32
+
+def test_prepare_resolves_the_connections(make_config, keys, tmp_path):
+    secret = tmp_path / 'db.secret'
+    secret.write_bytes(b'postgres://lega:secret@db:5432/ega')
+    config = make_config(keys + f"""
+    [db]
+    connection = secret://{secret}
+
+    [broker]
+    connection = amqp://admin:secret@mq:5672/%2F
+    """)
+    supervisor.Supervisor(config, 2, target=None).prepare()
+    assert not secret.exists() # read once, by the parent
+    for _ in range(2): # and then by each worker
+        assert config.getsensitive('db', 'connection', raw=True) == 'postgres://lega:secret@db:5432/ega'
+        assert config.getsensitive('broker', 'connection', raw=True) == 'amqp://admin:secret@mq:5672/%2F'
+
+def test_worker_config(config):
+    s = supervisor.Supervisor(config, 2, target=None)
+    config = s.worker_config(1)
+    assert config.getint('metrics', 'port') == 9100 + 1 + 1
+    assert config.outbox.path.name.endswith('.1.sqlite')
+
+def test_run_restarts_and_stops(config, tmp_path):
+    started = tmp_path / 'started'
+
+    def target(config):
+        with open(started, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+        if len(started.read_text().splitlines()) >= 3: # a restart happened: stop everything
+            os.kill(os.getppid(), signal.SIGTERM)
+            time.sleep(5) # until the SIGTERM forwarded by the parent
+        # else: exit, to be restarted
+
+    s = supervisor.Supervisor(config, 2, target)
+    s.run()
+    assert s.restarts >= 1
+    assert not s.workers
@@ -0,0 +1,119 @@
+import asyncio
+import hashlib
+import os
+from datetime import time
+
+import pytest
+
+from code.handlers import verify
+from code.utils import exceptions
+
+PAYLOAD = os.urandom(10 * 65536 + 7)
+HEADER = b'h' * 124
+
+@pytest.fixture
+def files(tmp_path):
+    source = tmp_path / 'staging.c4gh'
+    source.write_bytes(HEADER + PAYLOAD)
+    replicas = [tmp_path / 'vault', tmp_path / 'backup']
+    for path in replicas:
+        path.write_bytes(PAYLOAD)
+    return source, replicas
+
+def run(make_config, policy, source, replicas, **settings):
+    config = make_config('[verification]\npolicy = ' + policy + '\n'
+                         + ''.join(f'{k} = {v}\n' for k, v in settings.items()))
+    return asyncio.run(verify.execute(config, [str(p) for p in replicas], hashlib.sha256(PAYLOAD).hexdigest(),
+                                      str(source), len(HEADER), len(PAYLOAD)))
+
+@pytest.mark.parametrize('policy', ['full', 'direct', 'sampled'])
+def test_passes(make_config, files, policy):
+    assert run(make_config, policy, *files) == 'passed'
+
+@pytest.mark.parametrize('policy', ['full', 'direct'])
+def test_detects_corruption(make_config, files, policy):
+    source, replicas = files
+    corrupted = bytearray(PAYLOAD)
+    corrupted[12345] ^= 1
+    replicas[1].write_bytes(corrupted)
+    with pytest.raises(exceptions.ChecksumsNotMatching):
+        run(make_config, policy, source, replicas)
+
+def test_sampled_detects_corruption_in_a_sample(make_config, files):
+    source, replicas = files
+    corrupted = bytearray(PAYLOAD)
+    corrupted[-1] ^= 1 # the last range is always sampled
+    replicas[0].write_bytes(corrupted)
+    with pytest.raises(exceptions.ChecksumsNotMatching):
+        run(make_config, 'sampled', source, replicas, samples=2, sample_size=4096)
+
+def test_sampled_detects_truncation(make_config, files):
+    source, replicas = files
+    replicas[0].write_bytes(PAYLOAD[:-1])
+    with pytest.raises(exceptions.ChecksumsNotMatching):
+        run(make_config, 'sampled', source, replicas)
+
+def test_deferred_is_pending(make_config, files):
+    source, replicas = files
+    for path in replicas:
+        path.write_bytes(b'not even read')
+    assert run(make_config, 'deferred', source, replicas) == 'pending'
+
+def test_invalid_policy(make_config, files):
+    with pytest.raises(ValueError):
+        run(make_config, 'none', *files)
+
+@pytest.mark.parametrize('window, now, expected', [
+    ('01:00-05:00', time(3, 0), True),
+    ('01:00-05:00', time(5, 0), False),
+    ('01:00-05:00', time(0, 59), False),
+    ('22:00-02:00', time(23, 30), True), # over midnight
+    ('22:00-02:00', time(1, 0), True),
+    ('22:00-02:00', time(12, 0), False),
+])
+def test_in_window(window, now, expected):
+    assert verify.in_window(window, now) is expected
+
+def test_deferred_verifications(make_config, tmp_path, monkeypatch):
+    for location in ('vault', 'backup'):
+        (tmp_path / location / 'ok').parent.mkdir()
+        (tmp_path / location / 'ok').write_bytes(PAYLOAD)
+        (tmp_path / location / 'bad').write_bytes(PAYLOAD[1:])
+    config = make_config(f"""
+    [vault]
+    location = {tmp_path}/vault
+    [backup]
+    location = {tmp_path}/backup
+    [verification]
+    deferred_interval = 0.01
+    """)
+    checksum = hashlib.sha256(PAYLOAD).hexdigest()
+
+    class DB:
+        rows = [[{'id': 1, 'stable_id': 'EGAF1', 'relative_path': 'ok', 'payload_checksum': checksum},
+                 {'id': 2, 'stable_id': 'EGAF2', 'relative_path': 'bad', 'payload_checksum': checksum}]]
+        completed = []
+        async def fetch(self, stmt, batch):
+            assert stmt == 'claim_verifications_query'
+            return self.rows.pop() if self.rows else []
+        async def fetchval(self, stmt, *args):
+            assert stmt == 'complete_verification_query'
+            self.completed.append(args[:2])
+
+    class MQ:
+        errors = []
+        async def lega_publish(self, message, routing_key):
+            self.errors.append(message['accession_id'])
+
+    config._db, config._mq = DB(), MQ()
+
+    async def run():
+        task = asyncio.create_task(verify.run_deferred(config))
+        while len(config.db.completed) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    monkeypatch.setattr(verify, 'in_window', lambda window: True) # whenever the test runs
+    asyncio.run(asyncio.wait_for(run(), 5))
+    assert config.db.completed == [(1, 'passed'), (2, 'failed')]
+    assert config.mq.errors == ['EGAF2']
@@ -0,0 +1,66 @@
+-- Benchmark of process_mapping_message, on a dataset of :n files
+--
+-- Run it as superuser (for auto_explain), on a scratch vault DB, for each size:
+--
+--   for n in 10000 100000 1000000; do
+--       psql -X -v n=$n -d ega -f benchmarks/mapping.sql > mapping.$n.log 2>&1
+--   done
+--
+-- It prints the timing and the plans of the statements inside the function,
+-- for the initial mapping, a remapping with 1% of the files changed, and an identical remapping.
+-- Everything is rolled back at the end.
+
+\if :{?n}
+\else
+  \set n 10000
+\endif
+
+\set ON_ERROR_STOP on
+\timing off
+
+SELECT :n / 100 AS churn \gset
+
+SET statement_timeout = 0;
+BEGIN;
+
+-- the files: n, plus the churned ones
+INSERT INTO public.file_table(stable_id)
+SELECT 'EGAF_BENCH_' || i FROM generate_series(1, :n + :churn) AS i;
+
+CREATE TEMP TABLE bench_message ON COMMIT DROP AS
+SELECT 'initial' AS name,
+       jsonb_build_object('type', 'mapping', 'dataset_id', 'EGAD_BENCH',
+                          'accession_ids', jsonb_agg('EGAF_BENCH_' || i)) AS message
+FROM generate_series(1, :n) AS i
+UNION ALL
+SELECT 'churn', -- the first 1% replaced by new files
+       jsonb_build_object('type', 'mapping', 'dataset_id', 'EGAD_BENCH',
+                          'accession_ids', jsonb_agg('EGAF_BENCH_' || i))
+FROM generate_series(1 + :churn, :n + :churn) AS i;
+
+ANALYZE public.file_table;
+
+-- the plans of the statements inside the function
+LOAD 'auto_explain';
+SET auto_explain.log_min_duration = 0;
+SET auto_explain.log_nested_statements = on;
+SET auto_explain.log_analyze = on;
+SET auto_explain.log_buffers = on;
+SET client_min_messages = log;
+
+\timing on
+\echo '=== Initial mapping of' :n 'files'
+SELECT public.process_mapping_message(message) AS inserted FROM bench_message WHERE name = 'initial';
+ANALYZE public.dataset_file_table; -- as autovacuum would have done, by then
+
+\echo '=== Remapping with' :churn 'files changed'
+SELECT public.process_mapping_message(message) AS inserted FROM bench_message WHERE name = 'churn';
+
+\echo '=== Identical remapping'
+SELECT public.process_mapping_message(message) AS inserted FROM bench_message WHERE name = 'churn';
+\timing off
+
+SET client_min_messages = warning;
+SELECT count(*) AS links FROM public.dataset_file_table WHERE dataset_stable_id = 'EGAD_BENCH';
+
+ROLLBACK;
@@ -0,0 +1,81 @@
+-- Benchmark of process_permission_message, for :p permissions granted to the same user
+--
+-- Run it on a scratch vault DB, for example:
+--
+--   psql -X -v p=500 -d ega -f benchmarks/permissions.sql
+--
+-- It prints the timing, and the rows written so far in the user tables (pg_stat_xact_user_tables),
+-- when the same user block comes :p times, :p times again, and then with new keys.
+-- With unchanged user blocks, only the permissions are written.
+-- Everything is rolled back at the end.
+
+\if :{?p}
+\else
+  \set p 500
+\endif
+
+\set ON_ERROR_STOP on
+\timing off
+
+SET statement_timeout = 0;
+SET client_min_messages = warning;
+BEGIN;
+
+CREATE TEMP TABLE bench_user ON COMMIT DROP AS
+SELECT 'initial' AS name, jsonb_build_object(
+         'username', 'bench_user',
+         'full_name', 'Bench User',
+         'email', 'bench_user@example.org',
+         'institution', 'Bench',
+         'country', 'Spain',
+         'password_hash', '$2b$12$IqmF1hxte.zaaPnSliC0duFgFS0U.K2vb/cm6VlbpDa34kvpd9UzS',
+         'keys', jsonb_build_array(
+             jsonb_build_object('type', 'ssh-ed25519',
+                                'key', 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIJC8WIY+VztGShuajXQS5/Wo7TtyFeJ1MuZeAcDY0tiY bench@one'),
+             jsonb_build_object('type', 'ssh-ed25519',
+                                'key', 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAICulsKa6+cTg5YZVK4EhYJ+0DGUpECscEw2quAhzU2Jy bench@two'))
+       ) AS block;
+
+-- the second key replaced
+INSERT INTO bench_user
+SELECT 'new_keys', jsonb_set(block, '{keys,1}',
+                             jsonb_build_object('type', 'ssh', 'key', 'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQ bench@three'))
+FROM bench_user WHERE name = 'initial';
+
+CREATE TEMP VIEW bench_writes AS
+SELECT relname, n_tup_ins AS inserted, n_tup_upd AS updated, n_tup_del AS deleted
+FROM pg_stat_xact_user_tables
+WHERE relname IN ('user_table', 'user_key_table', 'user_password_table', 'dataset_permission_table')
+ORDER BY relname;
+
+\timing on
+\echo '=== ' :p 'permissions, same user block'
+SELECT sum(public.process_permission_message(jsonb_build_object(
+           'type', 'permission', 'dataset_id', 'EGAD_BENCH_' || i, 'user', block,
+           'created_at', now(), 'edited_at', now())))
+FROM bench_user, generate_series(1, :p) AS i
+WHERE name = 'initial';
+\timing off
+SELECT * FROM bench_writes;
+
+\timing on
+\echo '=== ' :p 'permissions again, same user block'
+SELECT sum(public.process_permission_message(jsonb_build_object(
+           'type', 'permission', 'dataset_id', 'EGAD_BENCH_' || i, 'user', block,
+           'created_at', now(), 'edited_at', now())))
+FROM bench_user, generate_series(1, :p) AS i
+WHERE name = 'initial';
+\timing off
+SELECT * FROM bench_writes;
+
+\timing on
+\echo '=== ' :p 'permissions, with a new key'
+SELECT sum(public.process_permission_message(jsonb_build_object(
+           'type', 'permission', 'dataset_id', 'EGAD_BENCH_' || i, 'user', block,
+           'created_at', now(), 'edited_at', now())))
+FROM bench_user, generate_series(1, :p) AS i
+WHERE name = 'new_keys';
+\timing off
+SELECT * FROM bench_writes;
+
+ROLLBACK;
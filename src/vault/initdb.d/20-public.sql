@@ -17,6 +17,11 @@ CREATE TABLE public.user_table
     institution		text,
     country		text, -- NOT NULL,
 
+    -- Local column (not replicated)
+    -- sha256 of the user block of the last permission message (with the password hash and keys),
+    -- to skip the identical ones. Reset to NULL by any other update of the user.
+    digest              bytea,
+
     -- auditing
     created_by_db_user      text NOT NULL DEFAULT CURRENT_USER,
     created_at              timestamp(6) with time zone NOT NULL DEFAULT now(),
@@ -51,3 +51,79 @@ CREATE TABLE private.file_table (
     edited_by_db_user       text NOT NULL DEFAULT CURRENT_USER,
     edited_at               timestamp(6) with time zone NOT NULL DEFAULT now()
 );
+
+
+-----------------------------------------
+-- Verifications of the archived files --
+-----------------------------------------
+
+CREATE TYPE private.verification_method AS ENUM ('full', 'direct', 'sampled', 'deferred');
+CREATE TYPE private.verification_status AS ENUM ('pending', 'running', 'passed', 'failed');
+
+CREATE TABLE private.file_verification_table (
+    id                  bigserial NOT NULL PRIMARY KEY,
+    stable_id           text NOT NULL REFERENCES public.file_table(stable_id),
+    method              private.verification_method NOT NULL,
+    status              private.verification_status NOT NULL,
+    details             text,
+    verified_at         timestamp(6) with time zone,
+
+    -- auditing
+    created_by_db_user      text NOT NULL DEFAULT CURRENT_USER,
+    created_at              timestamp(6) with time zone NOT NULL DEFAULT now(),
+    edited_by_db_user       text NOT NULL DEFAULT CURRENT_USER,
+    edited_at               timestamp(6) with time zone NOT NULL DEFAULT now()
+);
+
+
+------------------
+-- Session keys --
+------------------
+
+-- Keyed hashes of the session keys, to detect their reuse for other files
+CREATE TABLE private.session_key_table (
+    checksum            text NOT NULL PRIMARY KEY,
+    username            text NOT NULL,
+    filepath            text NOT NULL,
+
+    -- auditing
+    created_by_db_user      text NOT NULL DEFAULT CURRENT_USER,
+    created_at              timestamp(6) with time zone NOT NULL DEFAULT now()
+);
+
+
+------------------------
+-- Processed messages --
+------------------------
+
+-- Results of the completed jobs, to skip the redelivered messages
+CREATE TABLE private.processed_message_table (
+    key                 text NOT NULL PRIMARY KEY, -- correlation id, job type and payload digest
+    job_type            text NOT NULL,
+    correlation_id      text,
+    result              jsonb NOT NULL DEFAULT '{}'::jsonb, -- the emitted message, if any
+
+    -- auditing
+    created_by_db_user      text NOT NULL DEFAULT CURRENT_USER,
+    created_at              timestamp(6) with time zone NOT NULL DEFAULT now()
+);
+
+
+--------------
+-- Backfill --
+--------------
+
+-- Staging area of the bulk imports (see handler/code/backfill.py):
+-- the manifest is copied in, then merged into the file and dataset tables, partition by partition.
+-- Unlogged: it is cheap to write, and lost on a crash (the import is then started again).
+CREATE UNLOGGED TABLE private.backfill_table (
+    stable_id           text NOT NULL,
+    relative_path       text NOT NULL,
+    header              bytea NOT NULL,
+    payload_size        bigint NOT NULL,
+    payload_checksum    VARCHAR(128),
+    decrypted_checksum  VARCHAR(128),
+    display_name        text,         -- the inbox path, if known
+    dataset_stable_id   text,         -- one row per dataset, if the file is in several
+    partition           int NOT NULL  -- chosen by the importer
+);
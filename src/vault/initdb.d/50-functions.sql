@@ -62,54 +62,249 @@ END
 $_$;
 
 
+-- Bulk imports: merge the rows copied into private.backfill_table
+-- The datasets first, once (the partitions would otherwise compete for the same rows)
+CREATE OR REPLACE FUNCTION public.merge_backfill_datasets()
+RETURNS bigint
+LANGUAGE plpgsql
+AS $_$
+DECLARE
+	_rows bigint;
+BEGIN
+	INSERT INTO public.dataset_table(stable_id)
+	SELECT DISTINCT dataset_stable_id
+	FROM private.backfill_table
+	WHERE dataset_stable_id IS NOT NULL
+	ORDER BY dataset_stable_id
+	ON CONFLICT ON CONSTRAINT dataset_table_pkey
+	DO NOTHING;
+
+	GET DIAGNOSTICS _rows = ROW_COUNT;
+	RETURN _rows;
+END
+$_$;
+
+-- Then the files and their dataset links, one partition at a time (and the partitions in parallel)
+-- Same rules as upsert_file and process_mapping_message, but set-based
+CREATE OR REPLACE FUNCTION public.merge_backfill(_partition int)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $_$
+DECLARE
+	_rows bigint;
+BEGIN
+	WITH rows AS (
+		SELECT DISTINCT ON (stable_id) *
+		FROM private.backfill_table
+		WHERE partition = _partition
+		ORDER BY stable_id
+	), ins_file AS (
+		INSERT INTO public.file_table AS t(stable_id, filesize, display_name)
+		SELECT stable_id,
+		       payload_size + octet_length(header), -- as in upsert_file
+		       public.extract_name(display_name)
+		FROM rows
+		ON CONFLICT ON CONSTRAINT file_table_pkey
+		DO UPDATE
+		SET filesize=EXCLUDED.filesize,
+		    display_name=EXCLUDED.display_name
+		RETURNING t.stable_id
+	)
+	INSERT INTO private.file_table(stable_id, relative_path, header, payload_size, payload_checksum, decrypted_checksum)
+	SELECT r.stable_id, r.relative_path, r.header, r.payload_size, r.payload_checksum, r.decrypted_checksum
+	FROM rows r
+	INNER JOIN ins_file USING (stable_id)
+	ON CONFLICT DO NOTHING;
+
+	GET DIAGNOSTICS _rows = ROW_COUNT;
+
+	INSERT INTO public.dataset_file_table(dataset_stable_id, file_stable_id)
+	SELECT DISTINCT dataset_stable_id, stable_id
+	FROM private.backfill_table
+	WHERE partition = _partition
+	  AND dataset_stable_id IS NOT NULL
+	ON CONFLICT DO NOTHING;
+
+	RETURN _rows;
+END
+$_$;
+
+
+CREATE OR REPLACE FUNCTION public.record_verification(
+	_accession_id text,
+	_method text,
+	_status text,
+	_details text
+)
+RETURNS bigint
+LANGUAGE plpgsql
+AS $_$
+DECLARE
+	_id bigint;
+BEGIN
+	INSERT INTO private.file_verification_table AS t (stable_id, method, status, details, verified_at)
+	VALUES (_accession_id,
+		_method::private.verification_method,
+		_status::private.verification_status,
+		_details,
+		CASE WHEN _status = 'pending' THEN NULL ELSE now() END)
+	RETURNING t.id INTO _id;
+
+	RETURN _id;
+END
+$_$;
+
+-- Claim some pending verifications (or the ones that have been running for too long)
+-- Concurrent handlers skip the rows already claimed
+CREATE OR REPLACE FUNCTION public.claim_verifications(_limit integer)
+RETURNS TABLE(id bigint, stable_id text, relative_path text, payload_checksum text)
+LANGUAGE plpgsql
+AS $_$
+#variable_conflict use_column
+BEGIN
+	RETURN QUERY
+	WITH claimed AS (
+		SELECT v.id
+		FROM private.file_verification_table v
+		WHERE v.status = 'pending'
+		   OR (v.status = 'running' AND v.edited_at < now() - interval '1 day')
+		ORDER BY v.id
+		LIMIT _limit
+		FOR UPDATE SKIP LOCKED
+	), upd AS (
+		UPDATE private.file_verification_table v
+		SET status = 'running'
+		FROM claimed
+		WHERE v.id = claimed.id
+		RETURNING v.id, v.stable_id
+	)
+	SELECT upd.id, upd.stable_id, f.relative_path, f.payload_checksum::text
+	FROM upd
+	INNER JOIN private.file_table f ON f.stable_id = upd.stable_id;
+END
+$_$;
+
+CREATE OR REPLACE FUNCTION public.complete_verification(
+	_id bigint,
+	_status text,
+	_details text
+)
+RETURNS void
+LANGUAGE plpgsql
+AS $_$
+BEGIN
+	UPDATE private.file_verification_table
+	SET status = _status::private.verification_status,
+	    details = _details,
+	    verified_at = now()
+	WHERE id = _id;
+END
+$_$;
+
+
+CREATE OR REPLACE FUNCTION public.session_keys_since(_since timestamp with time zone)
+RETURNS TABLE(checksum text, created_at timestamp with time zone)
+LANGUAGE sql STABLE
+AS $_$
+	SELECT s.checksum, s.created_at
+	FROM private.session_key_table s
+	WHERE _since IS NULL OR s.created_at >= _since;
+$_$;
+
+-- Return the checksums used for another file (or NULL)
+CREATE OR REPLACE FUNCTION public.session_keys_used(_checksums text[], _username text, _filepath text)
+RETURNS text[]
+LANGUAGE sql STABLE
+AS $_$
+	SELECT array_agg(s.checksum)
+	FROM private.session_key_table s
+	WHERE s.checksum = ANY(_checksums)
+	  AND NOT (s.username = _username AND s.filepath = _filepath);
+$_$;
+
+CREATE OR REPLACE FUNCTION public.save_session_keys(_checksums text[], _username text, _filepath text)
+RETURNS text[]
+LANGUAGE plpgsql
+AS $_$
+BEGIN
+	INSERT INTO private.session_key_table (checksum, username, filepath)
+	SELECT DISTINCT unnest(_checksums), _username, _filepath
+	ON CONFLICT ON CONSTRAINT session_key_table_pkey
+	DO NOTHING;
+
+	RETURN public.session_keys_used(_checksums, _username, _filepath);
+END
+$_$;
+
+
+CREATE OR REPLACE FUNCTION public.processed_message(_key text)
+RETURNS jsonb
+LANGUAGE sql STABLE
+AS $_$
+	SELECT result FROM private.processed_message_table
+	WHERE key = _key AND result <> '{}'::jsonb; -- only the completed jobs
+$_$;
+
+-- Only the completed jobs are recorded (with the message they emitted)
+-- An empty result (recorded by earlier versions) is replaced
+CREATE OR REPLACE FUNCTION public.record_processed_message(_key text, _job_type text, _correlation_id text, _result jsonb)
+RETURNS void
+LANGUAGE sql
+AS $_$
+	INSERT INTO private.processed_message_table AS t (key, job_type, correlation_id, result)
+	SELECT _key, _job_type, _correlation_id, _result
+	WHERE _result IS NOT NULL AND _result <> '{}'::jsonb
+	ON CONFLICT ON CONSTRAINT processed_message_table_pkey
+	DO UPDATE SET result = EXCLUDED.result
+	WHERE t.result = '{}'::jsonb;
+$_$;
+
+
+-- Set the files of a dataset: an incremental diff against its current links
+-- The message is exploded once (deduplicated), and the links are reached through
+-- the primary key (dataset_stable_id, file_stable_id): only that dataset's rows are read.
+-- The remaps of a same dataset are serialized, so they can't interleave (nor deadlock).
 CREATE OR REPLACE FUNCTION public.process_mapping_message(_json_message jsonb)
     RETURNS bigint
     LANGUAGE 'plpgsql'
 AS $BODY$
 DECLARE
+	_dataset_id text := _json_message->>'dataset_id';
+	_file_ids text[];
 	_rows_inserted bigint;
 BEGIN
-	WITH metadata_data(metadata_json) AS (
-		SELECT (_json_message)
+	SELECT array_agg(DISTINCT file_id) INTO _file_ids
+	FROM jsonb_array_elements_text(_json_message->'accession_ids') AS f(file_id);
 
-	), metadata_rows AS (
-		SELECT --metadata_json->>'type' AS type, 
-			metadata_json->>'dataset_id' AS dataset_accession_id,
-			jsonb_array_elements_text(metadata_json->'accession_ids') AS file_accession_id
-		FROM metadata_data s
-
-	), ins_dataset AS (
-		INSERT INTO public.dataset_table AS dft (stable_id)
-		SELECT s.dataset_accession_id
-		FROM metadata_rows s
-		ON CONFLICT ON CONSTRAINT dataset_table_pkey
-		DO NOTHING
-	), find_links AS (
-		SELECT dft.dataset_stable_id, dft.file_stable_id
-		FROM public.dataset_file_table dft
-		INNER JOIN metadata_rows s ON s.dataset_accession_id=dft.dataset_stable_id
-		LEFT JOIN metadata_rows s2 ON s2.dataset_accession_id=dft.dataset_stable_id
-						AND s2.file_accession_id=dft.file_stable_id
-		WHERE s2.file_accession_id IS NULL -- this file is no longer in the list
-	), del_removed_links AS (
-		DELETE FROM public.dataset_file_table dft
-		USING find_links
-		WHERE dft.dataset_stable_id=find_links.dataset_stable_id
-			AND dft.file_stable_id=find_links.file_stable_id
-	), insrt AS (
-		INSERT INTO public.dataset_file_table AS dft (dataset_stable_id, file_stable_id)
-		SELECT s.dataset_accession_id, s.file_accession_id
-		FROM metadata_rows s
-		LEFT JOIN public.dataset_file_table already ON s.dataset_accession_id=already.dataset_stable_id
-								AND s.file_accession_id=already.file_stable_id
-		WHERE already.file_stable_id IS NULL -- file is not present in the table
-		RETURNING dft.file_stable_id
-	)
-	SELECT count(*) INTO _rows_inserted
-	FROM insrt;
+	IF _file_ids IS NULL THEN -- no files: nothing to do
+		RETURN 0;
+	END IF;
 
+	PERFORM pg_advisory_xact_lock(hashtext('mapping'), hashtext(_dataset_id));
+
+	INSERT INTO public.dataset_table(stable_id)
+	VALUES(_dataset_id)
+	ON CONFLICT ON CONSTRAINT dataset_table_pkey
+	DO NOTHING;
+
+	-- the files no longer in the list
+	DELETE FROM public.dataset_file_table dft
+	WHERE dft.dataset_stable_id = _dataset_id
+	  AND NOT EXISTS (SELECT 1 FROM unnest(_file_ids) AS f(file_id)
+	                  WHERE f.file_id = dft.file_stable_id);
+
+	-- the new ones (the others are left untouched)
+	INSERT INTO public.dataset_file_table(dataset_stable_id, file_stable_id)
+	SELECT _dataset_id, f.file_id
+	FROM unnest(_file_ids) AS f(file_id)
+	WHERE NOT EXISTS (SELECT 1 FROM public.dataset_file_table dft
+	                  WHERE dft.dataset_stable_id = _dataset_id
+	                    AND dft.file_stable_id = f.file_id)
+	ORDER BY f.file_id
+	ON CONFLICT DO NOTHING;
+
+	GET DIAGNOSTICS _rows_inserted = ROW_COUNT;
 	RETURN _rows_inserted;
-
 END
 $BODY$;
 
@@ -179,6 +374,9 @@ DECLARE
 	_user jsonb;
 	_username text;
 	_user_id bigint;
+	_digest bytea;
+	_unchanged boolean;
+	_expires_at timestamp with time zone;
 BEGIN
 	_stable_id = _json_message->>'dataset_id';
 	IF _stable_id IS NULL THEN
@@ -191,56 +389,74 @@ BEGIN
 	END IF;
 
 	_username = _user->>'username';
+	_digest = sha256(convert_to(_user::text, 'UTF8')); -- jsonb text is canonical (sorted keys)
 
 	RAISE NOTICE '_username= %', _username;
 
-	-----------------
-	-- Upsert user --
-	-----------------
-	-- We not use ON CONFLICT DO UPDATE here to not increment the sequence
-	-- every time the user already exists (we will receive many permissions for the same user)
+	-- Permissions come by the hundreds for the same user, mostly with the same user block:
+	-- if it has not changed since the last one, the user, password and keys are left untouched.
+	SELECT t.id, t.digest IS NOT DISTINCT FROM _digest INTO _user_id, _unchanged
+	FROM public.user_table t
+	WHERE t.username = _username;
+
+	IF _unchanged IS NOT TRUE THEN
+
+		-----------------
+		-- Upsert user --
+		-----------------
+		-- We not use ON CONFLICT DO UPDATE here to not increment the sequence
+		-- every time the user already exists (we will receive many permissions for the same user)
+
+		IF _user_id IS NULL THEN
+			INSERT INTO public.user_table AS t (username, group_id, full_name, email, institution, country, digest)
+			SELECT _username, 20000, _user->>'full_name', _user->>'email', _user->>'institution', _user->>'country', _digest
+			RETURNING t.id INTO _user_id;
+		ELSE
+			UPDATE public.user_table t
+			SET full_name=_user->>'full_name',
+				email=_user->>'email',
+				institution=_user->>'institution',
+				country=_user->>'country',
+				digest=_digest
+			WHERE t.id = _user_id;
+		END IF;
 
-	UPDATE public.user_table t
-	SET full_name=_user->>'full_name',
-		email=_user->>'email',
-		institution=_user->>'institution',
-		country=_user->>'country'
-	WHERE t.username = _username
-	RETURNING t.id INTO _user_id;
+		---------------------
+		-- Upsert password --
+		---------------------
+		INSERT INTO private.user_password_table AS t (user_id, password_hash)
+		SELECT _user_id,  _user->>'password_hash'
+		ON CONFLICT ON CONSTRAINT user_password_table_pkey
+		DO UPDATE
+		SET password_hash=EXCLUDED.password_hash
+		WHERE t.password_hash IS DISTINCT FROM EXCLUDED.password_hash
+		;
 
-	IF _user_id IS NULL THEN
-		INSERT INTO public.user_table AS t (username, group_id, full_name, email, institution, country)
-		SELECT _username, 20000, _user->>'full_name', _user->>'email', _user->>'institution', _user->>'country'
-		RETURNING t.id INTO _user_id;
+		-----------------
+		-- Update keys --
+		-----------------
+		-- Only the removed and the new keys (each insert parses the key)
+		DELETE FROM public.user_key_table t
+		WHERE t.user_id=_user_id
+		  AND NOT EXISTS (SELECT 1 FROM jsonb_array_elements(_user->'keys') _val
+		                  WHERE _val->>'key' = t.key AND (_val->>'type')::public.key_type = t.type);
+
+		INSERT INTO public.user_key_table (user_id, key, type)
+		SELECT DISTINCT _user_id, _val->>'key', (_val->>'type')::public.key_type
+		FROM jsonb_array_elements(_user->'keys') _val
+		WHERE NOT EXISTS (SELECT 1 FROM public.user_key_table t
+		                  WHERE t.user_id=_user_id AND t.key = _val->>'key'
+		                    AND t.type = (_val->>'type')::public.key_type);
 	END IF;
 
-	---------------------
-	-- Upsert password --
-	---------------------
-	INSERT INTO private.user_password_table (user_id, password_hash)
-	SELECT _user_id,  _user->>'password_hash'
-	ON CONFLICT ON CONSTRAINT user_password_table_pkey
-	DO UPDATE
-	SET password_hash=EXCLUDED.password_hash
-	;
-
-	-----------------
-	-- Insert keys --
-	-----------------
-	-- 1st) Delete existing keys
-	DELETE FROM public.user_key_table
-	WHERE user_id=_user_id;
-
-	-- 2n) Insert keys
-	INSERT INTO public.user_key_table (user_id, key, type)
-	SELECT _user_id, _val->>'key', (_val->>'type')::public.key_type
-	FROM jsonb_array_elements(_user->'keys') _val;
-
 	-----------------------
 	-- Upsert permission --
 	-----------------------
+	-- Central EGA sends "None" when the permission does not expire
+	_expires_at = NULLIF(_json_message->>'expires_at', 'None')::timestamp with time zone;
+
 	UPDATE private.dataset_permission_table
-	SET expires_at=(_json_message->>'expires_at')::timestamp with time zone,
+	SET expires_at=_expires_at,
 		edited_at=(_json_message->>'edited_at')::timestamp with time zone
 	WHERE dataset_stable_id=_stable_id AND user_id=_user_id;
 
@@ -248,7 +464,7 @@ BEGIN
 		INSERT INTO private.dataset_permission_table (dataset_stable_id, user_id, expires_at, created_at, edited_at)
 		SELECT _stable_id,
 		_user_id,
-		(_json_message->>'expires_at')::timestamp with time zone,
+		_expires_at,
 		(_json_message->>'created_at')::timestamp with time zone,
 		(_json_message->>'edited_at')::timestamp with time zone;
 	END IF;
@@ -314,6 +530,10 @@ BEGIN
 	FROM user_table ut
 	WHERE upt.user_id=ut.id AND ut.username=_username;
 
+	UPDATE public.user_table
+	SET digest=NULL
+	WHERE username=_username;
+
 	RETURN 1;
 END
 $BODY$;
@@ -358,6 +578,10 @@ BEGIN
     SELECT _user_id, _val->>'key', (_val->>'type')::public.key_type
     FROM jsonb_array_elements(_keys) _val;
 
+    UPDATE public.user_table
+    SET digest=NULL
+    WHERE id=_user_id;
+
 	RETURN 1;
 END
 $BODY$;
@@ -383,7 +607,8 @@ BEGIN
     SET full_name=_json_message->>'full_name',
             email=_json_message->>'email',
             institution=_json_message->>'institution',
-            country=_json_message->>'country'
+            country=_json_message->>'country',
+            digest=NULL
     WHERE t.username = _username
     RETURNING t.id INTO _user_id;
 
@@ -484,7 +709,8 @@ BEGIN
 			SET full_name=EXCLUDED.full_name,
                 email=EXCLUDED.email,
                 institution=EXCLUDED.institution,
-                country=EXCLUDED.country
+                country=EXCLUDED.country,
+                digest=NULL
 			RETURNING t.id, t.username
 		), ins_password AS (
 			INSERT INTO private.user_password_table AS t (user_id, password_hash, is_enabled)
@@ -611,7 +837,8 @@ BEGIN
 		SET full_name=EXCLUDED.full_name,
 			email=EXCLUDED.email,
 			institution=EXCLUDED.institution,
-			country=EXCLUDED.country
+			country=EXCLUDED.country,
+			digest=NULL
 		RETURNING t.id, t.username
 	), ins_password AS (
 		INSERT INTO private.user_password_table AS t (user_id, password_hash, is_enabled)
@@ -733,3 +960,45 @@ BEGIN
 END
 $BODY$;
 
+
+-- Process a batch of metadata messages (a jsonb array), in one round trip
+-- Each message is processed in its own savepoint: an error only rolls back that message,
+-- except a deadlock or a serialization failure, which rolls back the whole batch (to be retried).
+-- Returns a jsonb array, in the same order: {"response": <rows>} or {"error": <message>}
+CREATE OR REPLACE FUNCTION public.process_message_batch(_json_messages jsonb)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $_$
+DECLARE
+	_message jsonb;
+	_response bigint;
+	_results jsonb := '[]'::jsonb;
+BEGIN
+	FOR _message IN SELECT value FROM jsonb_array_elements(_json_messages) WITH ORDINALITY ORDER BY ordinality
+	LOOP
+		BEGIN
+			CASE _message->>'type'
+				WHEN 'mapping'            THEN _response := public.process_mapping_message(_message);
+				WHEN 'release'            THEN _response := public.process_release_message(_message);
+				WHEN 'deprecate'          THEN _response := public.process_deprecated_message(_message);
+				WHEN 'permission'         THEN _response := public.process_permission_message(_message);
+				WHEN 'permission.deleted' THEN _response := public.process_deleted_permission_message(_message);
+				WHEN 'password.updated'   THEN _response := public.process_user_password_message(_message);
+				WHEN 'keys.updated'       THEN _response := public.process_user_keys_message(_message);
+				WHEN 'contact.updated'    THEN _response := public.process_user_contact_message(_message);
+				WHEN 'dac.dataset'        THEN _response := public.process_dac_dataset_message(_message);
+				WHEN 'dac.members'        THEN _response := public.process_dac_members_message(_message);
+				WHEN 'dac'                THEN _response := public.process_dac_message(_message);
+				ELSE RAISE EXCEPTION 'Invalid message type: %', _message->>'type';
+			END CASE;
+			_results := _results || jsonb_build_array(jsonb_build_object('response', _response));
+		EXCEPTION
+			WHEN deadlock_detected OR serialization_failure THEN
+				RAISE; -- not the message's fault: the whole batch is rolled back, and retried
+			WHEN OTHERS THEN
+				_results := _results || jsonb_build_array(jsonb_build_object('error', SQLERRM));
+		END;
+	END LOOP;
+	RETURN _results;
+END
+$_$;
@@ -57,3 +57,7 @@ CREATE TRIGGER dataset_permission_table_update_edited_columns
 BEFORE UPDATE ON private.dataset_permission_table
 FOR EACH ROW EXECUTE PROCEDURE public.update_edited_columns();
 
+
+CREATE TRIGGER file_verification_table_update_edited_columns
+BEFORE UPDATE ON private.file_verification_table
+FOR EACH ROW EXECUTE PROCEDURE public.update_edited_columns();
@@ -18,3 +18,66 @@ CREATE INDEX idx_user_id_user_password_table
 ON private.user_password_table
 USING btree (user_id ASC NULLS LAST)
 ;
+
+
+-- #####################
+-- Datasets
+-- #####################
+
+-- The primary key (dataset_stable_id, file_stable_id) serves the mapping diffs.
+-- This one serves the lookups by file (which datasets is it in?),
+-- and the foreign key checks when a file is updated or removed.
+CREATE INDEX idx_file_stable_id_dataset_file_table
+ON public.dataset_file_table
+USING btree (file_stable_id)
+;
+
+
+-- #####################
+-- Verifications
+-- #####################
+
+CREATE INDEX idx_stable_id_file_verification_table
+ON private.file_verification_table
+USING btree (stable_id)
+;
+
+-- Only the pending (or running) ones are looked up
+CREATE INDEX idx_pending_file_verification_table
+ON private.file_verification_table
+USING btree (id)
+WHERE status IN ('pending', 'running')
+;
+
+
+-- #####################
+-- Session keys
+-- #####################
+
+-- For the incremental refresh of the handlers Bloom filters
+CREATE INDEX idx_created_at_session_key_table
+ON private.session_key_table
+USING btree (created_at)
+;
+
+
+-- #####################
+-- Processed messages
+-- #####################
+
+-- To purge the old ones
+CREATE INDEX idx_created_at_processed_message_table
+ON private.processed_message_table
+USING btree (created_at)
+;
+
+
+-- #####################
+-- Backfill
+-- #####################
+
+-- Each merge only reads its partition
+CREATE INDEX idx_partition_backfill_table
+ON private.backfill_table
+USING btree (partition)
+;
@@ -17,9 +17,24 @@ GRANT SELECT,INSERT,UPDATE,DELETE 	ON TABLE private.file_table 		TO lega;
 GRANT USAGE                             ON SEQUENCE private.dataset_permission_table_id_seq TO lega;
 GRANT SELECT,INSERT,UPDATE,DELETE	ON TABLE private.dataset_permission_table	TO lega;
 GRANT SELECT,INSERT,UPDATE,DELETE	ON TABLE private.user_password_table		TO lega;
+GRANT USAGE                             ON SEQUENCE private.file_verification_table_id_seq TO lega;
+GRANT SELECT,INSERT,UPDATE		ON TABLE private.file_verification_table	TO lega;
+GRANT SELECT,INSERT			ON TABLE private.session_key_table		TO lega;
+GRANT SELECT,INSERT,UPDATE		ON TABLE private.processed_message_table	TO lega;
+GRANT SELECT,INSERT,DELETE,TRUNCATE	ON TABLE private.backfill_table			TO lega;
 
 GRANT EXECUTE ON FUNCTION public.extract_name(text) 				TO lega;
 GRANT EXECUTE ON FUNCTION public.upsert_file 					TO lega;
+GRANT EXECUTE ON FUNCTION public.merge_backfill_datasets 			TO lega;
+GRANT EXECUTE ON FUNCTION public.merge_backfill 				TO lega;
+GRANT EXECUTE ON FUNCTION public.record_verification 				TO lega;
+GRANT EXECUTE ON FUNCTION public.claim_verifications 				TO lega;
+GRANT EXECUTE ON FUNCTION public.complete_verification 				TO lega;
+GRANT EXECUTE ON FUNCTION public.session_keys_since 				TO lega;
+GRANT EXECUTE ON FUNCTION public.session_keys_used 				TO lega;
+GRANT EXECUTE ON FUNCTION public.save_session_keys 				TO lega;
+GRANT EXECUTE ON FUNCTION public.processed_message 				TO lega;
+GRANT EXECUTE ON FUNCTION public.record_processed_message 			TO lega;
 GRANT EXECUTE ON FUNCTION public.process_dac_dataset_message(jsonb) 		TO lega;
 GRANT EXECUTE ON FUNCTION public.process_mapping_message(jsonb) 		TO lega;
 GRANT EXECUTE ON FUNCTION public.process_release_message 			TO lega;
@@ -29,6 +44,7 @@ GRANT EXECUTE ON FUNCTION public.process_deleted_permission_message 		TO lega;
 GRANT EXECUTE ON FUNCTION public.process_user_password_message             	TO lega;
 GRANT EXECUTE ON FUNCTION public.process_user_keys_message             		TO lega;
 GRANT EXECUTE ON FUNCTION public.process_user_contact_message             	TO lega;
+GRANT EXECUTE ON FUNCTION public.process_message_batch(jsonb)             	TO lega;
 
 GRANT USAGE	ON SCHEMA crypt4gh 					TO lega;
 GRANT EXECUTE 	ON FUNCTION crypt4gh.parse_pubkey 			TO lega;